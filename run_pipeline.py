@@ -2,7 +2,8 @@ from __future__ import unicode_literals
 import yaml
 from pathlib import Path
 import os
-import pandas as pd
+import queue
+import threading
 
 from src.pipeline_components.tile_creator import TileCreator
 from src.pipeline_components.tile_downloader import TileDownloader
@@ -10,6 +11,8 @@ from src.pipeline_components.tile_processor import TileProcessor
 from src.pipeline_components.tile_updater import TileCoordsUpdater
 from src.utils.geojson_handler import GeoJsonHandler
 from src.pipeline_components.registry_creator import RegistryCreator
+from src.utils.tile_buffer import TileBuffer
+from src.utils.run_state import RunStateStore
 
 def main():
 
@@ -23,71 +26,134 @@ def main():
 
     run_tile_creator = conf.get('run_tile_creator', 0)
     run_tile_downloader = conf.get('run_tile_downloader', 0)
+    retry_failed_tiles = conf.get('retry_failed_tiles', 0)
     run_tile_processor = conf.get('run_tile_processor', 0)
     run_tile_updater = conf.get('run_tile_coords_updater', 0)
     run_registry_creator = conf.get('run_registry_creator', 0)
 
+    # Downloading and processing overlap if both pipeline steps are executed in streaming mode
+    stream_tiles = run_tile_downloader and run_tile_processor and conf.get('stream_tiles', 0)
+
+    # Tiles can only be handed over in memory if the processor runs at the same time as the downloader
+    if conf.get('tile_handoff', 'disk') == 'memory' and not stream_tiles:
+
+        print('tile_handoff: memory requires stream_tiles: 1, tiles are saved to disk instead.')
+
+        conf['tile_handoff'] = 'disk'
+
     # Todo: Do the set up for your repo here
     # 1. Use the county variable to only select tiles which lie within your selected county
     # 2. Use the county variable to download the respective rooftop polygons file from AWS S3
 
     county4analysis = conf.get('county4analysis', 'Essen')
     nrw_county_data_path = conf.get('nrw_county_data_path', 'data/nrw_county_data/nrw_counties.geojson')
-    downloaded_path = Path(f"logs/downloading/{county4analysis}_downloadedTiles.csv")
-    processed_path = Path(f"logs/processing/{county4analysis}_processedTiles.csv")
 
     # ------- GeoJsonHandler provides utility functions -------
 
     county_handler = GeoJsonHandler(nrw_county_data_path, county4analysis)
 
-    # ------- TileCreator creates pickle file with all tiles in NRW and their respective minx, miny, maxx, maxy coordinates -------
+    # ------- TileCreator creates an index file with all tiles in NRW and their respective tile ID and minx, miny, maxx, maxy coordinates -------
 
     if run_tile_creator:
 
-        print("Starting to create a pickle file with the bounding box coordinates for all tiles within your selected county ... This will take a while")
+        print("Starting to create an index file with the bounding box coordinates for all tiles within your selected county ...")
 
-        tileCreator = TileCreator(county_handler=county_handler)
+        tileCreator = TileCreator(configuration=conf, county_handler=county_handler)
 
         tileCreator.defineTileCoords()
 
-        print('Pickle file has been sucessfully created')
+        print('Tile index has been sucessfully created')
 
-    # Tile_coords is a list of tuples. Each tuple specifies its respective tile by minx, miny, maxx, maxy.
+    # Tile_coords is a TileIndex. It maps each tile's integer ID to its respective minx, miny, maxx, maxy.
     tile_coords = county_handler.returnTileCoords()
 
     print(f'{len(tile_coords)} tiles have been identified.')
 
-    # ------- TileDownloader downloads tiles from openNRW in a multi-threaded fashion -------
+    # ------- RunStateStore tracks each tile from pending to done across all pipeline steps and restarts -------
+
+    run_state = RunStateStore.from_configuration(conf)
+
+    run_state.register(tile_coords.ids.tolist())
+
+    # ------- TileDownloader downloads tiles from openNRW with a configurable number of concurrent asyncio workers -------
+
+    # ------- In streaming mode, TileProcessor processes each tile as soon as TileDownloader has completed it -------
+
+    if stream_tiles:
+
+        print('Starting to download and process ' + str(len(tile_coords)) + ' tiles at the same time. This will take a while.')
+
+        # The buffer pauses downloads when the processor falls behind, the queue hands over completed tiles
+        tile_buffer = TileBuffer.from_configuration(conf)
+
+        # Tiles handed over in memory are bounded by the queue size instead of the tile buffer
+        if conf.get('tile_handoff', 'disk') == 'memory':
+
+            tile_queue = queue.Queue(maxsize=conf.get('memory_queue_size', 4))
 
-    if run_tile_downloader:
+        else:
+
+            tile_queue = queue.Queue()
+
+        # The processor lists tile_dir before the first download completes, later tiles arrive via tile_queue
+        tileProcessor = TileProcessor(configuration=conf, polygon=county_handler.polygon, tile_coords=tile_coords,
+                                      tile_buffer=tile_buffer, tile_queue=tile_queue, run_state=run_state)
+
+        downloader = TileDownloader(configuration=conf, polygon=county_handler.polygon, tile_coords=tile_coords,
+                                    tile_buffer=tile_buffer, tile_queue=tile_queue, run_state=run_state)
+
+        # Failed tiles are retried within the download, so that the processor still receives them
+        download_thread = threading.Thread(target=downloader.run, kwargs={'retry_failed_tiles': retry_failed_tiles})
+
+        download_thread.start()
+
+        try:
+
+            # Returns once the downloader has put None into tile_queue and all remaining tiles are processed
+            tileProcessor.run()
+
+        finally:
+
+            # A failing processor would otherwise leave the downloader waiting for space in the buffer or the queue
+            downloader.stop()
+
+            download_thread.join()
+
+    elif run_tile_downloader:
 
         print('Starting to download ' + str(len(tile_coords)) + '. This will take a while.')
 
-        downloader = TileDownloader(configuration=conf, polygon=county_handler.polygon, tile_coords=tile_coords)
+        downloader = TileDownloader(configuration=conf, polygon=county_handler.polygon, tile_coords=tile_coords,
+                                    run_state=run_state)
+
+        downloader.run()
 
-    if os.path.exists(Path(downloaded_path)):
+    if retry_failed_tiles and not stream_tiles:
 
-        # Load DownloadedTiles.csv file
-        downloadedTiles_df = pd.read_table(downloaded_path, header=None)
+        downloader = TileDownloader(configuration=conf, polygon=county_handler.polygon, tile_coords=tile_coords,
+                                    run_state=run_state)
 
-        print(f"{downloadedTiles_df[0].nunique()} unique tiles have been successfully downloaded.")
+        downloader.retry_failed()
 
-    if run_tile_processor:
+    if run_tile_processor and not stream_tiles:
 
-        tileProcessor = TileProcessor(configuration=conf, polygon=county_handler.polygon)
+        tileProcessor = TileProcessor(configuration=conf, polygon=county_handler.polygon, tile_coords=tile_coords,
+                                      run_state=run_state)
 
         tileProcessor.run()
 
-    if os.path.exists(processed_path):
+    # Downloaded tiles which have been processed since are counted as done
+    tile_states = run_state.counts()
+
+    print(f"{tile_states.get('downloaded', 0) + tile_states.get('done', 0)} unique tiles have been successfully downloaded.")
 
-        # Load DownloadedTiles.csv file
-        processedTiles_df = pd.read_table(processed_path, header=None)
+    print(f"{tile_states.get('done', 0)} unique tiles have been successfully processed.")
 
-        print(f"{processedTiles_df[0].nunique()} unique tiles have been successfully processed.")
+    print("Tiles per state: " + ", ".join(f"{state} {count}" for state, count in sorted(tile_states.items())))
 
     if run_tile_updater:
 
-        updater = TileCoordsUpdater(configuration=conf, tile_coords=tile_coords)
+        updater = TileCoordsUpdater(configuration=conf, tile_coords=tile_coords, run_state=run_state)
 
         updater.update()
 
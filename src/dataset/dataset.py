@@ -1,7 +1,62 @@
 from __future__ import print_function
 from __future__ import division
 import os
-from torch.utils.data import Dataset, DataLoader
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.data import Dataset, DataLoader, IterableDataset
+
+
+def split_sample(tile_splitter, filename, tile_bytes=None):
+    """
+    Decodes a tile and splits it into the images which are processed by the TileProcessor. Errors are returned with
+    the sample instead of being raised, so that a single corrupt tile does not stop the DataLoader.
+
+    Parameters
+    ----------
+    tile_splitter : src.utils.tile_splitter.TileSplitter
+        Decodes and splits a tile.
+    filename : str
+        File name of the tile.
+    tile_bytes : bytes
+        PNG bytes of the tile if it was handed over in memory.
+
+    Returns
+    -------
+    dict
+        File name of the tile, whether it was handed over in memory, coordinates and images within the county, and
+        the exception if the tile could not be decoded or split.
+    """
+
+    sample = {'tile': filename, 'in_memory': tile_bytes is not None, 'coords': [], 'images': None, 'error': None}
+
+    try:
+
+        sample['coords'], sample['images'] = tile_splitter(filename, tile_bytes)
+
+    except Exception as e:
+
+        sample['error'] = e
+
+    return sample
+
+
+def idle_sample():
+
+    # Announces that no tile is ready yet, so that the consumer does not hold back images while it waits
+    return {'tile': None}
+
+
+def is_idle(sample):
+
+    return sample['tile'] is None
+
+
+def unbatched(sample):
+
+    # collate_fn for DataLoader(batch_size=None), which otherwise converts the samples' lists and tuples
+    return sample
+
 
 '''
 Customized Dataset for openNRW tiles
@@ -9,7 +64,11 @@ Customized Dataset for openNRW tiles
 
 class NrwDataset(Dataset):
 
-    def __init__(self, data_root):
+    def __init__(self, data_root, tile_splitter=None):
+
+        # If set, __getitem__ returns decoded and split tiles instead of file names, so that DataLoader workers
+        # prepare the next tiles while the current one is processed
+        self.tile_splitter = tile_splitter
 
         self.samples = []
 
@@ -29,4 +88,116 @@ class NrwDataset(Dataset):
 
     def __getitem__(self, idx):
 
-        return self.samples[idx]
\ No newline at end of file
+        if self.tile_splitter is not None:
+
+            return split_sample(self.tile_splitter, self.samples[idx])
+
+        return self.samples[idx]
+
+
+'''
+Customized Dataset for openNRW tiles which are downloaded while they are being processed
+'''
+
+class NrwStreamDataset(IterableDataset):
+
+    def __init__(self, data_root, tile_queue, tile_splitter=None, num_workers=2, prefetch=2, idle_timeout=1.0):
+
+        # Tiles which are already complete when processing starts, e.g. from a previous run
+        self.initial_samples = [elem for elem in os.listdir(data_root) if elem[-12:] == 'COMPLETE.png']
+
+        # The TileDownloader puts the file name of each completed tile, or its name and bytes if tiles are handed over in
+        # memory, into tile_queue and None once it is done
+        self.tile_queue = tile_queue
+
+        # tile_queue cannot be shared with DataLoader worker processes, hence tiles are decoded and split by a pool of
+        # num_workers threads instead, at most prefetch tiles ahead of the consumer
+        self.tile_splitter = tile_splitter
+
+        self.num_workers = max(1, num_workers)
+
+        self.prefetch = max(1, prefetch)
+
+        # If no tile is ready within idle_timeout seconds, an idle sample is yielded before waiting on
+        self.idle_timeout = idle_timeout
+
+    def __iter__(self):
+
+        if self.tile_splitter is None:
+
+            for filename, tile_bytes in self._tiles():
+
+                yield filename if tile_bytes is None else (filename, tile_bytes)
+
+            return
+
+        futures = queue.Queue(maxsize=self.prefetch)
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+
+            feeder = threading.Thread(target=self._feed, args=(pool, futures), daemon=True)
+
+            feeder.start()
+
+            while True:
+
+                try:
+
+                    future = futures.get(timeout=self.idle_timeout)
+
+                # The next tile may only be downloaded once the consumer has finished the tiles it holds, e.g. when the
+                # tile buffer is full, hence the consumer is told to process its partial batches
+                except queue.Empty:
+
+                    yield idle_sample()
+
+                    future = futures.get()
+
+                if future is None:
+
+                    break
+
+                yield future.result()
+
+    def _feed(self, pool, futures):
+
+        try:
+
+            for filename, tile_bytes in self._tiles():
+
+                # Blocks while prefetch tiles are waiting to be consumed
+                futures.put(pool.submit(split_sample, self.tile_splitter, filename, tile_bytes))
+
+        finally:
+
+            futures.put(None)
+
+    def _tiles(self):
+
+        seen = set()
+
+        for elem in self.initial_samples:
+
+            seen.add(elem)
+
+            yield elem, None
+
+        while True:
+
+            elem = self.tile_queue.get()
+
+            if elem is None:
+
+                break
+
+            # Tiles handed over in memory arrive as (file name, PNG bytes)
+            filename, tile_bytes = (elem, None) if isinstance(elem, str) else elem
+
+            # A tile which completed while tile_dir was listed is announced twice
+            if filename in seen:
+
+                continue
+
+            seen.add(filename)
+
+            yield filename, tile_bytes
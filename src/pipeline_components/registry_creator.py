@@ -10,6 +10,7 @@ import geocoder
 import time
 import math
 from typing import List, Tuple
+from src.utils.detection_writer import detections_path, read_detections
 
 
 class RawSolarDatabase:
@@ -42,6 +43,29 @@ class RawSolarDatabase:
         solar_db["class"] = int(1)
         return solar_db[["class", "geometry"]]
 
+    def from_arrow(self, dir_path: Path):
+        """
+        Load raw PV polygons detected during the previous pipeline step from the Arrow files written by the
+        DetectionWriter and convert it to a Geopandas.GeoDataFrame with EPSG:4326 as the coordinate reference system.
+        The polygons are stored as well-known binary and decoded all at once.
+
+        Parameters
+        ----------
+        dir_path: Path
+            Path to the directory where all detected PV polygons from the tile processing step are stored.
+
+        Returns
+        -------
+        GeoPandas.GeoDataFrame
+            GeoPandas.GeoDataFrame specifying all raw PV polygons detected during the previous pipeline step within a
+            given county.
+        """
+
+        solar_db = gpd.GeoDataFrame(read_detections(dir_path), geometry="geometry")
+        solar_db.crs = {"init": "epsg:4326"}
+        solar_db["class"] = int(1)
+        return solar_db[["class", "geometry"]]
+
 
 class RegistryCreator:
     """
@@ -71,9 +95,14 @@ class RegistryCreator:
         """
 
         self.county = configuration.get("county4analysis")
-        self.raw_PV_polygons_gdf = RawSolarDatabase().from_csv(
-            Path(f"data/pv_database/{self.county}_PV_db.csv")
-        )
+        if configuration.get("detection_format", "arrow") == "arrow":
+            self.raw_PV_polygons_gdf = RawSolarDatabase().from_arrow(
+                detections_path(self.county, "arrow")
+            )
+        else:
+            self.raw_PV_polygons_gdf = RawSolarDatabase().from_csv(
+                detections_path(self.county, "csv")
+            )
 
         self.rooftop_gdf = gpd.read_file(
             Path(f"{configuration['rooftop_data_dir']}/{self.county}.geojson")
@@ -1,18 +1,18 @@
 # -*- coding: utf-8 -*-
-import numpy as np
-import pickle
-from shapely.geometry import Point
 from pathlib import Path
+from src.utils.building_index import BuildingIndex
+from src.utils.tile_grid import TileGrid
+from src.utils.tile_index import TileIndex
 
 
 class TileCreator(object):
     """
-    Class to generate a list specifying all tiles within a given county by their minx, miny, maxx, maxy coordinates.
+    Class to generate an index specifying all tiles within a given county by their tile ID and their minx, miny, maxx, maxy coordinates.
 
     Attributes
     ----------
     output_path : Path
-        Path to the pickle file which saves the list of all tiles within the selected county.
+        Path to the .npy file which saves the index of all tiles within the selected county.
     radius : int
         Earth radius in meters.
     side : int
@@ -27,16 +27,20 @@ class TileCreator(object):
         Western boundary for the tile coordinates.
     polygon : shapely.geometry.polygon.Polygon 
         Geo-referenced polygon geometry for the selected county within NRW.
+    building_index : src.utils.building_index.BuildingIndex
+        Building footprints of the selected county. Tiles without any building are not saved. None if tiles are not filtered by buildings.
     """
 
-    def __init__(self, county_handler):
+    def __init__(self, configuration, county_handler):
         """
         Parameters
         ----------
+        configuration : dict
+            config.yml in dict format.
         county_handler : GeoJsonHandler
             GeoJsonHandler instance which specifies the name and the geo-referenced polygon for a selected county within North Rhine-Westphalia (NRW).
         """
-        self.output_path = Path(f"data/coords/{county_handler.name}.pickle")
+        self.output_path = Path(f"data/coords/{county_handler.name}.npy")
         self.radius = 6371000
         self.side = 240
 
@@ -48,68 +52,28 @@ class TileCreator(object):
 
         self.polygon = county_handler.polygon
 
+        self.building_index = BuildingIndex.from_configuration(configuration)
+
     def defineTileCoords(self):
         """
-        Spans a grid of tiles, each with a dimension 240m x 240m, over North Rhine-Westphalia and saves the tiles within the respective county by their minx, miny, maxx, maxy coordinates. 
-        Only tiles where at least one corner is within the county's polygon will be saved and later downloaded.
+        Spans a grid of tiles, each with a dimension 240m x 240m, over North Rhine-Westphalia and saves the tiles within the respective county by their tile ID and minx, miny, maxx, maxy coordinates. 
+        Only tiles where at least one corner is within the county's polygon and, if rooftop data is available, which contain at least one building will be saved and later downloaded.
         """
 
-        # dlat spans a distance of 'side' meters in north-south direction:
-        # 1 degree in latitude direction spans (2*np.pi*r)/360° meters
-        # Hence, 'side' meters need to be divided by this quantity to obtain
-        # the number of degrees which span 'side' meters in latitude (north-south) direction
-        dlat = (self.side*360) / (2*np.pi*self.radius)
-
-        Tile_coords = []
-
-        y = self.S
-
-        while y < self.N:
-
-            x = self.W
-
-            while x < self.E:
-
-                # Center point of current image tile
-
-                cp = Point(x,y)
-
-                # Download 4800x4800 pixel imagery if one of the bounding box corners is inside the NRW polygon
-
-                # Bounding box coordinates for a given image tile
-                minx = x - (((self.side * 360) / (2 * np.pi * self.radius * np.cos(np.deg2rad(y))))/2)
-
-                miny = y - dlat/2
-
-                maxx = x + (((self.side * 360) / (2 * np.pi * self.radius * np.cos(np.deg2rad(y))))/2)
-
-                maxy = y + dlat/2
-
-                # Bounding box corners for a given image tile
-
-                # Lower Left
-                LL = Point(minx,miny)
-
-                # Lower Right
-                LR = Point(maxx,miny)
-
-                # Upper Left
-                UL = Point(minx,maxy)
-
-                # Upper Right
-                UR = Point(maxx, maxy)
+        # The grid is computed as NumPy arrays and whole blocks of tiles which lie completely inside or outside
+        # the county are accepted or rejected at once, see src.utils.tile_grid.TileGrid
+        grid = TileGrid(N=self.N, S=self.S, E=self.E, W=self.W, side=self.side, radius=self.radius)
 
-                # If bounding box corners are within NRW polygon
-                if (self.polygon.intersects(LL) | self.polygon.intersects(LR) | self.polygon.intersects(UL) | self.polygon.intersects(UR)):
+        rows, cols = grid.select(self.polygon)
 
-                    Tile_coords.append((minx, miny, maxx, maxy))
+        # Forests, fields and water bodies cannot contain rooftop PV systems and are not downloaded at all
+        if self.building_index is not None:
 
-                # Update longitude value
-                x = x + ((self.side * 360) / (2 * np.pi * self.radius * np.cos(np.deg2rad(y))))
+            with_building = self.building_index.intersects(*grid.bounds(rows, cols))
 
-            # Update latitude value
-            y = y + dlat
+            print(f"{with_building.sum()} of {len(rows)} tiles contain buildings.")
 
-        with open(self.output_path, 'wb') as f:
+            rows, cols = rows[with_building], cols[with_building]
 
-            pickle.dump(Tile_coords, f)
+        # Tiles are identified by their (row, col) position on the grid and saved as a memory-mappable .npy file
+        TileIndex.from_grid(grid, rows, cols).save(self.output_path)
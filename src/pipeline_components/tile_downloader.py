@@ -1,46 +1,100 @@
-import csv
+import asyncio
+import hashlib
+import io
 import os
-import pickle
-import json
-from itertools import chain
-from shapely.geometry.polygon import Polygon
-import threading
-import shutil
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full
 from pathlib import Path
+import aiohttp
+from src.utils.tile_index import tile_filename
+from src.utils.patch_grid import PATCHES_PER_TILE, PATCH_SIZE, TILE_SIZE, patch_window, window_bbox
+from src.utils.download_manifest import DownloadManifest, decodes, sha256_file
+from src.utils.rate_control import AdaptiveConcurrencyLimiter, RetryPolicy
+from src.utils.tile_buffer import TileBuffer
+from src.utils.run_state import RunStateStore
 
 class TileDownloader(object):
     """
-    Class to download tiles from the openNRW web server in a multi-threaded fashion.
-    
+    Class to download tiles from the openNRW web server with asyncio. All tiles are put into a shared work queue which
+    is consumed by a configurable number of concurrent workers. The workers share a single HTTP session, i.e. its
+    keep-alive connection pool, so TCP and TLS connections to the web server are reused between tiles.
+
+    Downloads are resumable and idempotent: every complete tile is recorded in a manifest with its size, checksum and a
+    decode check. On a restart, recorded tiles are skipped, corrupt tiles are fetched again, and partially downloaded
+    tiles are resumed with HTTP range requests if the server supports them.
+
+    Transient errors such as timeouts, dropped connections or 5xx responses are retried with exponential backoff and
+    jitter. The number of concurrent requests adapts to the server's health: it grows while requests succeed quickly
+    and is halved when requests fail or become slow.
+
+    Downloads pause while the TileBuffer, i.e. the downloaded but not yet processed tiles, is full or the disk is
+    running out of space, and resume as soon as the TileProcessor has deleted enough tiles.
+
+    With tile_handoff set to 'memory', tiles are not written to disk at all. The downloaded bytes are put into the
+    bounded tile_queue and decoded by the TileProcessor straight from memory.
+
+    Tiles along the county border are only requested for the block of 16 x 16 m images which lie within the county.
+    The TileProcessor puts such a clipped tile back into place within the full 4800 x 4800 pixel tile.
+
     Attributes
     ----------
+    tile_coords : src.utils.tile_index.TileIndex
+        Index of all tiles within the selected county by their tile ID and minx, miny, maxx, maxy coordinates.
     tile_dir : Path
         Path to directory where all the downloaded tiles are saved.
-    downloaded_path : Path
-        Specifies the path to the document which saves all the tiles by their minx, miny, maxx, maxy coordinates which were successfully downloaded.
-    not_downloaded_path : Path
-        Specifies the path to the document which saves all the tiles by their minx, miny, maxx, maxy coordinates which were **not** successfully downloaded.
+    run_state : src.utils.run_state.RunStateStore
+        Records for every tile whether it is being downloaded, has been downloaded, or could **not** be downloaded together with the error and the number of attempts.
+    tile_buffer : src.utils.tile_buffer.TileBuffer
+        Bounds the amount of downloaded, but not yet processed tiles in tile_dir.
+    tile_queue : queue.Queue
+        If set, the file name of each completed tile is put into this queue so that a TileProcessor can start processing it right away. None is put into the queue once all downloads are done.
+    tile_handoff : str
+        'disk' saves tiles in tile_dir. 'memory' puts (file name, PNG bytes) into tile_queue instead and requires a TileProcessor running at the same time.
+    manifest : src.utils.download_manifest.DownloadManifest
+        Record of all completely downloaded tiles with their size, checksum and decode check.
+    verify_checksums : bool
+        Recompute the checksum of all tiles on disk on a restart instead of only comparing their size.
+    clip_border_tiles : bool
+        Request border tiles only for the images within the county instead of the full tile.
     WMS_1 : str
         Initial URL stub for requests to the openNRW server.
     WMS_2 : str
         Final URL stub for requests to the openNRW server.
-    NUM_THREADS : int
-        Number of threads used to simultaneously download tiles from the openNRW server. 
+    concurrency : int
+        Maximum number of tiles which are simultaneously downloaded from the openNRW server. This is also the size of the connection pool.
+    min_concurrency : int
+        Lower bound for the number of simultaneous downloads when the server is overloaded.
+    latency_target : float
+        Downloads which take longer than this many seconds are considered a sign of overload.
+    retry_policy : src.utils.rate_control.RetryPolicy
+        Specifies how often and after which delay a failed download is retried.
+    timeout : float
+        Seconds after which a request is aborted if the server does not send any data.
+    chunk_size : int
+        Number of bytes which are read from the response and written to disk at once.
     """
 
-    def __init__(self, configuration, polygon, tile_coords):
+    def __init__(self, configuration, polygon, tile_coords, tile_buffer=None, tile_queue=None, run_state=None,
+                 manifest=None):
         """
-        Sets instance variables and starts donwloading process in a multi-threaded fashion
-        
+        Sets instance variables for the downloading process
+
         Parameters
         ----------
         configuration : dict
             config.yml in dict format.
         polygon : shapely.geometry.polygon.Polygon
             Geo-referenced polygon geometry for the selected county within NRW.
-        tile_coords : list
-            List of tuples where each tuple specifies its respective tile by minx, miny, maxx, maxy.
+        tile_coords : src.utils.tile_index.TileIndex
+            Index of all tiles within the selected county by their tile ID and minx, miny, maxx, maxy coordinates.
+        tile_buffer : src.utils.tile_buffer.TileBuffer
+            Buffer shared with a TileProcessor running at the same time. If None, a buffer is created from the configuration.
+        tile_queue : queue.Queue
+            Queue which hands completed tiles to a TileProcessor running at the same time.
+        run_state : src.utils.run_state.RunStateStore
+            Store shared with the other pipeline steps. If None, the store of the county is opened.
+        manifest : src.utils.download_manifest.DownloadManifest
+            Manifest of the downloaded tiles. If None, the manifest of the county is opened.
         """
 
         self.polygon = polygon
@@ -49,110 +103,491 @@ class TileDownloader(object):
 
         self.tile_dir = Path(configuration['tile_dir'])
 
-        self.downloaded_path = Path(f"logs/downloading/{configuration.get('county4analysis')}_downloadedTiles.csv")
+        self.tile_buffer = tile_buffer if tile_buffer is not None else TileBuffer.from_configuration(configuration)
+
+        self.tile_queue = tile_queue
+
+        self.tile_handoff = configuration.get('tile_handoff', 'disk') if tile_queue is not None else 'disk'
+
+        self.run_state = run_state if run_state is not None else RunStateStore.from_configuration(configuration)
+
+        self.manifest = manifest if manifest is not None else DownloadManifest(
+            Path(f"logs/downloading/{configuration.get('county4analysis')}_downloadManifest.jsonl"), self.tile_dir
+        )
+
+        self.verify_checksums = bool(configuration.get('verify_checksums', 0))
 
-        self.not_downloaded_path = Path(f"logs/downloading/{configuration.get('county4analysis')}_notDownloadedTiles.csv")
+        self.clip_border_tiles = bool(configuration.get('clip_border_tiles', 1))
 
-        # URL dummy for image request from open NRW server
-        self.WMS_1 = 'https://www.wms.nrw.de/geobasis/wms_nw_dop?SERVICE=WMS&REQUEST=GetMap&Version=1.1.1&LAYERS=nw_dop_rgb&SRS=EPSG:4326&BBOX='
+        # URL dummy for image request from open NRW server. wms_url can point to a local mock server for testing
+        wms_url = configuration.get('wms_url', 'https://www.wms.nrw.de/geobasis/wms_nw_dop')
 
-        self.WMS_2 = '&WIDTH=4800&HEIGHT=4800&FORMAT=image/png;%20mode=8bit'
+        self.WMS_1 = wms_url + '?SERVICE=WMS&REQUEST=GetMap&Version=1.1.1&LAYERS=nw_dop_rgb&SRS=EPSG:4326&BBOX='
 
-        self.NUM_THREADS = 4
+        self.WMS_2 = '&FORMAT=image/png;%20mode=8bit'
 
-        download_threads = []
+        self.concurrency = configuration.get('download_concurrency', 8)
 
-        for num in range(0, self.NUM_THREADS):
-            # Download_threads is a list which contains thread objects that get passed their respective function to execute, here the download function, and the necessary arguments to execute that
-            # function in form of a tuple
-            download_threads.append(threading.Thread(target=self.download, args=(self.tile_coords, num,)))
+        self.min_concurrency = configuration.get('download_min_concurrency', 1)
 
-        for num in range(0, self.NUM_THREADS):
-            # Iterate over all thread objects and start them
-            download_threads[num].start()
+        self.latency_target = configuration.get('download_latency_target', 60)
 
-            print('Successfully started thread ' + str(num))
+        self.retry_policy = RetryPolicy(
+            max_retries=configuration.get('download_max_retries', 5),
+            base_delay=configuration.get('download_backoff_base', 1.0),
+            max_delay=configuration.get('download_backoff_max', 60.0),
+        )
 
-        for t in download_threads:
-            # Iterate over all threads and execute them
-            t.join()
+        self.timeout = configuration.get('download_timeout', 300)
 
-    def download(self, Tile_coords, threadCounter):
+        self.chunk_size = 1024 * 1024
+
+        self._stopped = False
+
+    def run(self, retry_failed_tiles=False):
         """
-        Download tiles from openNRW's web servers.
-        
+        Downloads all tiles within the selected county which have not been completely downloaded yet.
+
         Parameters
         ----------
-        Tile_coords : list
-            List of tuples. Each tuple specifies a to be downloaded tile by its minx, miny, maxx, maxy.
-        threadCounter : int
-            ID to distinguish between the different threads working in parallel.
+        retry_failed_tiles : bool
+            Whether tiles which fail are retried once all other tiles have been downloaded. The retry is part of the
+            download, i.e. retried tiles are handed to a TileProcessor running at the same time as well.
+        """
+
+        tile_ids = self.pending_tiles()
+
+        print(f'{len(self.tile_coords) - len(tile_ids)} tiles are already complete, {len(tile_ids)} tiles remain to be downloaded.')
+
+        try:
+
+            asyncio.run(self.download_all(tile_ids))
+
+            if retry_failed_tiles:
+
+                self.retry_failed()
+
+        finally:
+
+            # Signal the end of the download to a TileProcessor running at the same time, even if the download failed
+            if self.tile_queue is not None and not self._stopped:
+
+                try:
+
+                    self._put(None)
+
+                # The TileProcessor has stopped in the meantime and does not wait for the signal anymore
+                except RuntimeError:
+
+                    pass
+
+    def stop(self):
+        """
+        Stops a download running in another thread, e.g. after the TileProcessor failed. Tiles which have not been
+        started yet keep their state, downloads which wait for the TileProcessor fail.
+        """
+
+        self._stopped = True
+
+        self.tile_buffer.close()
+
+    def _put(self, item):
+
+        # Blocks while the queue is full, but notices a stop of the download within a second
+        while not self._stopped:
+
+            try:
+
+                self.tile_queue.put(item, timeout=1.0)
+
+                return
+
+            except Full:
+
+                continue
+
+        raise RuntimeError('Download has been stopped')
+
+    def pending_tiles(self):
+        """
+        Identifies all tiles which are missing, corrupt or only partially downloaded. Tiles which have already been
+        processed are not downloaded again.
+
         Returns
         -------
+        list
+            Integer IDs of the tiles which need to be downloaded.
+        """
+
+        existing_files = set(os.listdir(self.tile_dir))
 
+        done = set(self.run_state.tiles('done'))
+
+        pending = []
+
+        for tile_id in self.tile_coords.ids.tolist():
+
+            if tile_id in done:
+
+                continue
+
+            filename = tile_filename(tile_id)
+
+            # Tiles which were completely downloaded before the manifest existed are verified once and recorded
+            if tile_id not in self.manifest.entries and filename in existing_files:
+
+                if self.manifest.record(tile_id, self.tile_dir / filename):
+
+                    continue
+
+                os.remove(self.tile_dir / filename)
+
+                existing_files.discard(filename)
+
+            if not self.manifest.is_complete(tile_id, existing_files, verify_checksum=self.verify_checksums, processed=done):
+
+                pending.append(tile_id)
+
+        return pending
+
+    def failed_tiles(self):
         """
-        
-        for index, tile in enumerate(Tile_coords):
+        Identifies all tiles whose download failed and which have not been completely downloaded since.
 
-            if index % self.NUM_THREADS == threadCounter:
+        Returns
+        -------
+        list
+            Integer IDs of the failed tiles.
+        """
 
-                minx, miny, maxx, maxy = tile
+        failed = set(self.run_state.tiles('failed', stage='download'))
 
-                # cease when disk space not enough
-                while 1:
+        existing_files = set(os.listdir(self.tile_dir))
 
-                    st = os.statvfs(self.tile_dir)
+        return [
+            tile_id for tile_id in self.tile_coords.ids.tolist()
+            if tile_id in failed and not self.manifest.is_complete(tile_id, existing_files)
+        ]
 
-                    # f_frsize − fundamental file system block size.
-                    # f_bavail − free blocks available to non-super user.
-                    # Storage capacity can be calculated by multiplying number of free blocks * block size
-                    # Remember: 1 KB are 1024 Bytes. Hence, 1 MB are 1024*1024 Bytes
-                    remain_capacity = st.f_bavail * st.f_frsize / 1024 / 1024
+    def retry_failed(self):
+        """
+        Re-queues all tiles which could not be downloaded in previous runs. Their attempts keep counting, tiles which
+        fail again stay failed with the new error.
+        """
 
-                    # if remain_capacity is larger than 1 GB, continue downloading tiles
-                    if remain_capacity > 1024:
+        tile_ids = self.failed_tiles()
 
-                        break
+        print(f'Re-queueing {len(tile_ids)} tiles which could not be downloaded before.')
 
-                    print(str(threadCounter), ": Disk space not enough!")
+        asyncio.run(self.download_all(tile_ids))
 
-                try:
+    async def download_all(self, tile_ids):
+        """
+        Downloads the given tiles with up to self.concurrency workers which share one work queue and one connection
+        pool. The number of requests in flight is controlled by an AdaptiveConcurrencyLimiter.
+
+        Parameters
+        ----------
+        tile_ids : iterable
+            Integer IDs of the to be downloaded tiles.
+        """
+
+        queue = asyncio.Queue()
+
+        for tile_id in tile_ids:
+
+            queue.put_nowait(int(tile_id))
+
+        # The connector keeps up to self.concurrency connections alive and hands them from one request to the next
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=self.timeout)
+
+        # The limiter is bound to the running event loop, hence it is created here
+        self.limiter = AdaptiveConcurrencyLimiter(
+            initial_limit=self.concurrency, min_limit=self.min_concurrency, max_limit=self.concurrency,
+            latency_target=self.latency_target,
+        )
+
+        # Waiting for the tile buffer or for the TileProcessor to take a tile blocks a thread for as long as the
+        # TileProcessor is busy. Such waits get their own thread, so that they never hold up the decoding and
+        # checksumming in the default executor. One thread is enough, since a single freed slot only lets one tile pass
+        self._wait_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tile-buffer')
+
+        try:
+
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+                workers = [asyncio.create_task(self._worker(session, queue)) for _ in range(self.concurrency)]
+
+                print(f'Successfully started {len(workers)} download workers')
+
+                # Wait until every tile has been taken from the queue and handled
+                await queue.join()
+
+                for worker in workers:
+
+                    worker.cancel()
+
+                await asyncio.gather(*workers, return_exceptions=True)
+
+        finally:
+
+            self._wait_executor.shutdown(wait=False)
+
+    async def _worker(self, session, queue):
+
+        # Each worker takes the next tile from the shared queue as soon as it is done with the previous one,
+        # hence a slow tile only holds up a single worker
+        while True:
+
+            tile_id = await queue.get()
+
+            try:
+
+                # The remaining tiles of a stopped download keep their state and are downloaded in the next run
+                if self._stopped:
+
+                    continue
+
+                await self.download(session, tile_id)
+
+            # Unexpected errors, e.g. a bug or a failing run state store, fail the tile instead of stopping the worker
+            except Exception as e:
+
+                self._fail(tile_id, f"{type(e).__name__}: {e}")
+
+            finally:
+
+                queue.task_done()
+
+    def _fail(self, tile_id, error):
+
+        try:
+
+            self.run_state.set_state(tile_id, 'failed', error)
+
+        except Exception as e:
+
+            print(f"Could not save tile {tile_id} as failed ({error}): {e}")
+
+    def _url(self, tile_id):
+
+        minx, miny, maxx, maxy = self.tile_coords.bbox(tile_id)
+
+        width = height = TILE_SIZE
+
+        if self.clip_border_tiles and self.polygon is not None:
+
+            window = patch_window(self.polygon, minx, maxy)
+
+            # Images outside the county are discarded by the TileProcessor anyway, hence they are not requested
+            if window != (0, PATCHES_PER_TILE, 0, PATCHES_PER_TILE):
+
+                minx, miny, maxx, maxy = window_bbox(minx, miny, maxx, maxy, window)
+
+                height = (window[1] - window[0]) * PATCH_SIZE
+                width = (window[3] - window[2]) * PATCH_SIZE
+
+        return (self.WMS_1 + str(minx) + ',' + str(miny) + ',' + str(maxx) + ',' + str(maxy)
+                + '&WIDTH=' + str(width) + '&HEIGHT=' + str(height) + self.WMS_2)
+
+    async def download(self, session, tile_id):
+        """
+        Download a single tile from openNRW's web servers. Transient errors are retried with exponential backoff.
+
+        Parameters
+        ----------
+        session : aiohttp.ClientSession
+            HTTP session whose connection pool is shared by all workers.
+        tile_id : int
+            Integer ID of the to be downloaded tile.
+        """
+
+        error = None
+
+        for attempt in range(self.retry_policy.max_retries + 1):
+
+            await self._reserve_space()
+
+            start = await self.limiter.acquire()
+
+            succeeded = False
+
+            retry_after = None
+
+            try:
+
+                self.run_state.set_state(tile_id, 'downloading')
+
+                if self.tile_handoff == 'memory':
+
+                    tile_bytes = await self._fetch_to_memory(session, tile_id)
+
+                else:
+
+                    await self._fetch_to_disk(session, tile_id)
+
+                succeeded = True
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+
+                error = f"{type(e).__name__}: {e}"
+
+                status = getattr(e, 'status', None)
+
+                if not self.retry_policy.is_retryable(status) or attempt == self.retry_policy.max_retries:
+
+                    break
+
+                headers = getattr(e, 'headers', None) or {}
+
+                retry_after = headers.get('Retry-After')
+
+                retry_after = float(retry_after) if retry_after is not None and retry_after.isdigit() else None
+
+            # Local errors, e.g. a full disk, are not going to be fixed by retrying immediately
+            except OSError as e:
+
+                error = f"{type(e).__name__}: {e}"
+
+                break
+
+            # The request slot and the reserved space in the tile buffer are returned whatever happened, any other
+            # exception is passed on to the worker
+            finally:
+
+                await self.limiter.release(start, success=succeeded)
+
+                if not succeeded:
+
+                    self._cancel_reservation()
+
+            if succeeded:
+
+                # Blocks while the queue is full, i.e. the TileProcessor is busy. This happens outside of the limiter,
+                # so that waiting for the processor does not count as server latency
+                if self.tile_handoff == 'memory':
+
+                    # Recorded before the hand-off, so that the TileProcessor's state change comes after it
+                    self.run_state.set_state(tile_id, 'downloaded')
+
+                    await asyncio.get_running_loop().run_in_executor(
+                        self._wait_executor, self._put, (tile_filename(tile_id), tile_bytes)
+                    )
+
+                return
+
+            await asyncio.sleep(self.retry_policy.delay(attempt, retry_after))
+
+        # Tiles that weren't fully downloaded are saved with their last error
+        self.run_state.set_state(tile_id, 'failed', error)
+
+    async def _reserve_space(self):
+
+        # Tiles handed over in memory never touch tile_dir, they are bounded by the size of tile_queue instead
+        if self.tile_handoff == 'disk':
+
+            # Waiting on the buffer blocks, hence it is done in the wait thread to keep the event loop running
+            await asyncio.get_running_loop().run_in_executor(self._wait_executor, self.tile_buffer.wait_for_space)
+
+    def _cancel_reservation(self):
+
+        if self.tile_handoff == 'disk':
+
+            self.tile_buffer.cancel()
+
+    async def _fetch_to_memory(self, session, tile_id):
+
+        async with session.get(self._url(tile_id)) as response:
+
+            response.raise_for_status()
+
+            # read() raises a ClientPayloadError if the transfer is shorter than announced
+            tile_bytes = await response.read()
+
+        if not await asyncio.get_running_loop().run_in_executor(None, decodes, io.BytesIO(tile_bytes)):
+
+            raise aiohttp.ClientPayloadError(f'Tile {tile_id} cannot be decoded')
+
+        # The tile is not recorded in the manifest, because it only exists in memory until it has been processed
+        return tile_bytes
+
+    async def _fetch_to_disk(self, session, tile_id):
+
+        current_save_path = os.path.join(self.tile_dir, tile_filename(tile_id, complete=False))
+
+        loop = asyncio.get_running_loop()
+
+        # A partially downloaded tile from a previous attempt is resumed where it stopped
+        offset = os.path.getsize(current_save_path) if os.path.exists(current_save_path) else 0
+
+        headers = {'Range': f'bytes={offset}-'} if offset > 0 else {}
+
+        # Download tile imagery from URL
+        async with session.get(self._url(tile_id), headers=headers) as response:
+
+            # The partial file is invalid for this server, start from scratch on the next attempt
+            if response.status == 416:
+
+                os.remove(current_save_path)
+
+            response.raise_for_status()
+
+            # 206 means that the server honoured the range request, otherwise it sends the whole tile again
+            if response.status == 206:
+
+                checksum = await loop.run_in_executor(None, sha256_file, current_save_path)
+
+                mode = 'ab'
+
+            else:
+
+                checksum = hashlib.sha256()
+
+                offset = 0
+
+                mode = 'wb'
+
+            received = 0
 
-                    current_save_path = os.path.join(self.tile_dir, str(minx) + ',' + str(miny) + ',' + str(maxx) + ',' + str(maxy) +  '.png')
+            # Save downloaded file under current_save_path
+            with open(current_save_path, mode) as out_file:
 
-                    # Specify URL from which we download our tile
-                    url = os.path.join(self.WMS_1 + str(minx) + ',' + str(miny) + ',' + str(maxx) + ',' + str(maxy) + self.WMS_2)
+                async for chunk in response.content.iter_chunked(self.chunk_size):
 
-                    # Download tile imagery from URL
-                    response = requests.get(url, stream=True)
+                    out_file.write(chunk)
 
-                    # Save downloaded file under current_save_path
-                    with open(current_save_path, 'wb') as out_file:
+                    checksum.update(chunk)
 
-                        response.raw.decode_content = True
+                    received += len(chunk)
 
-                        shutil.copyfileobj(response.raw, out_file)
+            if response.content_length is not None and received != response.content_length:
 
-                    del response
+                raise aiohttp.ClientPayloadError(f'Tile {tile_id} is truncated')
 
-                    # This line will execute only after the whole tile has been downloaded
-                    # Once the tile is completely downloaded, we add a 'COMPLETE' string at
-                    # the end of its path to signal the Tile_Processing script which tiles
-                    # are ready to be processed
-                    os.rename(current_save_path, os.path.join(current_save_path[:-4] + ',COMPLETE.png'))
+        # Truncated or corrupt tiles are deleted, so that they are downloaded from scratch on the next attempt
+        if not await loop.run_in_executor(None, decodes, current_save_path):
 
-                    with open(Path(self.downloaded_path), "a") as csvFile:
+            os.remove(current_save_path)
 
-                        writer = csv.writer(csvFile, lineterminator="\n")
+            raise aiohttp.ClientPayloadError(f'Tile {tile_id} cannot be decoded')
 
-                        writer.writerow([str(tile)])
+        # This line will execute only after the whole tile has been downloaded
+        # Once the tile is completely downloaded, we add a 'COMPLETE' string at
+        # the end of its path to signal the Tile_Processing script which tiles
+        # are ready to be processed
+        os.rename(current_save_path, os.path.join(self.tile_dir, tile_filename(tile_id)))
 
-                # Only tiles that weren't fully downloaded are saved subsequently
-                except:
+        # The tile is recorded only after the rename. If the run is aborted in between, the tile is verified and
+        # recorded on the next restart
+        self.manifest.add(tile_id, offset + received, checksum.hexdigest(), decoded=True)
 
-                    with open(Path(self.not_downloaded_path),"a") as csvFile:
+        # Saved before the reserved space is filled, so that a failure to save it only has to cancel the reservation
+        self.run_state.set_state(tile_id, 'downloaded')
 
-                        writer = csv.writer(csvFile, lineterminator="\n")
+        self.tile_buffer.add(offset + received)
 
-                        writer.writerow([str(tile)])
+        if self.tile_queue is not None:
 
+            self.tile_queue.put(tile_filename(tile_id))
@@ -4,21 +4,29 @@ from __future__ import division
 from src.utils.polygon_creator import PolygonCreator
 from pathlib import Path
 import torch
-from torchvision import datasets, models, transforms, utils
-from torchvision.models.segmentation.deeplabv3 import DeepLabHead
-import csv
 import os
 import numpy as np
 from itertools import compress
-from shapely.geometry import Point, Polygon, MultiPolygon
-from PIL import Image
 from torch.nn import functional as F
-from torchvision.models import Inception3
-from torch.utils.data import Dataset, DataLoader
-from src.dataset.dataset import NrwDataset
+from torch.utils.data import DataLoader
+from src.dataset.dataset import NrwDataset, NrwStreamDataset, is_idle, unbatched
+from src.utils.tile_index import tile_id_from_filename
+from src.utils.batch_transform import BatchTransform
+from src.utils.patch_batcher import PatchBatcher
+from src.utils.building_index import BuildingIndex
+from src.utils.patch_prefilter import PatchPrefilter
+from src.utils.geo_utils import prepare
+from src.utils.tile_splitter import TileSplitter
+from src.utils.patch_grid import patch_corners, patch_indices
+from src.utils.inference_engine import DTYPES, InferenceEngine, configure_threads
+from src.utils.quantization import ModelQuantizer
+from src.utils.model_loader import load_cls_model, load_seg_model
+from src.utils.model_export import export_models, exported_path, is_outdated, load_engine
+from src.utils.detection_writer import DetectionWriter, detections_path
+from src.utils.run_state import RunStateStore
+from itertools import chain
 import sys
 
-# TODO: Modularize __processTiles() by writing separate functions for classifying and segmenting a batch
 class TileProcessor(object):
     """
     Class which splits tiles into smaller images, performs a binary classifiaction on each image to identify PV panels and segments a PV system's area on positively classified images.
@@ -39,20 +47,48 @@ class TileProcessor(object):
         Path for loading the pre-trained segmentation weights. 
     tile_dir : str
         Path to directory where all the downloaded tiles are saved.
+    detection_format : str
+        File format of the detected PV systems, 'arrow' or 'csv'.
     pv_db_path : Path
-        Path to the .csv file which saves the tile ID, the image ID, and the geo-referenced polygon for all identified PV systems.
-    processed_path : Path
-        Path to the .csv file which saves all the tile IDs which have been successfully processed.
-    not_processed_path : Path
-        Path to the .csv file which saves all the tile IDs which have been **not** successfully processed.
+        Path to the directory of .arrow files or to the .csv file which saves the tile ID, the image ID, and the geo-referenced polygon for all identified PV systems.
+    detection_writer : src.utils.detection_writer.DetectionWriter
+        Buffers the detected PV systems and writes them to pv_db_path in chunks.
+    unlogged_tiles : list
+        Processed tiles which are only saved as done once their PV systems have been written.
+    run_state : src.utils.run_state.RunStateStore
+        Records for every tile whether it is being processed, has been processed, or could **not** be processed together with the error.
+    backend : str
+        Runtime both models run in, 'eager', 'torchscript' or 'onnxruntime'.
     cls_model : torchvision.models.inception.Inception3
-        Model to identify PV panels on aerial imagery.
+        Model to identify PV panels on aerial imagery. None if the model runs as an exported graph.
     seg_model : torchvision.models.segmentation.deeplabv3.DeepLabV3
-        Model to segment PV panels on aerial imagery.
-    dataset : src.dataset.dataset.NrwDataset
-        All the images which will be processed by our PV pipeline.
+        Model to segment PV panels on aerial imagery. None if the model runs as an exported graph.
+    inference_dtype : torch.dtype
+        Floating point type both models run in.
+    channels_last : int
+        Whether both models run on inputs in channels last memory format.
+    cls_engine : src.utils.inference_engine.InferenceEngine
+        Runs the classification model without autograd on the device and records its latency.
+    seg_engine : src.utils.inference_engine.InferenceEngine
+        Runs the segmentation model without autograd on the device and records its latency.
+    quantization : str
+        Quantized inference mode, 'none', 'dynamic_int8', 'static_int8' or 'bf16'.
+    calibration_images : int
+        Number of images from the first tiles used to calibrate and check the quantized models.
+    quantizer : src.utils.quantization.ModelQuantizer
+        Quantizes both models at the start of the run and checks them against the float32 models.
+    dataset : src.dataset.dataset.NrwDataset or src.dataset.dataset.NrwStreamDataset
+        All the images which will be processed by our PV pipeline. In streaming mode, tiles are added while they are being downloaded.
     polygon : shapely.geometry.polygon.Polygon 
         Geo-referenced polygon geometry for the selected county within NRW.
+    tile_coords : src.utils.tile_index.TileIndex
+        Index of all tiles within the selected county, used to look up a tile's minx, miny, maxx, maxy coordinates by its tile ID.
+    building_index : src.utils.building_index.BuildingIndex
+        Building footprints of the selected county. Only images close to a building are classified. None if images are not filtered by buildings.
+    prefilter : src.utils.patch_prefilter.PatchPrefilter
+        Rejects uniform, vegetated and no-data images before they are classified, or only reports which images it would reject in calibration mode. None if images are not prefiltered.
+    tile_buffer : src.utils.tile_buffer.TileBuffer
+        Buffer shared with a TileDownloader running at the same time, which is notified whenever a processed tile is deleted. None if no download is running.
     radius : int
         Earth radius in meters.
     side : int
@@ -63,9 +99,27 @@ class TileProcessor(object):
         Spans a distance of 16 meters in north-south direction.
     polygonCreator : src.utils.polygon_creator.PolygonCreator
         Turns binary segmentation mask of PV systems into geo-referenced polygons.
+    stitch_masks : int
+        Whether the segmentation masks of a tile are put together and polygonized at once, so that PV systems crossing image borders result in a single polygon.
+    batch_transform : src.utils.batch_transform.BatchTransform
+        Converts a batch of images into the normalized input tensors of the classification and the segmentation model.
+    decode_workers : int
+        Number of worker processes which decode and split tiles while the models process the current tile. In streaming mode, worker threads are used instead.
+    prefetch_tiles : int
+        Number of tiles each worker prepares ahead of time.
+    tile_splitter : src.utils.tile_splitter.TileSplitter
+        Decodes a tile and splits it into the images within the county.
+    seg_batch_size : int
+        Specifies the number of samples per batch processed by the segmentation network.
+    cls_queue : src.utils.patch_batcher.PatchBatcher
+        Images of all tiles which are waiting for classification.
+    seg_queue : src.utils.patch_batcher.PatchBatcher
+        Positively classified images of all tiles which are waiting for segmentation.
+    pending_tiles : dict
+        Tiles whose images are still queued for processing by their file name, with the number of images which have not been classified and not been completely processed yet, whether the tile was handed over in memory, the error of a failed batch, if any, and the segmentation masks of its images with PV systems, which are polygonized once the tile is done.
     """
 
-    def __init__(self, configuration, polygon):
+    def __init__(self, configuration, polygon, tile_coords, tile_buffer=None, tile_queue=None, run_state=None):
 
         # Execute on gpu, if available
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
@@ -80,6 +134,9 @@ class TileProcessor(object):
 
         self.input_size = configuration['input_size']
 
+        # Positively classified images are collected across classification batches and segmented in batches of this size
+        self.seg_batch_size = configuration.get('seg_batch_size', self.batch_size)
+
         # ------ Specify required input directories ------
         self.cls_checkpoint_path = configuration['cls_checkpoint_path']
 
@@ -88,22 +145,87 @@ class TileProcessor(object):
         self.tile_dir = configuration['tile_dir']
 
         # ------ Specify required output directories ------
-        self.pv_db_path = Path(f"data/pv_database/{configuration.get('county4analysis')}_PV_db.csv")
+        self.detection_format = configuration.get('detection_format', 'arrow')
+
+        self.pv_db_path = detections_path(configuration.get('county4analysis'), self.detection_format)
+
+        # PV systems are written in chunks of detection_buffer_size polygons instead of one by one
+        self.detection_writer = DetectionWriter(self.pv_db_path, self.detection_format, configuration.get('detection_buffer_size', 1000))
 
-        self.processed_path = Path(f"logs/processing/{configuration.get('county4analysis')}_processedTiles.csv")
+        self.unlogged_tiles = []
 
-        self.not_processed_path = Path(f"logs/processing/{configuration.get('county4analysis')}_notProcessedTiles.csv")
+        self.run_state = run_state if run_state is not None else RunStateStore.from_configuration(configuration)
 
         # ------ Load model and dataset ------
-        self.cls_model = self.__loadClsModel()
+        # Number of CPU threads within and across operators, 0 keeps PyTorch's default
+        configure_threads(configuration.get('intra_op_threads', 0), configuration.get('inter_op_threads', 0))
+
+        self.inference_dtype = DTYPES[configuration.get('inference_dtype', 'float32')]
+
+        self.channels_last = configuration.get('channels_last', 1)
+
+        self.backend = configuration.get('backend', 'eager')
+
+        if self.backend == 'eager':
+
+            self.cls_model = self.__loadClsModel()
+
+            self.seg_model = self.__loadSegModel()
+
+            # Both models run without autograd on self.device, and their inputs are moved there batch by batch
+            self.cls_engine = InferenceEngine(self.cls_model, 'Classification', self.device, self.inference_dtype, self.channels_last)
+
+            self.seg_engine = InferenceEngine(self.seg_model, 'Segmentation', self.device, self.inference_dtype, self.channels_last)
+
+        else:
+
+            self.cls_model = self.seg_model = None
+
+            cls_path = exported_path(self.cls_checkpoint_path, self.backend)
+
+            seg_path = exported_path(self.seg_checkpoint_path, self.backend)
+
+            # The models are exported next to their checkpoints once, and again whenever a checkpoint changes
+            if is_outdated(cls_path, self.cls_checkpoint_path) or is_outdated(seg_path, self.seg_checkpoint_path):
+
+                print(f"Exporting models for backend {self.backend} ...")
+
+                export_models(configuration, self.backend)
+
+            # Exported graphs run in float32
+            self.cls_engine = load_engine(cls_path, self.backend, 'Classification', self.device, self.channels_last)
+
+            self.seg_engine = load_engine(seg_path, self.backend, 'Segmentation', self.device, self.channels_last)
+
+        # Both models are quantized on the first calibration_images images of the run and kept in float32 if they do
+        # not agree with the float32 models on at least quantization_min_agreement of these images
+        self.quantization = configuration.get('quantization', 'none')
 
-        self.seg_model = self.__loadSegModel()
+        if self.quantization != 'none' and self.backend != 'eager':
 
-        self.dataset = NrwDataset(self.tile_dir)
+            print(f"quantization: {self.quantization} requires backend: eager, models are not quantized.")
+
+            self.quantization = 'none'
+
+        self.calibration_images = configuration.get('calibration_images', 32)
+
+        self.quantizer = ModelQuantizer(self.quantization, self.cls_threshold, self.seg_threshold,
+                                        configuration.get('quantization_min_agreement', 0.98))
 
         # ------ Set auxiliary instance variables ------
         self.polygon = polygon
 
+        # Speeds up the point-in-polygon tests in __splitTile()
+        prepare(self.polygon)
+
+        self.tile_coords = tile_coords
+
+        self.tile_buffer = tile_buffer
+
+        self.building_index = BuildingIndex.from_configuration(configuration)
+
+        self.prefilter = PatchPrefilter.from_configuration(configuration)
+
         # Avg. earth radius in meters
         self.radius = 6371000
 
@@ -116,298 +238,452 @@ class TileProcessor(object):
         # dlat spans a distance of 16 meters in north-south direction:
         self.dlat = (self.side * 360) / (2 * np.pi * self.radius)
 
-        self.polygonCreator = PolygonCreator(self.size, self.side, self.radius, self.dlat)
+        # Optionally removes the pixel staircases from the PV polygons, either with a tolerance in meters or by fitting rectangles
+        self.polygonCreator = PolygonCreator(self.size, self.side, self.radius, self.dlat,
+                                             configuration.get('simplification', 'none'),
+                                             configuration.get('simplify_tolerance_m', 0.1))
 
-    def __loadClsModel(self):
+        self.stitch_masks = configuration.get('stitch_masks', 1)
+
+        # Resizing and normalization for both models, applied to whole batches of images
+        self.batch_transform = BatchTransform(self.input_size)
+
+        # Tiles are decoded and split into images ahead of time by decode_workers worker processes, each holding
+        # up to prefetch_tiles tiles. 0 decodes tiles in the main process
+        self.decode_workers = configuration.get('decode_workers', 2)
 
-        # Specify model architecture
-        cls_model = Inception3(num_classes=2, aux_logits=True, transform_input=False)
-        cls_model = cls_model.to(self.device)
+        self.prefetch_tiles = configuration.get('prefetch_tiles', 2)
 
-        # Load old parameters
-        checkpoint = torch.load(self.cls_checkpoint_path, map_location=self.device)
+        self.tile_splitter = TileSplitter(self.tile_dir, self.polygon, self.tile_coords, self.building_index, self.side, self.radius)
 
-        if self.cls_checkpoint_path[-4:] == '.tar':  # it is a checkpoint dictionary rather than just model parameters
+        # In streaming mode, the TileDownloader hands over each tile as soon as it is complete
+        if tile_queue is not None:
 
-            cls_model.load_state_dict(checkpoint['model_state_dict'])
+            self.dataset = NrwStreamDataset(self.tile_dir, tile_queue, self.tile_splitter, self.decode_workers, self.prefetch_tiles)
 
         else:
 
-            cls_model.load_state_dict(checkpoint)
+            self.dataset = NrwDataset(self.tile_dir, self.tile_splitter)
 
-        # Put model into inference mode
-        cls_model.eval()
+    def __loadClsModel(self):
 
-        return cls_model
+        return load_cls_model(self.cls_checkpoint_path)
 
     def __loadSegModel(self):
 
-        seg_model = models.segmentation.deeplabv3_resnet101(pretrained=True, progress=True)
+        return load_seg_model(self.seg_checkpoint_path)
+
+    def __classifyBatch(self, tiles, coords, images):
+
+        # batch_transform() converts the uint8 images of shape [N,320,320,3] into normalized tensors of shape
+        # [N,3,320,320] for segmentation and resizes them to [N,3,299,299] for classification, all in one go
+        batch4cls, batch4seg = self.batch_transform(images)
+
+        # Classify batch, the engine returns the outputs on the CPU without any computational graph attached
+        cls_outputs = self.cls_engine(batch4cls)
+        cls_prob = F.softmax(cls_outputs, dim=1).numpy()
+
+        # PV_bool is a boolean array in which TRUE values correspond to images in our batch which depict PV systems
+        PV_bool = cls_prob[:, 1] >= self.cls_threshold
+
+        # Checks how many of the positively classified images the prefilter would have rejected
+        if self.prefilter is not None and self.prefilter.calibration:
+
+            self.prefilter.record(images, PV_bool)
+
+        # Positively classified images are queued for the segmentation model together with their tile and coordinates (upper left image corner)
+        if PV_bool.sum() > 0:
+
+            # The classification score is saved together with the PV systems of each image
+            for tile, image_coords, score in zip(compress(tiles, PV_bool), compress(coords, PV_bool), cls_prob[PV_bool, 1]):
+
+                self.pending_tiles[tile]['scores'][image_coords] = score
 
-        seg_model.classifier = DeepLabHead(2048, 1)
+            self.seg_queue.add(list(compress(tiles, PV_bool)), list(compress(coords, PV_bool)), batch4seg[PV_bool])
 
-        checkpoint = torch.load(self.seg_checkpoint_path, map_location=self.device)
+        # Negatively classified images are done
+        return list(compress(tiles, ~PV_bool))
 
-        seg_model.load_state_dict(checkpoint['model_state_dict'])
+    def __segmentBatch(self, tiles, coords, batch4seg):
 
-        seg_model.eval()
+        seg_outputs = self.seg_engine(batch4seg)
+        seg_outputs = seg_outputs['out'].squeeze(1)
+        seg_outputs = seg_outputs.numpy()
+        # min-max scaling per image, so that an image's mask does not depend on the other images in the batch
+        seg_min = seg_outputs.min(axis=(1, 2), keepdims=True)
+        seg_max = seg_outputs.max(axis=(1, 2), keepdims=True)
+        seg_outputs = (seg_outputs - seg_min) / (seg_max - seg_min + 0.000000001)
+        # setting a threshold to turn CAMs into binary segmentation masks
+        seg_outputs = seg_outputs >= self.seg_threshold
+        # Turn class activation maps (CAMs) into binary segmentation masks
+        seg_masks = [CAM.astype(np.int32) for CAM in seg_outputs]
+        # Only consider binary segmentation masks with at least one positive pixel
+        # I.e. ignore instances where an image is positively classified, but the segmentation model does not activate any pixels
+        PV_bool_seg = [True if seg_mask.sum() >= 1 else False for seg_mask in seg_masks]
+        PV_masks = list(compress(seg_masks, PV_bool_seg))
+        PV_image_coords = list(compress(coords, PV_bool_seg))
+        PV_tiles = list(compress(tiles, PV_bool_seg))
 
-        return seg_model
+        if len(PV_masks) == 0:
 
-    def __splitTile(self, tile, minx, miny, maxx, maxy):
+            return
 
-        minx = float(minx)
-        miny = float(miny)
-        maxx = float(maxx)
-        maxy = float(maxy)
+        # Masks are polygonized per tile once all of its images have been processed
+        if self.stitch_masks:
 
-        # Takes a 4800x4800 image tile and returns a list of 320x320 pixel images, if they are within
-        # the county polygon
+            for idx, mask in enumerate(PV_masks):
 
-        tile = np.array(tile)
+                self.pending_tiles[PV_tiles[idx]]['masks'].append((PV_image_coords[idx], mask.astype(bool)))
+
+            return
+
+        # Iterate over all PV masks and buffer the polygon for each detected PV system
+        for idx, mask in enumerate(PV_masks):
+
+            # Only the PV system polygons, i.e. no background polygons, are created
+            polygons = self.polygonCreator.mask2polygons(PV_image_coords[idx], mask)
+
+            score = self.pending_tiles[PV_tiles[idx]]['scores'][PV_image_coords[idx]]
+
+            self.detection_writer.add(tile_id_from_filename(PV_tiles[idx]), [PV_image_coords[idx]] * len(polygons),
+                                      polygons, [score] * len(polygons))
+
+    def __processQueue(self, flush=False):
+
+        # Takes full batches from the queue, i.e. images of several tiles are classified together
+        batch = self.cls_queue.next_batch(flush)
+
+        while batch is not None:
+
+            tiles, coords, images = batch
+
+            try:
+
+                done_tiles = self.__classifyBatch(tiles, coords, images)
+
+            # A failed batch marks all tiles with images in it as not processed
+            except:
+
+                self.__failImages(tiles, sys.exc_info()[0])
+
+                done_tiles = tiles
+
+            for tile in tiles:
+
+                self.pending_tiles[tile]['unclassified'] -= 1
+
+            # Once all images of a tile have been classified, its positives are segmented without waiting for a full batch
+            tile_classified = any(self.pending_tiles[tile]['unclassified'] == 0 for tile in set(tiles))
+
+            self.__completeImages(done_tiles)
+
+            self.__segmentQueue(flush or tile_classified)
+
+            batch = self.cls_queue.next_batch(flush)
+
+    def __segmentQueue(self, flush=False):
+
+        # Positives of several classification batches are segmented together in batches of seg_batch_size images
+        batch = self.seg_queue.next_batch(flush)
+
+        while batch is not None:
+
+            tiles, coords, batch4seg = batch
+
+            try:
+
+                self.__segmentBatch(tiles, coords, batch4seg)
+
+            except:
+
+                self.__failImages(tiles, sys.exc_info()[0])
+
+            self.__completeImages(tiles)
+
+            batch = self.seg_queue.next_batch(flush)
+
+    def __calibrate(self, samples):
+
+        # Takes samples from the dataloader until calibration_images images have been collected. The samples are
+        # returned to be processed afterwards
+        calibration_samples = []
 
         images = []
-        coords = []
 
-        N = 0
-        S = 4800
-        W = 0
-        E = 4800
+        n_images = 0
+
+        for sample in samples:
+
+            # Waiting for more images could stall a stream whose tile buffer is full
+            if is_idle(sample):
+
+                break
+
+            calibration_samples.append(sample)
+
+            if sample['error'] is None and len(sample['images']) > 0:
+
+                images.append(sample['images'][:self.calibration_images - n_images])
+
+                n_images += len(images[-1])
 
-        # The first image is taken from the upper left corner, we then slide from left
-        # to right and from top to bottom. Each image shall cover an area of 16x16m
-        # and shall be identified by the coordinates of its upper left corner.
-        y_coord = maxy
+            if n_images >= self.calibration_images:
 
-        while N < S:
+                break
 
-            W = 0
+        if n_images > 0:
 
-            x_coord = minx
+            calibration_batches = [self.batch_transform(batch) for batch in torch.cat(images).split(self.batch_size)]
 
-            while W < E:
+            self.quantizer.quantize(self.cls_engine, self.seg_engine, calibration_batches)
 
-                images.append(tile[N:N + 320, W:W + 320])
-                coords.append((x_coord, y_coord))
+        return calibration_samples
 
-                x_coord += (((self.side * 360) / (2 * np.pi * self.radius * np.cos(np.deg2rad(y_coord)))))
+    def __polygonizeTile(self, currentTile, masks, scores):
 
-                W = W + 320
+        minx, miny, maxx, maxy = self.tile_coords.bbox(tile_id_from_filename(currentTile))
 
-            N = N + 320
+        x, y = patch_corners(float(minx), float(maxy), self.side, self.radius)
 
-            y_coord = y_coord - self.dlat
+        rows, cols = patch_indices(x, y, [coords for coords, mask in masks])
 
-        # A boolean vector of length 225 indicating whether an image's upper left coordinate is within the county polygon
-        coords_boolean = [self.polygon.intersects(Point(elem)) for elem in coords]
+        # The masks are put together in a mosaic which only spans the block of images with PV systems instead of
+        # the whole 4800x4800 pixel tile
+        row_start, col_start = rows.min(), cols.min()
 
-        # A list containing all images from the current tile that lie within NRW
-        images_in_polygon = list(compress(images, coords_boolean))
-        coords_in_polygon = list(compress(coords, coords_boolean))
+        mosaic = np.zeros(((rows.max() - row_start + 1) * self.size, (cols.max() - col_start + 1) * self.size), dtype=np.uint8)
 
-        return coords_in_polygon, images_in_polygon
+        for row, col, (coords, mask) in zip(rows, cols, masks):
 
-    def __processTiles(self, currentTile, trans_cls, trans_seg):
+            mosaic[(row - row_start) * self.size:(row - row_start + 1) * self.size,
+                   (col - col_start) * self.size:(col - col_start + 1) * self.size] = mask
 
-        # Load image tile
-        tile = Image.open(Path(self.tile_dir + "/" + currentTile))
+        # Polygonize the mosaic once, PV systems which cross image borders are not split into several polygons
+        rings = self.polygonCreator.mask2rings(mosaic, row_start * self.size, col_start * self.size)
 
-        if not tile.mode == 'RGB':
-            tile = tile.convert('RGB')
+        polygons = self.polygonCreator.rings2polygons((float(minx), float(maxy)), rings)
 
-        print("New tile with dimension:", tile.size)
-        currentTile = currentTile[:-13]
-        minx, miny, maxx, maxy = currentTile.split(',')
-        coords, images = self.__splitTile(tile, minx, miny, maxx, maxy)
-        length = len(images)
-        if length == 0:
-            pass
+        image_scores = {(row, col): scores[coords] for row, col, (coords, mask) in zip(rows, cols, masks)}
+
+        ul_coords = []
+
+        polygon_scores = []
+
+        for ring in rings:
+
+            # A polygon is assigned to the image of its upper left pixel, i.e. the leftmost pixel of its top row.
+            # Ring coordinates are (column, -row)
+            top = ring[:, 1].max()
+
+            row = int(-top) // self.size
+            col = int(ring[ring[:, 1] == top, 0].min()) // self.size
+
+            ul_coords.append((x[row, col], y[row]))
+
+            polygon_scores.append(image_scores[(row, col)])
+
+        self.detection_writer.add(tile_id_from_filename(currentTile), ul_coords, polygons, polygon_scores)
+
+    def __failImages(self, tiles, error):
+
+        for tile in set(tiles):
+
+            self.pending_tiles[tile]['error'] = error
+
+    def __completeImages(self, tiles):
+
+        for tile in tiles:
+
+            self.pending_tiles[tile]['remaining'] -= 1
+
+        # A tile is done once all of its images have been processed
+        for tile in set(tiles):
+
+            if self.pending_tiles[tile]['remaining'] == 0:
+
+                state = self.pending_tiles.pop(tile)
+
+                error = state['error']
+
+                # A tile whose masks cannot be polygonized is not processed, but the run goes on with the other tiles
+                if error is None and len(state['masks']) > 0:
+
+                    try:
+
+                        self.__polygonizeTile(tile, state['masks'], state['scores'])
+
+                    except:
+
+                        error = sys.exc_info()[0]
+
+                self.__finishTile(tile, state['in_memory'], error)
+
+    def __logProcessedTiles(self):
+
+        if len(self.unlogged_tiles) == 0:
+
+            return
+
+        self.run_state.set_state([tile_id_from_filename(tile) for tile in self.unlogged_tiles], 'done')
+
+        self.unlogged_tiles = []
+
+    def __finishTile(self, currentTile, in_memory, error=None):
+
+        # Tiles handed over in memory do not exist on disk. The tile is deleted before it is saved as processed, so that
+        # a tile which cannot be deleted is saved as not processed instead of stopping the run
+        if not in_memory:
+
+            try:
+
+                self.__deleteTile(currentTile)
+
+            except:
+
+                error = error or sys.exc_info()[0]
+
+        if error is None:
+
+            self.unlogged_tiles.append(currentTile)
+
+            # A tile is only saved as processed once its PV systems are on disk, so that a restart after a crash
+            # processes it again instead of losing its buffered PV systems
+            if len(self.detection_writer) == 0:
+
+                self.__logProcessedTiles()
+
+        # Save the tile which could not be processed
         else:
-            k = int(length / self.batch_size)
 
-            for i in range(k):
+            self.run_state.set_state(tile_id_from_filename(currentTile), 'failed', getattr(error, '__name__', str(error)), stage='processing')
+
+    def __deleteTile(self, currentTile):
 
-                print("batch:", i+1, "of:", k)
+        # Delete iterated tile
+        tile_path = Path(self.tile_dir + "/" + str(currentTile))
 
-                img_batch = images[self.batch_size * i:self.batch_size * (i + 1)]
-                coords4batch = coords[self.batch_size * i:self.batch_size * (i + 1)]
-
-                # Image.fromarray() converts a numpy array into a PIL image
-                # trans_cls() and trans_seg() apply image transformations such as resizing or normalization and convert a PIL image to a tensor
-                # torch.unsqueeze(image tensor, 0) adds a new dimension at the specified position, e.g.
-                # converting our image tensor from [3,299,299] to [1,3,299,299]
-                batch4cls = [torch.unsqueeze(trans_cls(Image.fromarray(image)), 0) for image in img_batch]
-                batch4seg = [torch.unsqueeze(trans_seg(Image.fromarray(image)), 0) for image in img_batch]
-
-                # torch.cat(image tensor, dim=0) concatenates our image tensor along dimension 0, i.e. a list
-                # of tensors of the form [1,3,299,299] is converted into a tensor of form [N,3,299,299]
-                batch4cls = torch.cat(batch4cls, dim=0)
-                batch4seg = torch.cat(batch4seg, dim=0)
-
-                # Classify batch
-                cls_outputs = self.cls_model(batch4cls.to(self.device))
-                cls_prob = F.softmax(cls_outputs, dim=1)
-
-                # detach() detaches the output from the computational graph.
-                # So no gradient will be backproped along this variable.
-                # For example if you’re computing some indices from the output of the
-                # network and then want to use that to index a tensor. The indexing operation
-                # is not differentiable wrt the indices. So you should detach() the indices
-                # before providing them.
-                cls_prob = cls_prob.cpu().detach().numpy()
-
-                # PV_bool is a boolean array in which TRUE values correspond to images in our batch which depict PV systems
-                PV_bool = cls_prob[:, 1] >= self.cls_threshold
-
-                # If our batch contains positively classified images, we pass them to the segmentation model
-                if PV_bool.sum() > 0:
-
-                    # Select all images which depict PV systems and their respective coordinates (upper left image corner)
-                    batch4seg = batch4seg[PV_bool]
-                    coords4seg = list(compress(coords4batch, PV_bool))
-                    # self.seg_model.cuda()
-                    seg_outputs = self.seg_model(batch4seg)
-                    seg_outputs = seg_outputs['out'].squeeze(1)
-                    seg_outputs = seg_outputs.detach().cpu().numpy()
-                    # min-max scaling
-                    seg_outputs = (seg_outputs - np.min(seg_outputs)) / (
-                                np.max(seg_outputs) - np.min(seg_outputs) + 0.000000001)
-                    # setting a threshold to turn CAMs into binary segmentation masks
-                    seg_outputs = seg_outputs >= self.seg_threshold
-                    # Turn class activation maps (CAMs) into binary segmentation masks
-                    seg_masks = [CAM.astype(np.int32) for CAM in seg_outputs]
-                    # Only consider binary segmentation masks with at least one positive pixel
-                    # I.e. ignore instances where an image is positively classified, but the segmentation model does not activate any pixels
-                    PV_bool_seg = [True if seg_mask.sum() >= 1 else False for seg_mask in seg_masks]
-                    PV_masks = list(compress(seg_masks, PV_bool_seg))
-                    PV_image_coords = list(compress(coords4seg, PV_bool_seg))
-
-                    # Iterate over all PV masks and store the polygon for each detected PV system in a .csv file
-                    for idx, mask in enumerate(PV_masks):
-
-                        polygon_gdf = self.polygonCreator.mask2polygon(PV_image_coords[idx], mask)
-
-                        with open(Path(self.pv_db_path), "a") as csvFile:
-
-                            fieldnames = ['Current_Tile_240', 'UL_Image_16', 'PV_polygon']
-                            writer = csv.DictWriter(csvFile, fieldnames=fieldnames, delimiter=';')
-
-                            for index, row in polygon_gdf.iterrows():
-
-                                if row['class'] == 1:
-
-                                    writer.writerow({'Current_Tile_240': currentTile,
-                                                     'UL_Image_16': Point(PV_image_coords[idx]),
-                                                     'PV_polygon': row['geometry']})
-
-            # Repeat process for last batch
-            img_batch = images[self.batch_size * k:]
-            coords4batch = coords[self.batch_size * k:]
-
-            if len(img_batch) > 0:
-
-                batch4cls = [torch.unsqueeze(trans_cls(Image.fromarray(image)), 0) for image in img_batch]
-                batch4seg = [torch.unsqueeze(trans_seg(Image.fromarray(image)), 0) for image in img_batch]
-
-                batch4cls = torch.cat(batch4cls, dim=0)
-                batch4seg = torch.cat(batch4seg, dim=0)
-
-                # Classify batch
-                cls_outputs = self.cls_model(batch4cls.to(self.device))
-
-                cls_prob = F.softmax(cls_outputs, dim=1)
-                cls_prob = cls_prob.cpu().detach().numpy()
-
-                # PV_bool is a boolean array in which TRUE values correspond to images in our batch which depict PV systems
-                PV_bool = cls_prob[:, 1] >= self.cls_threshold
-
-                # If our batch contains positively classified images, we pass them to the segmentation model
-                if PV_bool.sum() > 0:
-
-                    # Select all images which depict PV systems and their respective coordinates (upper left image corner)
-                    batch4seg = batch4seg[PV_bool]
-                    coords4seg = list(compress(coords4batch, PV_bool))
-                    # self.seg_model.cuda()
-                    seg_outputs = self.seg_model(batch4seg)
-                    seg_outputs = seg_outputs['out'].squeeze(1)
-                    seg_outputs = seg_outputs.detach().cpu().numpy()
-                    # min-max scaling
-                    seg_outputs = (seg_outputs - np.min(seg_outputs)) / (
-                                np.max(seg_outputs) - np.min(seg_outputs) + 0.000000001)
-                    # setting a threshold to turn CAMs into binary segmentation masks
-                    seg_outputs = seg_outputs >= self.seg_threshold
-                    # Turn class activation maps (CAMs) into binary segmentation masks
-                    seg_masks = [CAM.astype(np.int32) for CAM in seg_outputs]
-                    # Only consider binary segmentation masks with at least one positive pixel
-                    # I.e. ignore instances where an image is positively classified, but the segmentation model does not activate any pixels
-                    PV_bool_seg = [True if seg_mask.sum() >= 1 else False for seg_mask in seg_masks]
-                    PV_masks = list(compress(seg_masks, PV_bool_seg))
-                    PV_image_coords = list(compress(coords4seg, PV_bool_seg))
-
-                    # Iterate over all PV masks and store the polygon for each detected PV system in a .csv file
-                    for idx, mask in enumerate(PV_masks):
-
-                        polygon_gdf = self.polygonCreator.mask2polygon(PV_image_coords[idx], mask)
-
-                        with open(Path(self.pv_db_path), "a") as csvFile:
-
-                            fieldnames = ['Current_Tile_240', 'UL_Image_16', 'PV_polygon']
-                            writer = csv.DictWriter(csvFile, fieldnames=fieldnames, delimiter=';')
-
-                            for index, row in polygon_gdf.iterrows():
+        tile_size = os.path.getsize(tile_path)
 
-                                if row['class'] == 1:
-                                    writer.writerow({'Current_Tile_240': currentTile,
-                                                     'UL_Image_16': Point(PV_image_coords[idx]),
-                                                     'PV_polygon': row['geometry']})
+        os.remove(tile_path)
+
+        # Wake up downloads which are paused because the tile buffer is full
+        if self.tile_buffer is not None:
+
+            self.tile_buffer.remove(tile_size, currentTile)
 
     def run(self):
         """
         Loads dataset of tiles, splits each tile into 16m x 16m images, and processes the aerial images within the specified county by detecting and segmenting PV panels.
         """
 
-        print('Dataset Size:', len(self.dataset))
+        if isinstance(self.dataset, NrwDataset):
 
-        dataloader = DataLoader(self.dataset, batch_size=1, num_workers=0)
+            print('Dataset Size:', len(self.dataset))
 
-        trans_cls = transforms.Compose([
-            transforms.Resize(self.input_size),
-            transforms.ToTensor(),
-            transforms.Normalize([0.5, 0.5, 0.5], [0.5, 0.5, 0.5])
-        ])
+        else:
 
-        trans_seg = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize([0.5, 0.5, 0.5], [0.5, 0.5, 0.5])
-        ])
+            print('Processing tiles as they are downloaded ...')
 
-        for i, batch in enumerate(dataloader):
+        # batch_size=None hands over each tile as it is, i.e. its file name together with its images and coordinates
+        loader_kwargs = {'batch_size': None, 'collate_fn': unbatched, 'pin_memory': self.device.type == 'cuda'}
 
-            currentTile = batch[0]
+        # The streaming dataset prepares tiles in threads, because its tile_queue cannot be shared with worker processes
+        if isinstance(self.dataset, NrwDataset) and self.decode_workers > 0:
 
-            # Try to process and record it
-            try:
+            loader_kwargs['num_workers'] = self.decode_workers
 
-                self.__processTiles(currentTile, trans_cls, trans_seg)
-    
-                with open(Path(self.processed_path), "a") as csvFile:
-    
-                    writer = csv.writer(csvFile, lineterminator="\n")
-    
-                    writer.writerow([currentTile])
+            loader_kwargs['prefetch_factor'] = self.prefetch_tiles
 
-            # Only tiles that weren't fully processed are saved subsequently
-            except:
+        dataloader = DataLoader(self.dataset, **loader_kwargs)
+
+        # Images of consecutive tiles are queued and classified in full batches of batch_size images, positively
+        # classified images are queued again and segmented in batches of seg_batch_size images
+        self.cls_queue = PatchBatcher(self.batch_size)
+
+        self.seg_queue = PatchBatcher(self.seg_batch_size)
+
+        self.pending_tiles = {}
+
+        samples = iter(dataloader)
+
+        if self.quantization != 'none':
+
+            samples = chain(self.__calibrate(samples), samples)
+
+        for sample in samples:
+
+            # No tile is ready, hence the images held back for full batches are processed now. Otherwise, their tiles
+            # are never deleted and the downloader might wait for space in the tile buffer forever
+            if is_idle(sample):
+
+                self.__processQueue(flush=True)
+
+                self.__segmentQueue(flush=True)
+
+                continue
+
+            currentTile = sample['tile']
+
+            # The tile is in memory from now on, hence it no longer counts towards the tile buffer
+            if self.tile_buffer is not None and not sample['in_memory'] and sample['error'] is None:
+
+                self.tile_buffer.release(currentTile, os.path.getsize(Path(self.tile_dir + "/" + str(currentTile))))
+
+            self.run_state.set_state(tile_id_from_filename(currentTile), 'processing')
+
+            # Decoding or splitting the tile already failed in the dataset
+            if sample['error'] is not None:
+
+                self.__finishTile(currentTile, sample['in_memory'], type(sample['error']))
+
+                continue
+
+            # coords and images have been prepared by the dataset, see src.utils.tile_splitter.TileSplitter
+            print("New tile with images within the county:", len(sample['images']))
+
+            # Uniform, vegetated and no-data images are not classified
+            if self.prefilter is not None and not self.prefilter.calibration and len(sample['images']) > 0:
+
+                plausible = self.prefilter(sample['images'])
+
+                sample['coords'] = list(compress(sample['coords'], plausible))
+
+                sample['images'] = sample['images'][torch.from_numpy(plausible)]
+
+            if len(sample['images']) == 0:
+
+                self.__finishTile(currentTile, sample['in_memory'])
+
+                continue
+
+            self.pending_tiles[currentTile] = {
+                'unclassified': len(sample['images']), 'remaining': len(sample['images']),
+                'in_memory': sample['in_memory'], 'error': None, 'masks': [], 'scores': {}
+            }
+
+            self.cls_queue.add(currentTile, sample['coords'], sample['images'])
+
+            self.__processQueue()
+
+        # Process the remaining images of the last tiles
+        self.__processQueue(flush=True)
+
+        self.__segmentQueue(flush=True)
+
+        self.detection_writer.close()
+
+        self.__logProcessedTiles()
+
+        print(f"{self.detection_writer.n_written} PV polygons written to {self.pv_db_path} in {self.detection_writer.n_chunks} chunks")
+
+        print(self.cls_engine.report())
 
-                e = sys.exc_info()[0]
+        print(self.seg_engine.report())
 
-                # Save the tile which could not be processed and continue
-                with open(Path(self.not_processed_path), "a") as csvFile:
+        if self.prefilter is not None:
 
-                    writer = csv.writer(csvFile, lineterminator="\n")
+            print(self.prefilter.report())
 
-                    writer.writerow([currentTile, e])
-                    
-            # Delete iterated tile
-            os.remove(Path(self.tile_dir + "/" + str(currentTile)))
+        if self.polygonCreator.simplification != 'none':
 
+            print(self.polygonCreator.simplification_report())
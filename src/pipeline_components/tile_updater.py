@@ -1,7 +1,6 @@
-import pickle
 from pathlib import Path
-import pandas as pd
 import os
+from src.utils.run_state import RunStateStore
 
 class TileCoordsUpdater(object):
     """
@@ -9,70 +8,63 @@ class TileCoordsUpdater(object):
 
     Attributes
     ----------
-    old_tile_coords : list
-        List of tuples with all the tiles within the selected county.
+    old_tile_coords : src.utils.tile_index.TileIndex
+        Index of all the tiles within the selected county.
     county : str
         The name of the county for which you run the analysis.
     tile_coords_path : Path
-        Path to the pickle file which stores the list of tuples for all tiles within a given county.
-    processed_path : Path
-        Path to the .csv file which stores all the already processed tiles within a given county.
+        Path to the .npy file which stores the index of all tiles within a given county.
+    run_state : src.utils.run_state.RunStateStore
+        Store which records all the already processed tiles within a given county.
     """
 
-    def __init__(self, configuration=None, tile_coords=None):
+    def __init__(self, configuration=None, tile_coords=None, run_state=None):
         """
         Parameters
         ----------
         configuration : dict
             The configuration based on config.yml in dict format.
-        tile_coords : list
-            List of tuples, where each tuple specifies the to be downloaed tiles by their minx, miny, maxx, maxy coordinates.
+        tile_coords : src.utils.tile_index.TileIndex
+            Index of the to be downloaded tiles by their tile ID and minx, miny, maxx, maxy coordinates.
+        run_state : src.utils.run_state.RunStateStore
+            Store shared with the other pipeline steps. If None, the store of the county is opened.
         """
 
         self.old_tile_coords = tile_coords
 
         self.county = configuration['county4analysis']
 
-        self.tile_coords_path = Path(f"data/coords/{self.county}.pickle")
+        self.tile_coords_path = Path(f"data/coords/{self.county}.npy")
 
-        self.processed_path = Path(f"logs/processing/{self.county}_processedTiles.csv")
+        self.run_state = run_state if run_state is not None else RunStateStore.from_configuration(configuration)
 
     def update(self):
         """
         Removes all the already processed tiles within a given county from the list of tiles which ought to be processed.
         """
 
-        if os.path.exists(self.processed_path):
+        processedTiles_list = self.run_state.tiles('done')
 
-            # Load Processed.csv file
-            processedTiles_df = pd.read_table(self.processed_path, header=None)
+        if len(processedTiles_list) > 0:
 
-            processedTiles_df = processedTiles_df.drop_duplicates()
-
-            processedTiles_list = []
-
-            for index, tile in processedTiles_df.iterrows():
-
-                minx, miny, maxx, maxy = tile[0].replace(",COMPLETE.png", "").split(',')
-
-                processedTiles_list.append((float(minx), float(miny), float(maxx), float(maxy)))
-
-            new_Tile_coords = [item for item in self.old_tile_coords if item not in processedTiles_list]
+            new_Tile_coords = self.old_tile_coords.drop(processedTiles_list)
 
             print(
                 f"Old list of tiles contained {len(self.old_tile_coords)} elements. New list contains {len(new_Tile_coords)}")
 
             print(
-                f"Successfully updated {self.county}.pickle by removing {len(self.old_tile_coords) - len(new_Tile_coords)} tiles.")
+                f"Successfully updated {self.county}.npy by removing {len(self.old_tile_coords) - len(new_Tile_coords)} tiles.")
+
+            # Save the new tile index. The index is loaded as a memory-map, hence it is written to a new file first
+            tmp_path = self.tile_coords_path.with_suffix('.tmp.npy')
 
-            # Save the new Tile_coords.pickle file
-            with open(Path(self.tile_coords_path), 'wb') as f:
+            new_Tile_coords.save(tmp_path)
 
-                pickle.dump(new_Tile_coords, f)
+            os.replace(tmp_path, self.tile_coords_path)
 
         else:
 
-            print("ProcessedTiles.csv does not exist. Cannot update TileCoords.pickle by removing already processed tiles ...")
+            print("No tiles have been processed yet. Cannot update the tile index by removing already processed tiles ...")
 
 
 
@@ -0,0 +1,61 @@
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+
+class BatchTransform(object):
+    """
+    Turns a batch of 320x320 pixel images into the input tensors of the classification and the segmentation model in
+    one go. Replaces transforms.Resize, transforms.ToTensor and transforms.Normalize which work on one PIL image at a
+    time: the whole batch is converted from uint8 to float and normalized once, and the segmentation input is resized
+    to the classification input with a single batched interpolation.
+
+    Attributes
+    ----------
+    input_size : int
+        Side length in pixels of the images processed by the classification network.
+    mean : torch.Tensor
+        Per channel mean subtracted during normalization.
+    std : torch.Tensor
+        Per channel standard deviation divided by during normalization.
+    """
+
+    def __init__(self, input_size, mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5)):
+
+        self.input_size = input_size
+
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(1, 3, 1, 1)
+
+        self.std = torch.tensor(std, dtype=torch.float32).view(1, 3, 1, 1)
+
+    def __call__(self, images):
+        """
+        Parameters
+        ----------
+        images : numpy.ndarray or torch.Tensor
+            uint8 images of shape (N, 320, 320, 3).
+
+        Returns
+        -------
+        tuple
+            torch.Tensor of shape (N, 3, input_size, input_size) for the classification model and torch.Tensor of shape
+            (N, 3, 320, 320) for the segmentation model.
+        """
+
+        if isinstance(images, np.ndarray):
+
+            images = torch.from_numpy(np.ascontiguousarray(images))
+
+        # (N, H, W, C) -> (N, C, H, W) is only a view, the conversion to float copies every image exactly once.
+        # Same operations as ToTensor() and Normalize(), hence batch4seg is identical to the former per image transform
+        batch4seg = images.permute(0, 3, 1, 2).to(torch.float32, memory_format=torch.contiguous_format).div_(255)
+
+        batch4seg.sub_(self.mean).div_(self.std)
+
+        # Resizing is linear, hence resizing the normalized batch equals normalizing the resized batch. antialias=True
+        # matches the filter of PIL's bilinear resize when downscaling
+        batch4cls = F.interpolate(
+            batch4seg, size=(self.input_size, self.input_size), mode='bilinear', align_corners=False, antialias=True
+        )
+
+        return batch4cls, batch4seg
@@ -0,0 +1,146 @@
+import os
+from pathlib import Path
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import box
+from shapely.strtree import STRtree
+
+try:
+
+    # Shapely >= 2.0 creates boxes and queries the tree for whole arrays of geometries at once
+    from shapely import box as _boxes
+
+except ImportError:
+
+    _boxes = None
+
+
+class BuildingIndex(object):
+    """
+    Spatial index over the building footprints of a county, i.e. the rooftop polygons which RegistryCreator later
+    matches the detected PV systems with. It is used to skip tiles and images without any building early on, because
+    only PV systems on or overhanging a rooftop end up in the registry.
+
+    Attributes
+    ----------
+    footprints : numpy.ndarray
+        Geo-referenced building footprints.
+    tree : shapely.strtree.STRtree
+        Sort-Tile-Recursive tree over the footprints.
+    buffer : float
+        Distance in meters by which a queried box is enlarged, so that PV systems which overhang a rooftop are kept.
+    radius : int
+        Earth radius in meters.
+    """
+
+    def __init__(self, footprints, buffer=0.0, radius=6371000):
+        """
+        Parameters
+        ----------
+        footprints : list
+            Geo-referenced building footprints as shapely geometries.
+        buffer : float
+            Distance in meters by which a queried box is enlarged.
+        radius : int
+            Earth radius in meters.
+        """
+
+        self.footprints = np.array([geometry for geometry in footprints if geometry is not None], dtype=object)
+
+        self.tree = STRtree(list(self.footprints))
+
+        self.buffer = buffer
+
+        self.radius = radius
+
+    @classmethod
+    def from_configuration(cls, configuration):
+        """
+        Loads the rooftop polygons of the selected county from rooftop_data_dir.
+
+        Parameters
+        ----------
+        configuration : dict
+            config.yml in dict format.
+
+        Returns
+        -------
+        BuildingIndex
+            None if filter_by_buildings is 0 or the county has no rooftop data.
+        """
+
+        if not configuration.get('filter_by_buildings', 1):
+
+            return None
+
+        path = Path(f"{configuration.get('rooftop_data_dir', 'data/nrw_rooftop_data/')}/{configuration.get('county4analysis')}.geojson")
+
+        if not os.path.exists(path):
+
+            print(f"No rooftop data found at {path}, tiles and images are not filtered by buildings.")
+
+            return None
+
+        rooftop_gdf = gpd.read_file(path)
+
+        return cls(rooftop_gdf.geometry.values, buffer=configuration.get('building_buffer_m', 2))
+
+    def __len__(self):
+
+        return len(self.footprints)
+
+    def intersects(self, minx, miny, maxx, maxy):
+        """
+        Checks which boxes intersect at least one building footprint after enlarging them by the buffer.
+
+        Parameters
+        ----------
+        minx : numpy.ndarray
+            Western boundaries of the boxes.
+        miny : numpy.ndarray
+            Southern boundaries of the boxes.
+        maxx : numpy.ndarray
+            Eastern boundaries of the boxes.
+        maxy : numpy.ndarray
+            Northern boundaries of the boxes.
+
+        Returns
+        -------
+        numpy.ndarray
+            Boolean array which is True for every box close to a building.
+        """
+
+        minx = np.asarray(minx, dtype=np.float64)
+        miny = np.asarray(miny, dtype=np.float64)
+        maxx = np.asarray(maxx, dtype=np.float64)
+        maxy = np.asarray(maxy, dtype=np.float64)
+
+        if minx.size == 0 or len(self.footprints) == 0:
+
+            return np.zeros(minx.shape, dtype=bool)
+
+        # The buffer in degrees, where a degree of longitude shrinks with the cosine of the latitude
+        dlat = (self.buffer * 360) / (2 * np.pi * self.radius)
+        dlon = dlat / np.cos(np.deg2rad(maxy))
+
+        minx, miny, maxx, maxy = minx - dlon, miny - dlat, maxx + dlon, maxy + dlat
+
+        if _boxes is not None:
+
+            box_idx, _ = self.tree.query(_boxes(minx, miny, maxx, maxy), predicate='intersects')
+
+            near_building = np.zeros(minx.shape, dtype=bool)
+            near_building[box_idx] = True
+
+            return near_building
+
+        # Shapely 1.x only returns the candidates whose envelope intersects the box
+        near_building = []
+
+        for bounds in zip(minx, miny, maxx, maxy):
+
+            query_box = box(*bounds)
+
+            near_building.append(any(query_box.intersects(candidate) for candidate in self.tree.query(query_box)))
+
+        return np.array(near_building, dtype=bool)
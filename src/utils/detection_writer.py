@@ -0,0 +1,243 @@
+import csv
+from pathlib import Path
+import pandas as pd
+from shapely.geometry import Point
+from src.utils.geo_utils import from_wkb, to_wkb
+
+'''
+Buffers the PV polygons detected by the TileProcessor and writes them to disk in chunks
+'''
+
+DETECTION_FORMATS = ('arrow', 'csv')
+
+# Columns of the legacy .csv file, which has no header
+CSV_FIELDNAMES = ['Current_Tile_240', 'UL_Image_16', 'PV_polygon']
+
+
+def detections_path(county, detection_format):
+    """
+    Parameters
+    ----------
+    county : str
+        Name of the county.
+    detection_format : str
+        'arrow' or 'csv'.
+
+    Returns
+    -------
+    Path
+        Directory of the Arrow files or path of the .csv file with the detections of a county.
+    """
+
+    if detection_format == 'arrow':
+
+        return Path(f"data/pv_database/{county}_PV_db")
+
+    return Path(f"data/pv_database/{county}_PV_db.csv")
+
+
+class DetectionWriter(object):
+    """
+    Collects detected PV polygons in column buffers and writes them once buffer_size polygons have been collected.
+
+    - arrow writes each chunk as a record batch of an Arrow IPC stream with the tile ID, the upper left coordinate of
+      the image, the polygon as well-known binary, and the classification score of the image. Every run appends a new
+      part file to the county's directory, since a stream cannot be continued once closed. Each record batch is
+      complete on disk once written, so a part which is cut off by a crash can still be read up to its last chunk.
+    - csv appends the rows of a chunk to the legacy .csv file with the polygons as well-known text, i.e. without the
+      classification score.
+
+    Attributes
+    ----------
+    path : Path
+        Directory of the Arrow files or path of the .csv file.
+    detection_format : str
+        'arrow' or 'csv'.
+    buffer_size : int
+        Number of polygons after which the buffer is written.
+    n_written : int
+        Number of polygons written so far.
+    n_chunks : int
+        Number of chunks written so far.
+    """
+
+    def __init__(self, path, detection_format='arrow', buffer_size=1000):
+
+        if detection_format not in DETECTION_FORMATS:
+
+            raise ValueError(f"Unknown detection format {detection_format}, expected one of {DETECTION_FORMATS}")
+
+        self.path = Path(path)
+
+        self.detection_format = detection_format
+
+        self.buffer_size = buffer_size
+
+        self.n_written = 0
+
+        self.n_chunks = 0
+
+        self._writer = None
+
+        self._sink = None
+
+        self._reset()
+
+    def _reset(self):
+
+        self._buffer = {'tile_id': [], 'ul_x': [], 'ul_y': [], 'polygon': [], 'score': []}
+
+    def __len__(self):
+
+        return len(self._buffer['polygon'])
+
+    def add(self, tile_id, ul_coords, polygons, scores):
+        """
+        Buffers the polygons of a tile and writes the buffer once it is full.
+
+        Parameters
+        ----------
+        tile_id : int
+            Integer ID of the tile.
+        ul_coords : list
+            Upper left (x, y) coordinate of the image of each polygon.
+        polygons : list
+            Geo-referenced shapely.geometry.Polygon of each PV system.
+        scores : list
+            Classification score of the image of each polygon.
+        """
+
+        self._buffer['tile_id'].extend([tile_id] * len(polygons))
+        self._buffer['ul_x'].extend(float(x) for x, y in ul_coords)
+        self._buffer['ul_y'].extend(float(y) for x, y in ul_coords)
+        self._buffer['polygon'].extend(polygons)
+        self._buffer['score'].extend(float(score) for score in scores)
+
+        if len(self) >= self.buffer_size:
+
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all buffered polygons.
+        """
+
+        if len(self) == 0:
+
+            return
+
+        if self.detection_format == 'arrow':
+
+            self._write_arrow()
+
+        else:
+
+            self._write_csv()
+
+        self.n_written += len(self)
+
+        self.n_chunks += 1
+
+        self._reset()
+
+    def _write_arrow(self):
+
+        # Only needed for the arrow format
+        import pyarrow as pa
+
+        batch = pa.RecordBatch.from_arrays([
+            pa.array(self._buffer['tile_id'], type=pa.int64()),
+            pa.array(self._buffer['ul_x'], type=pa.float64()),
+            pa.array(self._buffer['ul_y'], type=pa.float64()),
+            pa.array(to_wkb(self._buffer['polygon']), type=pa.binary()),
+            pa.array(self._buffer['score'], type=pa.float32()),
+        ], names=['Current_Tile_240', 'UL_Image_x', 'UL_Image_y', 'geometry', 'score'])
+
+        # The part file is only created once there is something to write
+        if self._writer is None:
+
+            self.path.mkdir(parents=True, exist_ok=True)
+
+            # Numbered after the last existing part, since parts may have been deleted in between
+            indices = [int(part.stem.split('-')[1]) for part in self.path.glob('part-*.arrow')
+                       if part.stem.split('-')[1].isdigit()]
+
+            part_path = self.path / f"part-{max(indices, default=-1) + 1:05d}.arrow"
+
+            self._sink = open(part_path, 'wb')
+
+            self._writer = pa.ipc.new_stream(self._sink, batch.schema)
+
+        self._writer.write_batch(batch)
+
+        self._sink.flush()
+
+    def _write_csv(self):
+
+        with open(self.path, "a") as csvFile:
+
+            writer = csv.DictWriter(csvFile, fieldnames=CSV_FIELDNAMES, delimiter=';')
+
+            writer.writerows({'Current_Tile_240': tile_id, 'UL_Image_16': Point(x, y), 'PV_polygon': polygon}
+                             for tile_id, x, y, polygon in zip(self._buffer['tile_id'], self._buffer['ul_x'],
+                                                               self._buffer['ul_y'], self._buffer['polygon']))
+
+    def close(self):
+        """
+        Writes all buffered polygons and closes the current part file.
+        """
+
+        self.flush()
+
+        if self._writer is not None:
+
+            self._writer.close()
+
+            self._sink.close()
+
+            self._writer = self._sink = None
+
+
+def read_detections(path):
+    """
+    Reads all part files of a county's detections written in the arrow format.
+
+    Parameters
+    ----------
+    path : Path
+        Directory of the Arrow files.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Tile ID, upper left image coordinate, shapely polygon and classification score of each detection.
+    """
+
+    import pyarrow as pa
+
+    batches = []
+
+    for part_path in sorted(Path(path).glob('part-*.arrow')):
+
+        with pa.OSFile(str(part_path)) as source:
+
+            # A part which was cut off by a crash is read up to its last complete record batch
+            try:
+
+                for batch in pa.ipc.open_stream(source):
+
+                    batches.append(batch)
+
+            except (pa.ArrowInvalid, OSError):
+
+                print(f"{part_path} is incomplete, reading its complete chunks only.")
+
+    if len(batches) == 0:
+
+        return pd.DataFrame(columns=['Current_Tile_240', 'UL_Image_x', 'UL_Image_y', 'geometry', 'score'])
+
+    detections = pa.Table.from_batches(batches).to_pandas()
+
+    detections['geometry'] = from_wkb(detections['geometry'].to_numpy())
+
+    return detections
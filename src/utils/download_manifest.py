@@ -0,0 +1,234 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from PIL import Image
+from src.utils.tile_index import tile_filename
+
+
+def sha256_file(path, chunk_size=1024 * 1024):
+    """
+    SHA-256 checksum of a file.
+
+    Parameters
+    ----------
+    path : Path
+        Path to the file.
+    chunk_size : int
+        Number of bytes which are read at once.
+
+    Returns
+    -------
+    hashlib._Hash
+        Hash object, so that further bytes can be added when a partial download is resumed.
+    """
+
+    checksum = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+
+            checksum.update(chunk)
+
+    return checksum
+
+
+def decodes(path):
+    """
+    Checks whether a downloaded tile is a valid image, i.e. it is neither truncated nor corrupt.
+
+    Parameters
+    ----------
+    path : Path or file-like object
+        Path to the tile or the tile's bytes.
+
+    Returns
+    -------
+    bool
+        True if the image could be verified.
+    """
+
+    try:
+
+        with Image.open(path) as image:
+
+            # verify() checks the structure and the chunk checksums of the file without decoding all pixels
+            image.verify()
+
+        return True
+
+    except Exception:
+
+        return False
+
+
+class DownloadManifest(object):
+    """
+    Append-only record of all completely downloaded tiles with their file size, SHA-256 checksum and the result of a
+    decode check. It allows the downloader to skip complete tiles when a run is restarted and to re-fetch only
+    tiles which are missing or corrupt.
+
+    Attributes
+    ----------
+    path : Path
+        Path to the manifest, a file with one JSON record per line.
+    tile_dir : Path
+        Path to directory where all the downloaded tiles are saved.
+    entries : dict
+        Latest record for each tile ID.
+    """
+
+    def __init__(self, path, tile_dir):
+        """
+        Parameters
+        ----------
+        path : Path
+            Path to the manifest.
+        tile_dir : Path
+            Path to directory where all the downloaded tiles are saved.
+        """
+
+        self.path = Path(path)
+
+        self.tile_dir = Path(tile_dir)
+
+        self.entries = {}
+
+        if self.path.exists():
+
+            with open(self.path) as f:
+
+                for line in f:
+
+                    # A crash while writing can leave an incomplete last line behind, which is ignored
+                    try:
+
+                        entry = json.loads(line)
+
+                    except ValueError:
+
+                        continue
+
+                    self.entries[entry['tile_id']] = entry
+
+    def __len__(self):
+
+        return len(self.entries)
+
+    def add(self, tile_id, size, sha256, decoded):
+        """
+        Records a completely downloaded tile.
+
+        Parameters
+        ----------
+        tile_id : int
+            Integer ID of the tile.
+        size : int
+            File size in bytes.
+        sha256 : str
+            Hex digest of the file's SHA-256 checksum.
+        decoded : bool
+            Result of the decode check.
+        """
+
+        entry = {'tile_id': int(tile_id), 'size': int(size), 'sha256': sha256, 'decoded': bool(decoded)}
+
+        with open(self.path, 'a') as f:
+
+            f.write(json.dumps(entry) + '\n')
+
+            f.flush()
+
+            os.fsync(f.fileno())
+
+        self.entries[entry['tile_id']] = entry
+
+    def record(self, tile_id, path):
+        """
+        Computes size, checksum and decode check of a tile on disk and records it.
+
+        Parameters
+        ----------
+        tile_id : int
+            Integer ID of the tile.
+        path : Path
+            Path to the tile.
+
+        Returns
+        -------
+        bool
+            Result of the decode check.
+        """
+
+        decoded = decodes(path)
+
+        self.add(tile_id, os.path.getsize(path), sha256_file(path).hexdigest(), decoded)
+
+        return decoded
+
+    def discard(self, tile_id):
+        """
+        Forgets a tile, e.g. because its file has been lost. The record in the manifest file is superseded once the tile
+        has been downloaded again, until then the tile is discarded again on every restart.
+
+        Parameters
+        ----------
+        tile_id : int
+            Integer ID of the tile.
+        """
+
+        self.entries.pop(int(tile_id), None)
+
+    def is_complete(self, tile_id, existing_files, verify_checksum=False, processed=()):
+        """
+        Checks whether a tile has been completely downloaded.
+
+        Parameters
+        ----------
+        tile_id : int
+            Integer ID of the tile.
+        existing_files : set
+            Names of all files in tile_dir.
+        verify_checksum : bool
+            Recompute the SHA-256 checksum of tiles on disk instead of only comparing their size.
+        processed : set
+            Integer IDs of all tiles which have been processed successfully.
+
+        Returns
+        -------
+        bool
+            True if the tile does not need to be downloaded again.
+        """
+
+        entry = self.entries.get(int(tile_id))
+
+        if entry is None or not entry['decoded']:
+
+            return False
+
+        filename = tile_filename(tile_id)
+
+        if filename not in existing_files:
+
+            # The tile has been downloaded, processed and deleted by the TileProcessor afterwards
+            if int(tile_id) in processed:
+
+                return True
+
+            # Otherwise, the tile has been lost, e.g. it was deleted after its processing failed or tile_dir was wiped
+            self.discard(tile_id)
+
+            return False
+
+        path = self.tile_dir / filename
+
+        if os.path.getsize(path) != entry['size']:
+
+            return False
+
+        if verify_checksum:
+
+            return sha256_file(path).hexdigest() == entry['sha256']
+
+        return True
@@ -0,0 +1,253 @@
+import numpy as np
+from shapely import wkb
+
+try:
+
+    # Shapely >= 2.0 ships a vectorized point-in-polygon predicate and can prepare geometries in place
+    from shapely import intersects_xy as _intersects_xy
+    from shapely import prepare as _prepare
+    from shapely import linearrings as _linearrings
+    from shapely import polygons as _polygons
+    import shapely as _shapely
+
+except ImportError:
+
+    from shapely.geometry import Polygon
+
+    _linearrings = None
+
+    _shapely = None
+
+    from shapely.vectorized import contains, touches
+
+    # shapely.vectorized prepares the geometry on every call
+    def _prepare(geometry):
+
+        pass
+
+    def _intersects_xy(geometry, x, y):
+
+        # intersects() for a point is equivalent to contains() or touches() on the polygon boundary
+        return contains(geometry, x, y) | touches(geometry, x, y)
+
+
+def intersects_xy(geometry, x, y):
+    """
+    Vectorized version of geometry.intersects(Point(x, y)) for arrays of x and y coordinates.
+
+    Parameters
+    ----------
+    geometry : shapely.geometry.base.BaseGeometry
+        Geo-referenced geometry, e.g. the polygon of the selected county.
+    x : numpy.ndarray
+        Longitude values of the points to be tested.
+    y : numpy.ndarray
+        Latitude values of the points to be tested.
+
+    Returns
+    -------
+    numpy.ndarray
+        Boolean array with the same shape as x and y which is True for every point that intersects the geometry.
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    if x.size == 0:
+
+        return np.zeros(x.shape, dtype=bool)
+
+    return np.asarray(_intersects_xy(geometry, x, y), dtype=bool)
+
+
+def prepare(geometry):
+    """
+    Prepares a geometry in place, which speeds up repeated calls of intersects_xy() on it.
+
+    Parameters
+    ----------
+    geometry : shapely.geometry.base.BaseGeometry
+        Geo-referenced geometry, e.g. the polygon of the selected county.
+    """
+
+    if geometry is not None:
+
+        _prepare(geometry)
+
+
+def polygons_from_rings(coords, ring_sizes):
+    """
+    Creates polygons without holes from the vertices of their exterior rings in one go.
+
+    Parameters
+    ----------
+    coords : numpy.ndarray
+        Vertices of all rings one after another, of shape (N, 2).
+    ring_sizes : list
+        Number of vertices of each ring.
+
+    Returns
+    -------
+    list
+        One shapely.geometry.Polygon per ring.
+    """
+
+    if len(ring_sizes) == 0:
+
+        return []
+
+    if _linearrings is not None:
+
+        ring_indices = np.repeat(np.arange(len(ring_sizes)), ring_sizes)
+
+        return list(_polygons(_linearrings(coords, indices=ring_indices)))
+
+    return [Polygon(ring) for ring in np.split(coords, np.cumsum(ring_sizes)[:-1])]
+
+
+def simplify_polygons(polygons, tolerance=None, rectangle=False):
+    """
+    Reduces the number of vertices of polygons, either by topology-preserving Douglas-Peucker simplification or by
+    fitting the minimum rotated rectangle.
+
+    Parameters
+    ----------
+    polygons : list
+        shapely.geometry.Polygon geometries.
+    tolerance : float
+        Maximum distance of a simplified boundary from the original one, in the polygons' units.
+    rectangle : bool
+        Replace each polygon by its minimum rotated rectangle instead.
+
+    Returns
+    -------
+    list
+        Simplified polygons. Polygons which would degenerate to a line are kept as they are.
+    """
+
+    if len(polygons) == 0:
+
+        return []
+
+    if _shapely is not None:
+
+        polygons = np.asarray(polygons, dtype=object)
+
+        if rectangle:
+
+            simplified = _shapely.oriented_envelope(polygons)
+
+        else:
+
+            simplified = _shapely.simplify(polygons, tolerance, preserve_topology=True)
+
+        degenerate = _shapely.get_type_id(simplified) != 3
+
+        simplified[degenerate] = polygons[degenerate]
+
+        return list(simplified)
+
+    simplified = []
+
+    for polygon in polygons:
+
+        simple = polygon.minimum_rotated_rectangle if rectangle else polygon.simplify(tolerance, preserve_topology=True)
+
+        simplified.append(simple if simple.geom_type == 'Polygon' and not simple.is_empty else polygon)
+
+    return simplified
+
+
+def exterior_coords(polygons):
+    """
+    Vertices of the exterior rings of polygons, the counterpart of polygons_from_rings().
+
+    Parameters
+    ----------
+    polygons : list
+        shapely.geometry.Polygon geometries.
+
+    Returns
+    -------
+    tuple
+        numpy.ndarray of shape (N, 2) with the vertices of all rings one after another and numpy.ndarray with the
+        number of vertices of each ring.
+    """
+
+    if len(polygons) == 0:
+
+        return np.empty((0, 2)), np.empty(0, dtype=int)
+
+    if _shapely is not None:
+
+        coords, ring_indices = _shapely.get_coordinates(_shapely.get_exterior_ring(np.asarray(polygons, dtype=object)), return_index=True)
+
+        return coords, np.bincount(ring_indices, minlength=len(polygons))
+
+    rings = [np.asarray(polygon.exterior.coords) for polygon in polygons]
+
+    return np.concatenate(rings), np.array([len(ring) for ring in rings])
+
+
+def polygon_areas(polygons):
+    """
+    Parameters
+    ----------
+    polygons : list
+        shapely.geometry.Polygon geometries.
+
+    Returns
+    -------
+    numpy.ndarray
+        Area of each polygon.
+    """
+
+    if _shapely is not None:
+
+        return _shapely.area(np.asarray(polygons, dtype=object))
+
+    return np.array([polygon.area for polygon in polygons])
+
+
+def to_wkb(polygons):
+    """
+    Parameters
+    ----------
+    polygons : list
+        shapely.geometry.Polygon geometries.
+
+    Returns
+    -------
+    list
+        Well-known binary representation of each polygon.
+    """
+
+    if _shapely is not None:
+
+        return list(_shapely.to_wkb(np.asarray(polygons, dtype=object)))
+
+    return [polygon.wkb for polygon in polygons]
+
+
+def from_wkb(values):
+    """
+    Parameters
+    ----------
+    values : list
+        Well-known binary representations, e.g. a column read from an Arrow file.
+
+    Returns
+    -------
+    numpy.ndarray
+        shapely geometries as object array.
+    """
+
+    if _shapely is not None:
+
+        return _shapely.from_wkb(np.asarray(values, dtype=object))
+
+    geometries = np.empty(len(values), dtype=object)
+
+    geometries[:] = [wkb.loads(value) for value in values]
+
+    return geometries
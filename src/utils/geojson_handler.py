@@ -2,7 +2,7 @@ import json
 from itertools import chain
 import geopandas as gpd
 from shapely.geometry import Polygon, MultiPolygon
-import pickle
+from src.utils.tile_index import TileIndex
 
 class GeoJsonHandler(object):
 
@@ -18,9 +18,7 @@ class GeoJsonHandler(object):
 
     def returnTileCoords(self):
 
-        with open(f"data/coords/{self.name}.pickle", "rb") as f:
-
-            Tile_coords = pickle.load(f)
+        # Memory-mapped, hence even statewide tile indices load instantly
+        Tile_coords = TileIndex.load(f"data/coords/{self.name}.npy")
 
         return Tile_coords
-
@@ -0,0 +1,182 @@
+import time
+import torch
+
+# torch.inference_mode() is available since PyTorch 1.9, older versions only disable gradient tracking
+_inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+DTYPES = {'float32': torch.float32, 'float16': torch.float16, 'bfloat16': torch.bfloat16}
+
+
+def configure_threads(intra_op_threads=0, inter_op_threads=0):
+    """
+    Sets the number of threads PyTorch uses on CPU. A value of 0 keeps PyTorch's default, i.e. one thread per
+    physical core for intra-op parallelism.
+
+    Parameters
+    ----------
+    intra_op_threads : int
+        Number of threads used within an operator, e.g. a convolution.
+    inter_op_threads : int
+        Number of threads used to run independent operators in parallel.
+    """
+
+    if intra_op_threads:
+
+        torch.set_num_threads(intra_op_threads)
+
+    if inter_op_threads:
+
+        # The inter-op thread pool can only be sized once, before it is first used
+        try:
+
+            torch.set_num_interop_threads(inter_op_threads)
+
+        except RuntimeError as e:
+
+            print(f"Could not set inter_op_threads to {inter_op_threads}: {e}")
+
+
+class InferenceEngine(object):
+    """
+    Runs a model for inference only. The model is put into eval mode and moved to the device, dtype and memory format
+    once, every batch is moved the same way before the forward pass, and no autograd graph is built. Outputs are
+    returned on the CPU in float32. The time spent on moving inputs, the forward pass, and moving outputs back is
+    recorded per batch.
+
+    Attributes
+    ----------
+    name : str
+        Name of the model in the latency report.
+    model : torch.nn.Module
+        Model in eval mode on the device.
+    device : torch.device
+        Device the model runs on.
+    dtype : torch.dtype
+        Floating point type of the model's parameters and inputs.
+    memory_format : torch.memory_format
+        Memory format of 4D inputs, torch.channels_last or torch.contiguous_format.
+    autocast_dtype : torch.dtype
+        Lower precision type the forward pass is autocast to, e.g. torch.bfloat16. None runs the model in dtype.
+    n_batches : int
+        Number of batches processed.
+    n_images : int
+        Number of images processed.
+    timings : dict
+        Accumulated seconds spent on 'to_device', 'forward' and 'to_host'.
+    """
+
+    def __init__(self, model, name, device, dtype=torch.float32, channels_last=False):
+
+        self.name = name
+
+        self.device = device
+
+        self.dtype = dtype
+
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+
+        self.model = model.to(device=device, dtype=dtype, memory_format=self.memory_format)
+
+        self.model.eval()
+
+        self.autocast_dtype = None
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        """
+        Discards the latency of all batches processed so far.
+        """
+
+        self.n_batches = 0
+
+        self.n_images = 0
+
+        self.timings = {'to_device': 0.0, 'forward': 0.0, 'to_host': 0.0}
+
+    def __call__(self, batch):
+        """
+        Parameters
+        ----------
+        batch : torch.Tensor
+            Input batch of shape (N, C, H, W).
+
+        Returns
+        -------
+        torch.Tensor or dict
+            Model output in float32 on the CPU. Dict outputs, e.g. of torchvision's segmentation models, keep their keys.
+        """
+
+        with _inference_mode():
+
+            start = time.perf_counter()
+
+            inputs = self._to_device(batch)
+
+            self._synchronize()
+
+            moved = time.perf_counter()
+
+            outputs = self._forward(inputs)
+
+            self._synchronize()
+
+            computed = time.perf_counter()
+
+            outputs = self._to_host(outputs)
+
+            done = time.perf_counter()
+
+        self.timings['to_device'] += moved - start
+        self.timings['forward'] += computed - moved
+        self.timings['to_host'] += done - computed
+
+        self.n_batches += 1
+
+        self.n_images += len(batch)
+
+        return outputs
+
+    def _to_device(self, batch):
+
+        return batch.to(device=self.device, dtype=self.dtype, memory_format=self.memory_format, non_blocking=True)
+
+    def _forward(self, inputs):
+
+        with torch.autocast(self.device.type, dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None):
+
+            return self.model(inputs)
+
+    def _synchronize(self):
+
+        # CUDA kernels run asynchronously, hence wait for them to finish before taking the time
+        if self.device.type == 'cuda':
+
+            torch.cuda.synchronize(self.device)
+
+    def _to_host(self, outputs):
+
+        if isinstance(outputs, dict):
+
+            return {key: self._to_host(value) for key, value in outputs.items()}
+
+        return outputs.float().cpu()
+
+    def report(self):
+        """
+        Returns
+        -------
+        str
+            Latency breakdown of all processed batches.
+        """
+
+        if self.n_batches == 0:
+
+            return f"{self.name}: no batches processed"
+
+        total = sum(self.timings.values())
+
+        breakdown = ", ".join(f"{key} {seconds:.2f}s" for key, seconds in self.timings.items())
+
+        return (f"{self.name}: {self.n_images} images in {self.n_batches} batches, {total:.2f}s total ({breakdown}), "
+                f"{1000 * total / self.n_batches:.1f} ms/batch, {1000 * total / self.n_images:.1f} ms/image")
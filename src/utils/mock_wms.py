@@ -0,0 +1,298 @@
+import argparse
+import io
+import random
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+from PIL import Image
+
+'''
+Local stand-in for the openNRW WMS to test the tile downloader offline, optionally with injected faults
+'''
+
+
+class _MockWmsHandler(BaseHTTPRequestHandler):
+
+    # HTTP/1.1 keeps connections alive, which is required to test connection pooling
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+
+        params = {key.upper(): values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+
+        if params.get('REQUEST') != 'GetMap' or 'BBOX' not in params:
+
+            self.send_error(400, 'Only GetMap requests with a BBOX are supported')
+
+            return
+
+        with self.server.lock:
+
+            self.server.requests += 1
+
+            self.server.in_flight += 1
+
+            overloaded = self.server.max_in_flight is not None and self.server.in_flight > self.server.max_in_flight
+
+            fault = self.server.random.random()
+
+        try:
+
+            self._answer(params, overloaded, fault)
+
+        finally:
+
+            with self.server.lock:
+
+                self.server.in_flight -= 1
+
+    def _answer(self, params, overloaded, fault):
+
+        # An overloaded server answers slower and sheds load
+        if overloaded:
+
+            time.sleep(self.server.latency * 4)
+
+            self.send_response(503)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+            return
+
+        if self.server.latency > 0:
+
+            time.sleep(self.server.latency)
+
+        if fault < self.server.error_rate:
+
+            self.send_error(503, 'Injected fault')
+
+            return
+
+        body = self.server.png(int(params.get('WIDTH', 4800)), int(params.get('HEIGHT', 4800)))
+
+        truncate = fault < self.server.error_rate + self.server.truncate_rate
+
+        # Partial transfers are resumed with range requests of the form 'bytes=<offset>-'
+        byte_range = self.headers.get('Range', '')
+
+        if self.server.supports_range and byte_range.startswith('bytes=') and byte_range.endswith('-'):
+
+            offset = int(byte_range[len('bytes='):-1])
+
+            if offset >= len(body):
+
+                self.send_error(416, 'Requested range not satisfiable')
+
+                return
+
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {offset}-{len(body) - 1}/{len(body)}')
+
+            body = body[offset:]
+
+        else:
+
+            self.send_response(200)
+
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        # A truncated transfer announces the full length, sends half of the body and drops the connection
+        if truncate:
+
+            self.wfile.write(body[:len(body) // 2])
+
+            self.close_connection = True
+
+            return
+
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+
+        pass
+
+
+class MockWmsServer(object):
+    """
+    Minimal WMS server which answers GetMap requests with a synthetic PNG. It runs in a background thread and can be
+    used as a context manager. Point the downloader to it via the 'wms_url' key in the configuration.
+
+    Attributes
+    ----------
+    latency : float
+        Seconds the server waits before answering a request, e.g. to emulate a slow WMS.
+    image_size : int
+        If set, the side length in pixels of every returned image regardless of the requested WIDTH and HEIGHT.
+    supports_range : bool
+        Whether the server honours HTTP range requests to resume partial transfers.
+    error_rate : float
+        Probability that a request is answered with 503.
+    truncate_rate : float
+        Probability that a transfer is cut off halfway.
+    max_in_flight : int
+        If set, requests beyond this number of concurrent requests are answered slowly with 503 and Retry-After.
+    url : str
+        Base URL of the running server.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, image_size=None, supports_range=True,
+                 error_rate=0.0, truncate_rate=0.0, max_in_flight=None, seed=0):
+        """
+        Parameters
+        ----------
+        host : str
+            Interface the server listens on.
+        port : int
+            Port the server listens on. 0 picks a free port.
+        latency : float
+            Seconds the server waits before answering a request.
+        image_size : int
+            If set, the side length in pixels of every returned image.
+        supports_range : bool
+            Whether the server honours HTTP range requests.
+        error_rate : float
+            Probability that a request is answered with 503.
+        truncate_rate : float
+            Probability that a transfer is cut off halfway.
+        max_in_flight : int
+            If set, the number of concurrent requests above which the server is overloaded.
+        seed : int
+            Seed for the injected faults.
+        """
+
+        self.latency = latency
+        self.image_size = image_size
+        self.supports_range = supports_range
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.max_in_flight = max_in_flight
+
+        self._server = ThreadingHTTPServer((host, port), _MockWmsHandler)
+        self._server.daemon_threads = True
+        self._server.latency = latency
+        self._server.supports_range = supports_range
+        self._server.error_rate = error_rate
+        self._server.truncate_rate = truncate_rate
+        self._server.max_in_flight = max_in_flight
+        self._server.random = random.Random(seed)
+        self._server.lock = threading.Lock()
+        self._server.requests = 0
+        self._server.in_flight = 0
+        self._server.png = self._png
+
+        self._pngs = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self.url = f"http://{host}:{self._server.server_address[1]}/wms"
+
+    @property
+    def requests(self):
+
+        return self._server.requests
+
+    def _png(self, width, height):
+
+        if self.image_size is not None:
+
+            width = height = self.image_size
+
+        # Encoding a large PNG is expensive, hence each size is only encoded once
+        with self._lock:
+
+            if (width, height) not in self._pngs:
+
+                rng = np.random.default_rng(0)
+                image = rng.integers(0, 255, size=(height, width, 3), dtype=np.uint8)
+
+                buffer = io.BytesIO()
+                Image.fromarray(image).save(buffer, format='PNG')
+
+                self._pngs[(width, height)] = buffer.getvalue()
+
+            return self._pngs[(width, height)]
+
+    def start(self):
+
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+
+        return self.start()
+
+    def __exit__(self, *exc_info):
+
+        self.stop()
+
+
+def _benchmark():
+
+    # Imported here to keep the server itself free of pipeline dependencies
+    from src.pipeline_components.tile_downloader import TileDownloader
+    from src.utils.tile_index import TileIndex, TILE_DTYPE
+    from src.utils.download_manifest import DownloadManifest
+    from src.utils.run_state import RunStateStore
+
+    parser = argparse.ArgumentParser(description='Measure the download throughput against a local mock WMS.')
+    parser.add_argument('--tiles', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--image-size', type=int, default=1200)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--truncate-rate', type=float, default=0.0)
+    parser.add_argument('--max-in-flight', type=int, default=None)
+    args = parser.parse_args()
+
+    tiles = np.zeros(args.tiles, dtype=TILE_DTYPE)
+    tiles['id'] = np.arange(args.tiles)
+    tiles['maxx'] = tiles['maxy'] = 1.0
+
+    with MockWmsServer(latency=args.latency, image_size=args.image_size, error_rate=args.error_rate,
+                       truncate_rate=args.truncate_rate, max_in_flight=args.max_in_flight) as server, \
+            tempfile.TemporaryDirectory() as tmp_dir:
+
+        configuration = {
+            'tile_dir': tmp_dir,
+            'county4analysis': 'mock',
+            'wms_url': server.url,
+            'download_concurrency': args.concurrency,
+            'download_backoff_base': 0.1,
+        }
+
+        run_state = RunStateStore(f"{tmp_dir}/state.sqlite")
+
+        downloader = TileDownloader(configuration=configuration, polygon=None, tile_coords=TileIndex(tiles),
+                                    run_state=run_state, manifest=DownloadManifest(f"{tmp_dir}/manifest.jsonl", tmp_dir))
+
+        start = time.time()
+
+        downloader.run()
+
+        elapsed = time.time() - start
+
+        downloaded = len(downloader.manifest)
+
+        run_state.close()
+
+    print(f"{downloaded} of {args.tiles} tiles in {elapsed:.2f}s with {server.requests} requests, "
+          f"i.e. {downloaded / elapsed:.1f} tiles/s. Final concurrency limit: {downloader.limiter.limit:.1f}")
+
+
+if __name__ == '__main__':
+
+    _benchmark()
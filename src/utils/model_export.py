@@ -0,0 +1,320 @@
+import argparse
+import inspect
+from pathlib import Path
+import numpy as np
+import torch
+import yaml
+from torch import nn
+from src.utils.inference_engine import InferenceEngine, configure_threads
+
+'''
+Exports the classification and the segmentation model to TorchScript or ONNX once, and runs the exported graphs
+'''
+
+BACKENDS = ('eager', 'torchscript', 'onnxruntime')
+
+# File suffix of the exported model next to its checkpoint
+SUFFIXES = {'torchscript': '.ts', 'onnxruntime': '.onnx'}
+
+# Models which return a tensor are exported with a single output of this name, models which return a dict with one
+# output per key
+TENSOR_OUTPUT = 'output'
+
+
+def exported_path(checkpoint_path, backend):
+    """
+    Parameters
+    ----------
+    checkpoint_path : str
+        Path of the model's pre-trained weights.
+    backend : str
+        'torchscript' or 'onnxruntime'.
+
+    Returns
+    -------
+    Path
+        Path of the exported model next to the checkpoint.
+    """
+
+    return Path(checkpoint_path).with_suffix(SUFFIXES[backend])
+
+
+def is_outdated(path, checkpoint_path):
+    """
+    Whether the model has not been exported yet or its checkpoint has changed since.
+    """
+
+    return not path.exists() or path.stat().st_mtime < Path(checkpoint_path).stat().st_mtime
+
+
+class _SelectOutputs(nn.Module):
+    """
+    Keeps only the given keys of a model's dict output. Tracing removes everything which does not contribute to the
+    kept outputs.
+    """
+
+    def __init__(self, model, keys):
+
+        super().__init__()
+
+        self.model = model
+
+        self.keys = keys
+
+    def forward(self, x):
+
+        outputs = self.model(x)
+
+        return {key: outputs[key] for key in self.keys}
+
+
+def export_model(model, path, backend, example_input, output_keys=None, rtol=1e-3):
+    """
+    Exports a model in eval mode on the CPU to a frozen TorchScript or an ONNX graph, and checks that the exported
+    graph matches the model within tolerance.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Float32 model in eval mode on the CPU.
+    path : Path
+        Path of the exported model.
+    backend : str
+        'torchscript' or 'onnxruntime'.
+    example_input : torch.Tensor
+        Input batch of the model. The batch dimension of the exported graph is dynamic, all other dimensions are fixed.
+    output_keys : list
+        Keys of a model's dict output to be exported. None if the model returns a tensor.
+    rtol : float
+        Maximum absolute deviation from the model relative to the largest absolute output value.
+
+    Returns
+    -------
+    float
+        Maximum absolute deviation from the model on a batch of random inputs.
+    """
+
+    if output_keys is not None:
+
+        model = _SelectOutputs(model, output_keys).eval()
+
+    output_names = output_keys or [TENSOR_OUTPUT]
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    with torch.no_grad():
+
+        if backend == 'torchscript':
+
+            # Freezing inlines parameters and attributes as constants, so that conv and batch norm can be folded
+            # after loading. strict=False allows dict outputs
+            torch.jit.save(torch.jit.freeze(torch.jit.trace(model, example_input, strict=False)), str(path))
+
+        elif backend == 'onnxruntime':
+
+            kwargs = {}
+
+            # PyTorch >= 2.5 defaults to the dynamo based exporter, which requires onnxscript
+            if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+
+                kwargs['dynamo'] = False
+
+            torch.onnx.export(model, (example_input,), str(path), input_names=['input'], output_names=output_names,
+                              dynamic_axes={name: {0: 'batch'} for name in ['input'] + output_names}, **kwargs)
+
+        else:
+
+            raise ValueError(f"Models can only be exported for {list(SUFFIXES)}, not for {backend}")
+
+    # Compare on a batch size which differs from the example input to check the dynamic batch dimension as well
+    test_input = torch.randn(len(example_input) + 1, *example_input.shape[1:])
+
+    engine = load_engine(path, backend, path.stem, torch.device('cpu'))
+
+    with torch.no_grad():
+
+        expected = model(test_input)
+
+    actual = engine(test_input)
+
+    if output_keys is None:
+
+        expected, actual = {TENSOR_OUTPUT: expected}, {TENSOR_OUTPUT: actual}
+
+    deviation = 0.0
+
+    for key, expected_output in expected.items():
+
+        key_deviation = (expected_output - actual[key]).abs().max().item()
+
+        if key_deviation > rtol * expected_output.abs().max().item():
+
+            path.unlink()
+
+            raise ValueError(f"Exported model {path} deviates by {key_deviation} from the model in output {key}")
+
+        deviation = max(deviation, key_deviation)
+
+    return deviation
+
+
+def load_engine(path, backend, name, device, channels_last=False):
+    """
+    Loads an exported model for inference.
+
+    Parameters
+    ----------
+    path : Path
+        Path of the exported model.
+    backend : str
+        'torchscript' or 'onnxruntime'.
+    name : str
+        Name of the model in the latency report.
+    device : torch.device
+        Device the model runs on.
+    channels_last : bool
+        Whether TorchScript models run on inputs in channels last memory format.
+
+    Returns
+    -------
+    src.utils.inference_engine.InferenceEngine
+    """
+
+    if backend == 'onnxruntime':
+
+        return OnnxEngine(path, name, device)
+
+    model = torch.jit.load(str(path), map_location=device)
+
+    # Folds conv and batch norm, and converts convolutions to oneDNN on CPU. The result cannot be saved again
+    model = torch.jit.optimize_for_inference(model)
+
+    return InferenceEngine(model, name, device, channels_last=channels_last)
+
+
+class OnnxEngine(InferenceEngine):
+    """
+    Runs an exported ONNX graph with ONNX Runtime. Inputs and outputs are exchanged as float32 numpy arrays on the CPU,
+    on a GPU device ONNX Runtime moves them to the GPU itself. The graph uses as many threads as PyTorch.
+
+    Attributes
+    ----------
+    session : onnxruntime.InferenceSession
+        Session holding the optimized graph.
+    output_names : list
+        Names of the graph outputs, i.e. the keys of a model's dict output.
+    """
+
+    def __init__(self, path, name, device):
+
+        # Only needed for the onnxruntime backend
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        options.intra_op_num_threads = torch.get_num_threads()
+
+        providers = ['CPUExecutionProvider']
+
+        if device.type == 'cuda':
+
+            providers.insert(0, 'CUDAExecutionProvider')
+
+        self.session = onnxruntime.InferenceSession(str(path), options, providers=providers)
+
+        self.output_names = [output.name for output in self.session.get_outputs()]
+
+        self.name = name
+
+        self.device = device
+
+        self.dtype = torch.float32
+
+        self.memory_format = torch.contiguous_format
+
+        self.model = self.session
+
+        self.autocast_dtype = None
+
+        self.reset_stats()
+
+    def _to_device(self, batch):
+
+        return np.ascontiguousarray(batch.numpy(), dtype=np.float32)
+
+    def _forward(self, inputs):
+
+        outputs = self.session.run(None, {'input': inputs})
+
+        if self.output_names == [TENSOR_OUTPUT]:
+
+            return outputs[0]
+
+        return dict(zip(self.output_names, outputs))
+
+    def _synchronize(self):
+
+        # session.run() returns once the outputs are on the host
+        pass
+
+    def _to_host(self, outputs):
+
+        if isinstance(outputs, dict):
+
+            return {key: self._to_host(value) for key, value in outputs.items()}
+
+        return torch.from_numpy(outputs)
+
+
+def export_models(configuration, backend):
+    """
+    Exports the classification and the segmentation model of the configuration.
+
+    Parameters
+    ----------
+    configuration : dict
+        config.yml in dict format.
+    backend : str
+        'torchscript' or 'onnxruntime'.
+    """
+
+    # Imported here, because the TileProcessor imports this module
+    from src.utils.model_loader import load_cls_model, load_seg_model
+
+    input_size = configuration['input_size']
+
+    exports = [
+        ('Classification', configuration['cls_checkpoint_path'], load_cls_model, (2, 3, input_size, input_size), None),
+        ('Segmentation', configuration['seg_checkpoint_path'], load_seg_model, (2, 3, 320, 320), ['out']),
+    ]
+
+    for name, checkpoint_path, load_model, input_shape, output_keys in exports:
+
+        path = exported_path(checkpoint_path, backend)
+
+        deviation = export_model(load_model(checkpoint_path), path, backend, torch.randn(*input_shape), output_keys)
+
+        print(f"{name} model exported to {path}, max. deviation from the eager model: {deviation:.2e}")
+
+
+def _export():
+
+    parser = argparse.ArgumentParser(description='Export the models of config.yml to TorchScript or ONNX.')
+    parser.add_argument('--backend', choices=list(SUFFIXES), default='torchscript')
+    parser.add_argument('--config', default='config.yml')
+    args = parser.parse_args()
+
+    with open(args.config, 'rb') as f:
+
+        configuration = yaml.load(f, Loader=yaml.FullLoader)
+
+    configure_threads(configuration.get('intra_op_threads', 0), configuration.get('inter_op_threads', 0))
+
+    export_models(configuration, args.backend)
+
+
+if __name__ == '__main__':
+
+    _export()
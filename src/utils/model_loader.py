@@ -0,0 +1,147 @@
+import inspect
+import pickle
+import torch
+from torch import nn
+from torchvision.models import Inception3, resnet101
+from torchvision.models._utils import IntermediateLayerGetter
+from torchvision.models.segmentation.deeplabv3 import DeepLabHead, DeepLabV3
+
+'''
+Builds the classification and the segmentation model and loads their pre-trained weights. Both models are built
+without downloading any pre-trained weights, since all of them are overwritten by the checkpoints anyway
+'''
+
+# PyTorch >= 2.1 can memory-map a checkpoint and assign its tensors to a model without copying them
+_MMAP = 'mmap' in inspect.signature(torch.load).parameters
+
+_ASSIGN = 'assign' in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def load_state_dict(checkpoint_path):
+    """
+    Loads the model parameters of a checkpoint to the CPU. The checkpoint is memory-mapped if possible, so that only
+    the model parameters are read from disk, e.g. no optimizer state, and they are read only once.
+
+    Parameters
+    ----------
+    checkpoint_path : str
+        Path of a checkpoint dictionary ending with .tar, or of the model parameters only.
+
+    Returns
+    -------
+    dict
+    """
+
+    checkpoint = None
+
+    if _MMAP:
+
+        # Memory-mapping requires the zip format of PyTorch >= 1.6
+        try:
+
+            checkpoint = torch.load(checkpoint_path, map_location='cpu', mmap=True, weights_only=True)
+
+        except (RuntimeError, pickle.UnpicklingError):
+
+            checkpoint = None
+
+    if checkpoint is None:
+
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+
+    if checkpoint_path[-4:] == '.tar':  # it is a checkpoint dictionary rather than just model parameters
+
+        return checkpoint['model_state_dict']
+
+    return checkpoint
+
+
+def assemble(build, state_dict):
+    """
+    Builds a model and loads its parameters. With PyTorch >= 2.1, the model is built on the meta device, i.e.
+    without allocating and randomly initializing parameters, and the loaded tensors become the model's parameters.
+
+    Parameters
+    ----------
+    build : callable
+        Builds the model architecture.
+    state_dict : dict
+        Parameters of the model.
+
+    Returns
+    -------
+    torch.nn.Module
+        Model in eval mode on the CPU.
+    """
+
+    if _ASSIGN:
+
+        with torch.device('meta'):
+
+            model = build()
+
+        model.load_state_dict(state_dict, assign=True)
+
+    else:
+
+        model = build()
+
+        model.load_state_dict(state_dict)
+
+    # Put model into inference mode
+    model.eval()
+
+    return model
+
+
+def _build_cls_model():
+
+    # Specify model architecture
+    return Inception3(num_classes=2, aux_logits=True, transform_input=False, init_weights=False)
+
+
+def _build_seg_model():
+
+    # Same architecture as deeplabv3_resnet101() with a single output channel, but without the auxiliary classifier,
+    # which is only needed for training. The builder itself may download pre-trained weights
+    backbone = IntermediateLayerGetter(resnet101(replace_stride_with_dilation=[False, True, True]),
+                                       return_layers={'layer4': 'out'})
+
+    return DeepLabV3(backbone, DeepLabHead(2048, 1))
+
+
+def load_cls_model(checkpoint_path):
+    """
+    Parameters
+    ----------
+    checkpoint_path : str
+        Path for loading the pre-trained classification weights.
+
+    Returns
+    -------
+    torchvision.models.inception.Inception3
+        Model in eval mode on the CPU.
+    """
+
+    return assemble(_build_cls_model, load_state_dict(checkpoint_path))
+
+
+def load_seg_model(checkpoint_path):
+    """
+    Parameters
+    ----------
+    checkpoint_path : str
+        Path for loading the pre-trained segmentation weights.
+
+    Returns
+    -------
+    torchvision.models.segmentation.deeplabv3.DeepLabV3
+        Model in eval mode on the CPU.
+    """
+
+    state_dict = load_state_dict(checkpoint_path)
+
+    # The checkpoints were trained with the auxiliary classifier, whose parameters are not needed for inference
+    state_dict = {key: value for key, value in state_dict.items() if not key.startswith('aux_classifier.')}
+
+    return assemble(_build_seg_model, state_dict)
@@ -0,0 +1,103 @@
+from collections import deque
+import torch
+
+
+class PatchBatcher(object):
+    """
+    Queue of images which spans tiles. Images are added tile by tile and handed out in full batches of batch_size
+    images regardless of tile boundaries, so that the models never run on under-filled batches except for the very
+    last one. Every image keeps its tile and its upper left coordinate, so that results can be routed back.
+
+    Attributes
+    ----------
+    batch_size : int
+        Number of images per batch.
+    """
+
+    def __init__(self, batch_size):
+
+        self.batch_size = batch_size
+
+        # Chunks of consecutive images as (tiles, coords, images)
+        self._chunks = deque()
+
+        self._size = 0
+
+    def __len__(self):
+
+        return self._size
+
+    def add(self, tile, coords, images):
+        """
+        Appends the images of a tile, or of several tiles.
+
+        Parameters
+        ----------
+        tile : str or list
+            File name of the tile, or a list with the file name of each image's tile.
+        coords : list
+            Upper left (x, y) coordinate of each image.
+        images : torch.Tensor
+            Images with the batch dimension first.
+        """
+
+        if len(images) == 0:
+
+            return
+
+        tiles = [tile] * len(images) if isinstance(tile, str) else list(tile)
+
+        self._chunks.append((tiles, list(coords), images))
+
+        self._size += len(images)
+
+    def next_batch(self, flush=False):
+        """
+        Takes the next batch from the queue.
+
+        Parameters
+        ----------
+        flush : bool
+            Also return an under-filled batch, e.g. after the last tile.
+
+        Returns
+        -------
+        tuple
+            Tile and coordinate of each image as lists and the images as torch.Tensor. None if there is no full batch,
+            or no image at all when flushing.
+        """
+
+        if self._size == 0 or (self._size < self.batch_size and not flush):
+
+            return None
+
+        n_images = min(self.batch_size, self._size)
+
+        tiles = []
+        coords = []
+        images = []
+
+        while n_images > 0:
+
+            chunk_tiles, chunk_coords, chunk_images = self._chunks[0]
+
+            n_taken = min(n_images, len(chunk_images))
+
+            tiles.extend(chunk_tiles[:n_taken])
+            coords.extend(chunk_coords[:n_taken])
+            images.append(chunk_images[:n_taken])
+
+            if n_taken == len(chunk_images):
+
+                self._chunks.popleft()
+
+            else:
+
+                # Slicing a tensor creates a view, the remaining images are not copied
+                self._chunks[0] = (chunk_tiles[n_taken:], chunk_coords[n_taken:], chunk_images[n_taken:])
+
+            n_images -= n_taken
+
+            self._size -= n_taken
+
+        return tiles, coords, images[0] if len(images) == 1 else torch.cat(images)
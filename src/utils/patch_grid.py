@@ -0,0 +1,183 @@
+import numpy as np
+from src.utils.geo_utils import intersects_xy
+
+'''
+Layout of the 16 x 16 m images within a 240 x 240 m tile, shared by TileDownloader and TileProcessor
+'''
+
+# Number of images along each axis of a tile and their side length in pixels
+PATCHES_PER_TILE = 15
+
+PATCH_SIZE = 320
+
+TILE_SIZE = PATCHES_PER_TILE * PATCH_SIZE
+
+
+def patch_corners(minx, maxy, side=16, radius=6371000):
+    """
+    Upper left corners of all images within a tile. The first image is taken from the upper left corner of the tile,
+    the following ones from left to right and from top to bottom. The coordinates are accumulated in exactly the same
+    order as in the original loop of TileProcessor, hence they are bit-identical.
+
+    Parameters
+    ----------
+    minx : float
+        Western boundary of the tile.
+    maxy : float
+        Northern boundary of the tile.
+    side : int
+        Side length in meters for the images.
+    radius : int
+        Earth radius in meters.
+
+    Returns
+    -------
+    tuple
+        numpy.ndarray of shape (15, 15) with the longitudes and numpy.ndarray of shape (15,) with the latitudes of the
+        images' upper left corners.
+    """
+
+    # dlat spans a distance of 'side' meters in north-south direction
+    dlat = (side * 360) / (2 * np.pi * radius)
+
+    steps = np.full(PATCHES_PER_TILE, dlat, dtype=np.float64)
+    steps[0] = float(maxy)
+
+    # np.subtract.accumulate subtracts sequentially, i.e. y = y - dlat just like the original loop
+    y = np.subtract.accumulate(steps)
+
+    # dlon depends on the latitude of each row and is computed per scalar to match the original loop
+    dlon = np.array([(side * 360) / (2 * np.pi * radius * np.cos(np.deg2rad(lat))) for lat in y], dtype=np.float64)
+
+    steps = np.empty((PATCHES_PER_TILE, PATCHES_PER_TILE), dtype=np.float64)
+    steps[:, 0] = float(minx)
+    steps[:, 1:] = dlon[:, None]
+
+    x = np.add.accumulate(steps, axis=1)
+
+    return x, y
+
+
+def patch_mask(polygon, minx, maxy, side=16, radius=6371000):
+    """
+    Images within a tile whose upper left corner intersects the polygon. Only these images are processed.
+
+    Parameters
+    ----------
+    polygon : shapely.geometry.polygon.Polygon
+        Geo-referenced polygon geometry for the selected county within NRW.
+    minx : float
+        Western boundary of the tile.
+    maxy : float
+        Northern boundary of the tile.
+    side : int
+        Side length in meters for the images.
+    radius : int
+        Earth radius in meters.
+
+    Returns
+    -------
+    numpy.ndarray
+        Boolean array of shape (15, 15) which is True for every image within the polygon.
+    """
+
+    x, y = patch_corners(minx, maxy, side, radius)
+
+    return intersects_xy(polygon, x, np.broadcast_to(y[:, None], x.shape))
+
+
+def patch_window(polygon, minx, maxy, side=16, radius=6371000):
+    """
+    Smallest block of image rows and columns which contains all images of a tile within the polygon. Tiles along the
+    county border only need to be downloaded for this block.
+
+    Parameters
+    ----------
+    polygon : shapely.geometry.polygon.Polygon
+        Geo-referenced polygon geometry for the selected county within NRW.
+    minx : float
+        Western boundary of the tile.
+    maxy : float
+        Northern boundary of the tile.
+    side : int
+        Side length in meters for the images.
+    radius : int
+        Earth radius in meters.
+
+    Returns
+    -------
+    tuple
+        First row, last row + 1, first column and last column + 1 of the block. (0, 15, 0, 15) is the full tile.
+    """
+
+    mask = patch_mask(polygon, minx, maxy, side, radius)
+
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+
+    # A tile which only touches the polygon with its lower or right edge contains no image to process,
+    # the single upper left image is the smallest request for it
+    if len(rows) == 0:
+
+        return 0, 1, 0, 1
+
+    return int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1
+
+
+def window_bbox(minx, miny, maxx, maxy, window):
+    """
+    Bounding box of a block of images within a tile, aligned to the pixels of the full 4800 x 4800 image.
+
+    Parameters
+    ----------
+    minx : float
+        Western boundary of the tile.
+    miny : float
+        Southern boundary of the tile.
+    maxx : float
+        Eastern boundary of the tile.
+    maxy : float
+        Northern boundary of the tile.
+    window : tuple
+        First row, last row + 1, first column and last column + 1 of the block as returned by patch_window().
+
+    Returns
+    -------
+    tuple
+        minx, miny, maxx, maxy coordinates of the block.
+    """
+
+    row_start, row_stop, col_start, col_stop = window
+
+    # Degrees per image along each axis of the tile
+    dx = (maxx - minx) / PATCHES_PER_TILE
+    dy = (maxy - miny) / PATCHES_PER_TILE
+
+    return minx + col_start * dx, maxy - row_stop * dy, minx + col_stop * dx, maxy - row_start * dy
+
+
+def patch_indices(x, y, coords):
+    """
+    Row and column of images within a tile by the coordinates of their upper left corners.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Longitudes of all images' upper left corners of shape (15, 15) as returned by patch_corners().
+    y : numpy.ndarray
+        Latitudes of all images' upper left corners of shape (15,) as returned by patch_corners().
+    coords : list
+        Upper left (x, y) coordinates of the images to be looked up.
+
+    Returns
+    -------
+    tuple
+        numpy.ndarray with the row and numpy.ndarray with the column of each image.
+    """
+
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+
+    rows = np.abs(y[None, :] - coords[:, 1:2]).argmin(axis=1)
+    cols = np.abs(x[rows] - coords[:, 0:1]).argmin(axis=1)
+
+    return rows, cols
@@ -0,0 +1,235 @@
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import torch
+
+
+class PatchPrefilter(object):
+    """
+    Cheap first stage in front of the classification model, which rejects images that cannot depict a PV system:
+
+    - uniform images, e.g. water, bare fields or no-data areas, whose pixel standard deviation averaged over the color
+      channels is below min_std,
+    - vegetated images, e.g. forest or meadows, of which more than max_vegetation of the pixels have an excess green
+      index (2G - R - B) / (R + G + B) above vegetation_index,
+    - exact duplicates of an all-black or all-white image or of any of the last max_hashes images, since aerial imagery
+      never repeats pixel by pixel, but filler patterns at coverage gaps do.
+
+    The statistics are computed for a whole tile at once on every stride-th pixel.
+
+    In calibration mode, the prefilter decides on every image, but all images are classified anyway. record() then
+    compares the decisions with the classification model, so that report() can tell the recall, i.e. the share of
+    positively classified images which the prefilter would have passed on.
+
+    Attributes
+    ----------
+    min_std : float
+        Minimum pixel standard deviation of a plausible image.
+    max_vegetation : float
+        Maximum share of vegetation pixels of a plausible image.
+    vegetation_index : float
+        Excess green index above which a pixel counts as vegetation.
+    stride : int
+        Only every stride-th pixel along both axes is used for the statistics.
+    max_hashes : int
+        Number of recent image hashes kept to find duplicates.
+    calibration : bool
+        Whether all images are classified and the decisions are only compared with the classification model.
+    hashes : collections.OrderedDict
+        Hashes of the most recent images.
+    counts : dict
+        Number of images which have been checked, passed and rejected by each test. In calibration mode also the number
+        of positively classified images and how many of them would have been rejected by each test.
+    """
+
+    REASONS = ('low_std', 'vegetation', 'duplicate')
+
+    def __init__(self, min_std=4.0, max_vegetation=0.95, vegetation_index=0.1, stride=4, max_hashes=4096, image_size=320,
+                 calibration=False):
+
+        self.min_std = min_std
+
+        self.max_vegetation = max_vegetation
+
+        self.vegetation_index = vegetation_index
+
+        self.stride = stride
+
+        self.max_hashes = max_hashes
+
+        self.calibration = calibration
+
+        # Areas without coverage are filled with white or black
+        self._no_data_hashes = {self._hash(np.full((image_size, image_size, 3), value, dtype=np.uint8)) for value in (0, 255)}
+
+        self.hashes = OrderedDict()
+
+        self.counts = {'images': 0, 'passed': 0, 'positives': 0, 'positives_passed': 0}
+
+        for reason in self.REASONS:
+
+            self.counts[reason] = 0
+
+            self.counts[f'positives_{reason}'] = 0
+
+    @classmethod
+    def from_configuration(cls, configuration):
+        """
+        Parameters
+        ----------
+        configuration : dict
+            config.yml in dict format.
+
+        Returns
+        -------
+        PatchPrefilter
+            None if neither prefilter nor prefilter_calibration is 1.
+        """
+
+        if not configuration.get('prefilter', 0) and not configuration.get('prefilter_calibration', 0):
+
+            return None
+
+        return cls(configuration.get('prefilter_min_std', 4.0), configuration.get('prefilter_max_vegetation', 0.95),
+                   calibration=bool(configuration.get('prefilter_calibration', 0)))
+
+    def _hash(self, image):
+
+        return hashlib.blake2b(np.ascontiguousarray(image).data, digest_size=16).digest()
+
+    def statistics(self, images):
+        """
+        Parameters
+        ----------
+        images : numpy.ndarray or torch.Tensor
+            uint8 images of shape (N, H, W, 3).
+
+        Returns
+        -------
+        tuple
+            Pixel standard deviation averaged over the color channels and share of vegetation pixels, both as
+            numpy.ndarray of shape (N,).
+        """
+
+        if isinstance(images, torch.Tensor):
+
+            images = images.numpy()
+
+        # A strided view, only the sampled pixels are converted to float
+        pixels = images[:, ::self.stride, ::self.stride].astype(np.float32)
+
+        std = pixels.std(axis=(1, 2)).mean(axis=1)
+
+        red, green, blue = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+
+        excess_green = (2 * green - red - blue) / (red + green + blue + 1)
+
+        vegetation = (excess_green > self.vegetation_index).mean(axis=(1, 2))
+
+        return std, vegetation
+
+    def __call__(self, images):
+        """
+        Decides which images are passed on to the classification model.
+
+        Parameters
+        ----------
+        images : numpy.ndarray or torch.Tensor
+            uint8 images of shape (N, H, W, 3).
+
+        Returns
+        -------
+        numpy.ndarray
+            Boolean array which is True for every plausible image.
+        """
+
+        return self._reasons(images).sum(axis=1) == 0
+
+    def _reasons(self, images):
+
+        if isinstance(images, torch.Tensor):
+
+            images = images.numpy()
+
+        std, vegetation = self.statistics(images)
+
+        duplicate = np.zeros(len(images), dtype=bool)
+
+        for idx, image in enumerate(images):
+
+            image_hash = self._hash(image)
+
+            duplicate[idx] = image_hash in self._no_data_hashes or image_hash in self.hashes
+
+            self.hashes[image_hash] = None
+
+            self.hashes.move_to_end(image_hash)
+
+            if len(self.hashes) > self.max_hashes:
+
+                self.hashes.popitem(last=False)
+
+        # One column per test in the order of REASONS
+        reasons = np.stack([std < self.min_std, vegetation > self.max_vegetation, duplicate], axis=1)
+
+        self.counts['images'] += len(images)
+
+        self.counts['passed'] += int((reasons.sum(axis=1) == 0).sum())
+
+        for reason, rejected in zip(self.REASONS, reasons.sum(axis=0)):
+
+            self.counts[reason] += int(rejected)
+
+        return reasons
+
+    def record(self, images, positives):
+        """
+        Checks images in calibration mode and compares the decisions with the classification model.
+
+        Parameters
+        ----------
+        images : numpy.ndarray or torch.Tensor
+            uint8 images of shape (N, H, W, 3).
+        positives : numpy.ndarray
+            Boolean array which is True for every image the classification model considers to depict a PV system.
+        """
+
+        reasons = self._reasons(images)[positives]
+
+        self.counts['positives'] += int(positives.sum())
+
+        for reason, rejected in zip(self.REASONS, reasons.sum(axis=0)):
+
+            self.counts[f'positives_{reason}'] += int(rejected)
+
+        self.counts['positives_passed'] += int((reasons.sum(axis=1) == 0).sum())
+
+    def report(self):
+        """
+        Returns
+        -------
+        str
+            Share of images rejected by each test and, in calibration mode, the recall with respect to the
+            classification model.
+        """
+
+        if self.counts['images'] == 0:
+
+            return f"Prefilter{' calibration' if self.calibration else ''}: no images"
+
+        rejected = ", ".join(f"{reason} {self.counts[reason]}" for reason in self.REASONS)
+
+        report = (f"Prefilter{' calibration' if self.calibration else ''}: {self.counts['images'] - self.counts['passed']} "
+                  f"of {self.counts['images']} images ({100 * (1 - self.counts['passed'] / self.counts['images']):.1f}%) "
+                  f"{'would be ' if self.calibration else ''}rejected ({rejected})")
+
+        if self.calibration:
+
+            recall = self.counts['positives_passed'] / self.counts['positives'] if self.counts['positives'] else 1.0
+
+            missed = ", ".join(f"{reason} {self.counts[f'positives_{reason}']}" for reason in self.REASONS)
+
+            report += (f"\nRecall {recall:.4f}, {self.counts['positives_passed']} of "
+                       f"{self.counts['positives']} positively classified images passed ({missed} rejected)")
+
+        return report
@@ -1,12 +1,13 @@
-from shapely.geometry import Polygon
 import numpy as np
 import rasterio.features as raster
-from fiona.crs import from_epsg
-import geopandas as gpd
+from affine import Affine
+from src.utils.geo_utils import exterior_coords, polygon_areas, polygons_from_rings, simplify_polygons
 
 class PolygonCreator():
 
-    def __init__(self, size, side, earth_radius, dlat):
+    SIMPLIFICATIONS = ('none', 'simplify', 'rectangle')
+
+    def __init__(self, size, side, earth_radius, dlat, simplification='none', tolerance_m=0.1):
 
         self.size = size
         self.side = side
@@ -15,44 +16,157 @@ class PolygonCreator():
         self.dlat = dlat
         self.epsg = 4326
 
-    def _deltapx2latlon(self, px_distance):
+        if simplification not in self.SIMPLIFICATIONS:
+            raise ValueError(f"Unknown simplification {simplification}, expected one of {self.SIMPLIFICATIONS}")
+
+        # Polygons are simplified in pixel coordinates, where both axes have the same scale
+        self.simplification = simplification
+        self.tolerance_px = tolerance_m * size / side
+        # Number of simplified polygons, their vertices and their area in pixels before and after simplification
+        self.simplification_stats = {'polygons': 0, 'vertices': 0, 'simplified_vertices': 0,
+                                     'area': 0.0, 'simplified_area': 0.0, 'abs_area_change': 0.0}
+
+    def px2latlon(self, upper_left_coords, px_coords):
+        """
+        Georeferences an array of pixel coordinates of shape (N, 2) as returned by rasterio.features.shapes(), i.e.
+        all vertices relative to an image's upper left corner at once.
+        The longitude spacing depends on each vertex' latitude, hence the conversion is not an affine transform.
+        """
+
+        x_min, y_max = upper_left_coords
+        y_new = y_max + (self.side / self.size) * (px_coords[:, 1] - 0.5) * (self.dlat / self.side)
+        x_new = x_min + (self.side / self.size) * (px_coords[:, 0] - 0.5) * 360 * (1 / (2 * np.pi * self.earth_radius * np.cos(np.deg2rad(y_new))))
+        return np.stack([x_new, y_new], axis=1)
+
+    def mask2rings(self, mask, row_offset=0, col_offset=0):
+        """
+        Traces the foreground, i.e. PV system, pixels of a binary segmentation mask. Background shapes are never created.
+
+        Parameters
+        ----------
+        mask : numpy.ndarray
+            Binary segmentation mask, e.g. of shape (size, size) for an image.
+        row_offset : int
+            Row of the mask's upper left pixel within the image or tile which upper_left_coords refer to.
+        col_offset : int
+            Column of the mask's upper left pixel within the image or tile which upper_left_coords refer to.
+
+        Returns
+        -------
+        list
+            numpy.ndarray of shape (N, 2) with the pixel coordinates (column, -row) of each connected PV area's
+            exterior ring.
+        """
+
+        mask = mask.astype(np.uint8)
+
+        # rasterio.features.shapes() returns vertices at pixel corners as (column, -row), here shifted by the offset of
+        # the mask
+        transform = Affine(1.0, 0.0, float(col_offset), 0.0, -1.0, -float(row_offset))
+
+        return [np.asarray(shape['coordinates'][0], dtype=np.float64)
+                for shape, value in raster.shapes(mask, mask=mask.astype(bool), transform=transform)]
+
+    def simplify_rings(self, rings):
+        """
+        Removes the staircase of vertices at every pixel corner, either by topology-preserving simplification with a
+        tolerance of tolerance_px or by fitting the minimum rotated rectangle, e.g. for panel arrays.
+
+        Parameters
+        ----------
+        rings : list
+            Rings as returned by mask2rings().
+
+        Returns
+        -------
+        list
+            Simplified rings.
+        """
+
+        ring_sizes = [len(ring) for ring in rings]
+
+        polygons = polygons_from_rings(np.concatenate(rings), ring_sizes)
+
+        simplified = simplify_polygons(polygons, self.tolerance_px, rectangle=self.simplification == 'rectangle')
+
+        coords, simplified_sizes = exterior_coords(simplified)
+
+        areas, simplified_areas = polygon_areas(polygons), polygon_areas(simplified)
+
+        self.simplification_stats['polygons'] += len(rings)
+        self.simplification_stats['vertices'] += int(sum(ring_sizes))
+        self.simplification_stats['simplified_vertices'] += int(simplified_sizes.sum())
+        self.simplification_stats['area'] += float(areas.sum())
+        self.simplification_stats['simplified_area'] += float(simplified_areas.sum())
+        self.simplification_stats['abs_area_change'] += float(np.abs(simplified_areas - areas).sum())
+
+        return np.split(coords, np.cumsum(simplified_sizes)[:-1])
+
+    def simplification_report(self):
+        """
+        Returns
+        -------
+        str
+            Share of vertices removed and change of the PV area by the simplification.
+        """
+
+        stats = self.simplification_stats
+
+        if stats['polygons'] == 0:
+
+            return f"Simplification {self.simplification}: no polygons"
+
+        return (f"Simplification {self.simplification}: {stats['polygons']} polygons, "
+                f"{stats['vertices']} -> {stats['simplified_vertices']} vertices "
+                f"({100 * (1 - stats['simplified_vertices'] / stats['vertices']):.1f}% removed), "
+                f"total area change {100 * (stats['simplified_area'] / stats['area'] - 1):+.2f}%, "
+                f"absolute area change per polygon {100 * stats['abs_area_change'] / stats['area']:.2f}% of the total area")
+
+    def rings2polygons(self, upper_left_coords, rings):
+        """
+        Simplifies the rings if configured, georeferences their vertices in one array operation and creates the
+        polygons in bulk.
+
+        Parameters
+        ----------
+        upper_left_coords : tuple
+            (x, y) coordinate of the upper left corner of the image or tile.
+        rings : list
+            Rings as returned by mask2rings().
+
+        Returns
+        -------
+        list
+            shapely.geometry.Polygon for each ring.
+        """
 
-        dist_px_x, dist_px_y = px_distance
-        x_min, y_max = self.upper_left_coords
-        y_new = y_max + (self.side / self.size) * (dist_px_y - 0.5) * (self.dlat / self.side)
-        x_new = x_min + (self.side / self.size) * (dist_px_x - 0.5) * 360 * (1 / (2 * np.pi * self.earth_radius * np.cos(np.deg2rad(y_new))))
-        return (x_new, y_new)
+        if len(rings) == 0:
 
-    def _polygon2latlon(self, poly_exterior_coords):
+            return []
 
-        poly_latlon = []
-        for px_distance in poly_exterior_coords:
-            poly_latlon.append(self._deltapx2latlon(px_distance))
-        poly_latlon = Polygon(poly_latlon)
+        if self.simplification != 'none':
 
-        return poly_latlon
+            rings = self.simplify_rings(rings)
 
-    def mask2polygon(self, upper_left_coords, mask):
+        coords = self.px2latlon(upper_left_coords, np.concatenate(rings))
 
-        self.upper_left_coords = upper_left_coords
+        return polygons_from_rings(coords, [len(ring) for ring in rings])
 
-        geos = gpd.GeoDataFrame()
-        geos['class'] = None
-        geos['geometry'] = None
-        for idx, (shape, value) in enumerate(raster.shapes(mask, transform = (1.0, 0.0, 0.0, 0.0, -1.0, 0.0))):
-            polygon = Polygon(shape["coordinates"][0])
-            poly_exterior_coords = list(polygon.exterior.coords)
-            polygon_latlon = self._polygon2latlon(poly_exterior_coords)
-            geos.loc[idx, 'class'] = int(value)
-            geos.loc[idx, 'geometry'] = polygon_latlon
+    def mask2polygons(self, upper_left_coords, mask):
+        """
+        Turns the foreground, i.e. PV system, pixels of a binary segmentation mask into geo-referenced polygons.
 
-        # Set projection for a GeoSeries so geopandas knows how to interpret the coordinates in the geometry column
-        # Read docs at: https://geopandas.org/projections.html
-        if geos['geometry'].crs == None:
-            geos['geometry'].set_crs(epsg=self.epsg, inplace=True)
+        Parameters
+        ----------
+        upper_left_coords : tuple
+            (x, y) coordinate of the image's upper left corner.
+        mask : numpy.ndarray
+            Binary segmentation mask of shape (size, size).
 
-        # Set projection for the GeoDataFrame
-        if geos.crs == None:
-            geos.to_crs(epsg=self.epsg, inplace=True)
+        Returns
+        -------
+        list
+            shapely.geometry.Polygon for each connected PV area, i.e. the exterior ring without holes.
+        """
 
-        return geos
\ No newline at end of file
+        return self.rings2polygons(upper_left_coords, self.mask2rings(mask))
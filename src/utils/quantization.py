@@ -0,0 +1,285 @@
+import copy
+import time
+import numpy as np
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+try:
+
+    import torch.ao.quantization as tq
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+    from torchvision.models.quantization.inception import QuantizableInception3
+
+except ImportError:
+
+    tq = None
+
+QUANTIZATION_MODES = ('none', 'dynamic_int8', 'static_int8', 'bf16')
+
+
+def quantized_backend():
+    """
+    Selects the fastest quantized kernel library available on this CPU, i.e. x86 or fbgemm on x86 CPUs and qnnpack on
+    ARM CPUs.
+
+    Returns
+    -------
+    str
+    """
+
+    for backend in ('x86', 'fbgemm', 'qnnpack'):
+
+        if backend in torch.backends.quantized.supported_engines:
+
+            torch.backends.quantized.engine = backend
+
+            return backend
+
+    raise RuntimeError("No quantized backend is supported on this machine")
+
+
+def segmentation_masks(outputs, threshold):
+    """
+    Turns the segmentation model's class activation maps into binary masks in the same way as the TileProcessor,
+    i.e. with min-max scaling per image.
+
+    Parameters
+    ----------
+    outputs : torch.Tensor
+        Class activation maps of shape (N, 1, H, W).
+    threshold : float
+        Threshold on the scaled activations.
+
+    Returns
+    -------
+    numpy.ndarray
+        Boolean masks of shape (N, H, W).
+    """
+
+    outputs = outputs.squeeze(1).numpy()
+
+    outputs_min = outputs.min(axis=(1, 2), keepdims=True)
+    outputs_max = outputs.max(axis=(1, 2), keepdims=True)
+
+    return (outputs - outputs_min) / (outputs_max - outputs_min + 0.000000001) >= threshold
+
+
+class ModelQuantizer(object):
+    """
+    Speeds up CPU inference by quantizing the classification and the segmentation model once at the start of a run.
+
+    - dynamic_int8 quantizes the weights of linear layers ahead of time and their activations on the fly. This only
+      covers the classifier's fully connected layer, the convolutions of both models keep running in float32.
+    - static_int8 quantizes weights and activations of all layers, with activation ranges calibrated on a sample of
+      images. The classifier is quantized in eager mode with torchvision's quantizable Inception3, which fuses
+      convolution, batch norm and ReLU, the segmentation model with FX graph mode quantization.
+    - bf16 runs both models with bfloat16 autocasting, which needs a CPU with native bfloat16 support to pay off.
+
+    Afterwards, the quantized models are checked against the float32 models on the calibration images: the share of
+    images which are classified the same at cls_threshold and the intersection over union of the segmentation masks
+    at seg_threshold. If either is below min_agreement, the float32 models are kept.
+
+    Attributes
+    ----------
+    mode : str
+        One of 'dynamic_int8', 'static_int8' or 'bf16'.
+    cls_threshold : float
+        Threshold value with respect to the classification network's softmax score above which an image is classified as positive.
+    seg_threshold : float
+        Threshold value to turn the segmentation model's final class activation maps into binary segmentation masks.
+    min_agreement : float
+        Minimum classification agreement and mask intersection over union with the float32 models.
+    """
+
+    def __init__(self, mode, cls_threshold, seg_threshold, min_agreement=0.98):
+
+        if mode not in QUANTIZATION_MODES:
+
+            raise ValueError(f"Unknown quantization mode {mode}, expected one of {QUANTIZATION_MODES}")
+
+        self.mode = mode
+
+        self.cls_threshold = cls_threshold
+
+        self.seg_threshold = seg_threshold
+
+        self.min_agreement = min_agreement
+
+    def quantize(self, cls_engine, seg_engine, calibration_batches):
+        """
+        Quantizes the models of both engines in place and checks them against the float32 models.
+
+        Parameters
+        ----------
+        cls_engine : src.utils.inference_engine.InferenceEngine
+            Engine of the classification model.
+        seg_engine : src.utils.inference_engine.InferenceEngine
+            Engine of the segmentation model.
+        calibration_batches : list
+            Batches of (batch4cls, batch4seg) input tensors.
+
+        Returns
+        -------
+        bool
+            Whether the quantized models passed the check and are used from now on.
+        """
+
+        if self.mode == 'none' or len(calibration_batches) == 0:
+
+            return False
+
+        if self.mode != 'bf16' and (tq is None or cls_engine.device.type != 'cpu' or cls_engine.dtype != torch.float32):
+
+            print(f"Quantization {self.mode} needs a CPU, float32 models and PyTorch >= 1.10, keeping float32 models.")
+
+            return False
+
+        start = time.perf_counter()
+
+        cls_model, seg_model = cls_engine.model, seg_engine.model
+
+        cls_reference = torch.cat([cls_engine(batch4cls) for batch4cls, _ in calibration_batches])
+        seg_reference = torch.cat([seg_engine(batch4seg)['out'] for _, batch4seg in calibration_batches])
+
+        if self.mode == 'bf16':
+
+            cls_engine.autocast_dtype = seg_engine.autocast_dtype = torch.bfloat16
+
+        else:
+
+            backend = quantized_backend()
+
+            cls_engine.model = self.quantize_classifier(cls_model, backend, [batch4cls for batch4cls, _ in calibration_batches])
+            seg_engine.model = self.quantize_segmenter(seg_model, backend, [batch4seg for _, batch4seg in calibration_batches])
+
+        cls_outputs = torch.cat([cls_engine(batch4cls) for batch4cls, _ in calibration_batches])
+        seg_outputs = torch.cat([seg_engine(batch4seg)['out'] for _, batch4seg in calibration_batches])
+
+        cls_agreement, seg_iou = self.agreement(cls_reference, seg_reference, cls_outputs, seg_outputs)
+
+        passed = cls_agreement >= self.min_agreement and seg_iou >= self.min_agreement
+
+        print(f"Quantization {self.mode} on {len(cls_reference)} images in {time.perf_counter() - start:.1f}s: "
+              f"classification agreement {cls_agreement:.4f}, segmentation mask IoU {seg_iou:.4f}, "
+              f"{'passed' if passed else 'below'} min_agreement {self.min_agreement}")
+
+        if not passed:
+
+            print("Keeping float32 models.")
+
+            cls_engine.model, seg_engine.model = cls_model, seg_model
+
+            cls_engine.autocast_dtype = seg_engine.autocast_dtype = None
+
+        # Calibration does not count towards the latency of the run
+        cls_engine.reset_stats()
+
+        seg_engine.reset_stats()
+
+        return passed
+
+    def quantize_classifier(self, model, backend, calibration_batches):
+        """
+        Parameters
+        ----------
+        model : torchvision.models.inception.Inception3
+            Float32 classification model in eval mode on the CPU, which is not modified.
+        backend : str
+            Quantized kernel library.
+        calibration_batches : list
+            Input tensors of shape (N, 3, 299, 299).
+
+        Returns
+        -------
+        torch.nn.Module
+        """
+
+        if self.mode == 'dynamic_int8':
+
+            return tq.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+        quantized_model = QuantizableInception3(num_classes=model.fc.out_features, aux_logits=model.AuxLogits is not None,
+                                                transform_input=model.transform_input, init_weights=False)
+
+        quantized_model.load_state_dict(model.state_dict())
+
+        quantized_model.eval()
+
+        quantized_model.fuse_model()
+
+        quantized_model.qconfig = tq.get_default_qconfig(backend)
+
+        tq.prepare(quantized_model, inplace=True)
+
+        self._calibrate(quantized_model, calibration_batches)
+
+        return tq.convert(quantized_model, inplace=True)
+
+    def quantize_segmenter(self, model, backend, calibration_batches):
+        """
+        Parameters
+        ----------
+        model : torchvision.models.segmentation.deeplabv3.DeepLabV3
+            Float32 segmentation model in eval mode on the CPU, which is not modified.
+        backend : str
+            Quantized kernel library.
+        calibration_batches : list
+            Input tensors of shape (N, 3, 320, 320).
+
+        Returns
+        -------
+        torch.nn.Module
+        """
+
+        # DeepLabV3 consists of convolutions only
+        if self.mode == 'dynamic_int8':
+
+            return model
+
+        prepared_model = prepare_fx(copy.deepcopy(model), tq.get_default_qconfig_mapping(backend),
+                                    example_inputs=(calibration_batches[0],))
+
+        self._calibrate(prepared_model, calibration_batches)
+
+        return convert_fx(prepared_model)
+
+    def _calibrate(self, model, calibration_batches):
+
+        # Observers record the range of every activation
+        with torch.no_grad():
+
+            for batch in calibration_batches:
+
+                model(batch)
+
+    def agreement(self, cls_reference, seg_reference, cls_outputs, seg_outputs):
+        """
+        Parameters
+        ----------
+        cls_reference : torch.Tensor
+            Logits of the float32 classification model.
+        seg_reference : torch.Tensor
+            Class activation maps of the float32 segmentation model.
+        cls_outputs : torch.Tensor
+            Logits of the quantized classification model.
+        seg_outputs : torch.Tensor
+            Class activation maps of the quantized segmentation model.
+
+        Returns
+        -------
+        tuple
+            Share of images classified the same and intersection over union of all segmentation mask pixels.
+        """
+
+        cls_reference = F.softmax(cls_reference, dim=1)[:, 1].numpy() >= self.cls_threshold
+        cls_outputs = F.softmax(cls_outputs, dim=1)[:, 1].numpy() >= self.cls_threshold
+
+        seg_reference = segmentation_masks(seg_reference, self.seg_threshold)
+        seg_outputs = segmentation_masks(seg_outputs, self.seg_threshold)
+
+        union = np.logical_or(seg_reference, seg_outputs).sum()
+
+        seg_iou = np.logical_and(seg_reference, seg_outputs).sum() / union if union > 0 else 1.0
+
+        return float((cls_reference == cls_outputs).mean()), float(seg_iou)
@@ -0,0 +1,162 @@
+import asyncio
+import random
+import time
+
+'''
+Retry and rate control for requests to the openNRW web server
+'''
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with full jitter, i.e. the n-th retry waits a random time between 0 and
+    min(max_delay, base_delay * 2 ** n) seconds. Randomizing the delay keeps concurrent workers from retrying in
+    lockstep after a common failure.
+
+    Attributes
+    ----------
+    max_retries : int
+        Number of retries after the first attempt before a tile is given up.
+    base_delay : float
+        Upper bound in seconds for the delay before the first retry.
+    max_delay : float
+        Upper bound in seconds for the delay before any retry.
+    """
+
+    # HTTP status codes which signal a transient problem on the server's side
+    RETRYABLE_STATUS = {408, 416, 429, 500, 502, 503, 504}
+
+    def __init__(self, max_retries=5, base_delay=1.0, max_delay=60.0):
+
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Seconds to wait before the next attempt.
+
+        Parameters
+        ----------
+        attempt : int
+            Number of the failed attempt, starting at 0.
+        retry_after : float
+            Delay in seconds requested by the server via the Retry-After header, if any.
+
+        Returns
+        -------
+        float
+        """
+
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+        if retry_after is not None:
+
+            delay = max(delay, min(self.max_delay, retry_after))
+
+        return delay
+
+    def is_retryable(self, status):
+        """
+        Whether a request which failed with the given HTTP status code should be retried.
+
+        Parameters
+        ----------
+        status : int
+            HTTP status code, or None if the request failed without a response, e.g. due to a timeout.
+
+        Returns
+        -------
+        bool
+        """
+
+        return status is None or status in self.RETRYABLE_STATUS
+
+
+class AdaptiveConcurrencyLimiter(object):
+    """
+    Limits the number of concurrent requests with additive increase, multiplicative decrease (AIMD). Every request
+    which succeeds within the latency target raises the limit by 1 / limit, i.e. by about one per round of requests.
+    A failed or slow request multiplies the limit by decrease_factor, at most once per round: requests which were
+    started before the last decrease cannot trigger another one.
+
+    The limiter must be created within the event loop that uses it.
+
+    Attributes
+    ----------
+    limit : float
+        Current number of requests which may be in flight at the same time.
+    min_limit : int
+        Lower bound for the limit.
+    max_limit : int
+        Upper bound for the limit.
+    latency_target : float
+        Requests taking longer than this many seconds count as a sign of overload.
+    decrease_factor : float
+        Factor by which the limit is multiplied on overload.
+    """
+
+    def __init__(self, initial_limit, min_limit, max_limit, latency_target, decrease_factor=0.5):
+
+        self.min_limit = max(1, int(min_limit))
+        self.max_limit = max(self.min_limit, int(max_limit))
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+
+        self._in_flight = 0
+        self._last_decrease = float('-inf')
+        self._condition = asyncio.Condition()
+
+    @property
+    def in_flight(self):
+
+        return self._in_flight
+
+    async def acquire(self):
+        """
+        Waits until a request may be sent.
+
+        Returns
+        -------
+        float
+            Start time of the request, which has to be passed to release().
+        """
+
+        async with self._condition:
+
+            await self._condition.wait_for(lambda: self._in_flight < int(self.limit))
+
+            self._in_flight += 1
+
+        return time.monotonic()
+
+    async def release(self, start, success):
+        """
+        Marks a request as finished and adapts the limit.
+
+        Parameters
+        ----------
+        start : float
+            Start time of the request as returned by acquire().
+        success : bool
+            Whether the request succeeded.
+        """
+
+        latency = time.monotonic() - start
+
+        async with self._condition:
+
+            self._in_flight -= 1
+
+            if success and latency <= self.latency_target:
+
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            elif start > self._last_decrease:
+
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+
+                self._last_decrease = time.monotonic()
+
+            self._condition.notify_all()
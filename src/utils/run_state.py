@@ -0,0 +1,333 @@
+import csv
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from src.utils.tile_index import tile_filename
+
+'''
+Keeps track of every tile of a county on its way through the pipeline in a single SQLite database
+'''
+
+STATES = ('pending', 'downloading', 'downloaded', 'processing', 'done', 'failed')
+
+# Entering one of these states starts another attempt
+ATTEMPT_STATES = ('downloading', 'processing')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (
+    tile_id INTEGER PRIMARY KEY,
+    state TEXT NOT NULL,
+    stage TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tiles_state ON tiles (state, stage, tile_id);
+CREATE TABLE IF NOT EXISTS transitions (
+    tile_id INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    error TEXT,
+    time REAL NOT NULL
+);
+"""
+
+# Unknown tiles are inserted, known tiles are updated. Attempts are counted per stage, i.e. they start at 1 again when
+# a downloaded tile enters processing
+_UPSERT = """
+INSERT INTO tiles (tile_id, state, stage, attempts, error, updated) VALUES (:tile_id, :state, :stage, :attempt, :error, :time)
+ON CONFLICT (tile_id) DO UPDATE SET
+    state = excluded.state,
+    stage = excluded.stage,
+    attempts = CASE WHEN tiles.stage IS excluded.stage THEN tiles.attempts + excluded.attempts ELSE excluded.attempts END,
+    error = excluded.error,
+    updated = excluded.updated
+"""
+
+
+def _downloaded_tile_id(entry):
+
+    # Integer tile IDs, logs of the bounding box as a stringified tuple were written by older versions
+    return int(entry) if entry.isdigit() else None
+
+
+def _processed_tile_id(entry):
+
+    # File names of complete tiles, i.e. '<tile ID>,COMPLETE.png'. Older versions named tiles after their bounding box
+    prefix = entry.split(',')[0]
+
+    if prefix.isdigit() and entry == tile_filename(int(prefix)):
+
+        return int(prefix)
+
+    return None
+
+
+class RunStateStore(object):
+    """
+    Lifecycle of every tile of a county, i.e. pending, downloading, downloaded, processing, done or failed, together
+    with the number of attempts of its current stage and the error of its last failure. This replaces the .csv logs of
+    downloaded and processed tiles.
+
+    The database runs in write-ahead logging mode, so that readers never block the writer and a crash never leaves a
+    half-written state behind. Every state change is a single transaction which updates the tile and appends the change
+    to the transitions table. Tiles are stored by their integer ID and indexed by their state, so that resuming a run
+    only looks up the tiles in the requested state.
+
+    The downloader and the processor share one connection across threads, which is serialized by a lock.
+
+    Attributes
+    ----------
+    path : Path
+        Path to the SQLite database.
+    """
+
+    def __init__(self, path):
+
+        self.path = Path(path)
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+
+        # isolation_level=None leaves transactions to the explicit BEGIN statements below
+        self._connection = sqlite3.connect(str(self.path), timeout=60, check_same_thread=False, isolation_level=None)
+
+        self._connection.execute('PRAGMA journal_mode=WAL')
+
+        # In WAL mode, transactions are still atomic and durable against crashes of the process with synchronous=NORMAL
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+
+        self._connection.executescript(_SCHEMA)
+
+    @classmethod
+    def from_configuration(cls, configuration):
+        """
+        Parameters
+        ----------
+        configuration : dict
+            config.yml in dict format.
+
+        Returns
+        -------
+        RunStateStore
+            Store of the county of the configuration. The .csv logs of previous runs are imported on first use.
+        """
+
+        county = configuration.get('county4analysis')
+
+        store = cls(Path(f"logs/{county}_runState.sqlite"))
+
+        if store.is_empty():
+
+            store.import_csv_logs(Path('logs'), county)
+
+        return store
+
+    def _execute(self, statement, parameters=()):
+
+        with self._lock:
+
+            return self._connection.execute(statement, parameters).fetchall()
+
+    def is_empty(self):
+
+        return len(self._execute('SELECT 1 FROM tiles LIMIT 1')) == 0
+
+    def register(self, tile_ids):
+        """
+        Adds tiles as pending. Tiles which are already known keep their state.
+
+        Parameters
+        ----------
+        tile_ids : iterable
+            Integer IDs of the tiles.
+        """
+
+        now = time.time()
+
+        with self._lock:
+
+            self._connection.execute('BEGIN IMMEDIATE')
+
+            try:
+
+                self._connection.executemany(
+                    "INSERT OR IGNORE INTO tiles (tile_id, state, updated) VALUES (?, 'pending', ?)",
+                    ((int(tile_id), now) for tile_id in tile_ids)
+                )
+
+                self._connection.execute('COMMIT')
+
+            except BaseException:
+
+                self._connection.execute('ROLLBACK')
+
+                raise
+
+    def set_state(self, tile_ids, state, error=None, stage=None):
+        """
+        Moves tiles to a new state in one transaction.
+
+        Parameters
+        ----------
+        tile_ids : int or iterable
+            Integer ID of a tile or of several tiles.
+        state : str
+            One of STATES.
+        error : str
+            Error of a failed tile.
+        stage : str
+            'download' or 'processing'. Derived from state if None, a failed tile keeps the stage it failed in.
+        """
+
+        if state not in STATES:
+
+            raise ValueError(f"Unknown tile state {state}, expected one of {STATES}")
+
+        if not hasattr(tile_ids, '__iter__'):
+
+            tile_ids = [tile_ids]
+
+        if stage is None and state != 'failed':
+
+            stage = 'processing' if state in ('processing', 'done') else 'download'
+
+        now = time.time()
+
+        rows = [{'tile_id': int(tile_id), 'state': state, 'stage': stage, 'attempt': int(state in ATTEMPT_STATES),
+                 'error': error, 'time': now} for tile_id in tile_ids]
+
+        with self._lock:
+
+            self._connection.execute('BEGIN IMMEDIATE')
+
+            try:
+
+                if stage is None:
+
+                    # A failure is attributed to the stage the tile is in
+                    self._connection.executemany(
+                        "UPDATE tiles SET state = :state, error = :error, updated = :time WHERE tile_id = :tile_id",
+                        rows
+                    )
+
+                else:
+
+                    self._connection.executemany(_UPSERT, rows)
+
+                self._connection.executemany(
+                    "INSERT INTO transitions (tile_id, state, error, time) VALUES (:tile_id, :state, :error, :time)", rows
+                )
+
+                self._connection.execute('COMMIT')
+
+            except BaseException:
+
+                self._connection.execute('ROLLBACK')
+
+                raise
+
+    def tiles(self, state, stage=None):
+        """
+        Parameters
+        ----------
+        state : str
+            One of STATES.
+        stage : str
+            Only tiles in this stage, e.g. 'download' to get the tiles which could not be downloaded.
+
+        Returns
+        -------
+        list
+            Integer IDs of all tiles in the state in ascending order.
+        """
+
+        if stage is None:
+
+            rows = self._execute('SELECT tile_id FROM tiles WHERE state = ? ORDER BY tile_id', (state,))
+
+        else:
+
+            rows = self._execute('SELECT tile_id FROM tiles WHERE state = ? AND stage = ? ORDER BY tile_id', (state, stage))
+
+        return [tile_id for tile_id, in rows]
+
+    def get(self, tile_id):
+        """
+        Parameters
+        ----------
+        tile_id : int
+            Integer ID of the tile.
+
+        Returns
+        -------
+        dict
+            State, stage, attempts and error of the tile. None if the tile is unknown.
+        """
+
+        rows = self._execute('SELECT state, stage, attempts, error FROM tiles WHERE tile_id = ?', (int(tile_id),))
+
+        if len(rows) == 0:
+
+            return None
+
+        return dict(zip(('state', 'stage', 'attempts', 'error'), rows[0]))
+
+    def counts(self):
+        """
+        Returns
+        -------
+        dict
+            Number of tiles in each state.
+        """
+
+        return dict(self._execute('SELECT state, COUNT(*) FROM tiles GROUP BY state'))
+
+    def import_csv_logs(self, log_dir, county):
+        """
+        Imports the .csv logs of downloaded and processed tiles which were written before the store existed, so that
+        such runs can be resumed. Successes are imported after failures, i.e. a tile which failed and succeeded later
+        ends up as downloaded or done. Rows which do not identify a tile by its integer ID, e.g. from versions which
+        identified tiles by their bounding box, are skipped and counted.
+
+        Parameters
+        ----------
+        log_dir : Path
+            Directory with the downloading and processing logs.
+        county : str
+            Name of the county.
+        """
+
+        logs = [
+            (Path(log_dir) / f"downloading/{county}_notDownloadedTiles.csv", 'failed', 'download', _downloaded_tile_id),
+            (Path(log_dir) / f"downloading/{county}_downloadedTiles.csv", 'downloaded', 'download', _downloaded_tile_id),
+            (Path(log_dir) / f"processing/{county}_notProcessedTiles.csv", 'failed', 'processing', _processed_tile_id),
+            (Path(log_dir) / f"processing/{county}_processedTiles.csv", 'done', 'processing', _processed_tile_id),
+        ]
+
+        for path, state, stage, to_tile_id in logs:
+
+            if not os.path.exists(path):
+
+                continue
+
+            with open(path) as csvFile:
+
+                # Failed tiles were saved with their error as second column
+                rows = [(to_tile_id(row[0]), row[1] if len(row) > 1 else None) for row in csv.reader(csvFile) if row]
+
+            valid_rows = [(tile_id, error) for tile_id, error in rows if tile_id is not None]
+
+            for error in {error for tile_id, error in valid_rows}:
+
+                self.set_state([tile_id for tile_id, row_error in valid_rows if row_error == error], state, error, stage)
+
+            print(f"Imported {len(valid_rows)} tiles from {path}, skipped {len(rows) - len(valid_rows)} rows in an outdated format")
+
+    def close(self):
+
+        with self._lock:
+
+            self._connection.close()
@@ -0,0 +1,320 @@
+import os
+import threading
+from pathlib import Path
+
+
+class TileBuffer(object):
+    """
+    Bounds the amount of downloaded, but not yet processed tiles in tile_dir. Downloads pause once the buffer exceeds
+    its high watermark and resume once it has been drained below its low watermark, e.g. by the TileProcessor
+    deleting processed tiles. Both watermarks can be given in bytes and/or in number of tiles; a watermark of 0 or
+    None is not enforced. Independent of the watermarks, downloads pause while the free disk space is below
+    min_free_bytes.
+
+    Every download reserves a slot in wait_for_space() and either fills it with add() or returns it with cancel(),
+    hence downloads in flight count towards the tile watermarks as well.
+
+    Consumers in the same process call remove() to wake up waiting downloads immediately. Consumers in other
+    processes are noticed by rescanning tile_dir every poll_interval seconds while downloads are paused.
+
+    A consumer which has read a tile into memory can release() it before deleting it. The tile then no longer counts
+    towards the buffer, so that the next tile can be downloaded while the consumer is still working on it.
+
+    Once nothing consumes tiles anymore, e.g. because the consumer failed, close() ends all waiting downloads.
+
+    Attributes
+    ----------
+    tile_dir : Path
+        Path to directory where all the downloaded tiles are saved.
+    high_watermark_bytes : int
+        Downloads pause when the buffered tiles exceed this many bytes.
+    low_watermark_bytes : int
+        Paused downloads resume when the buffered tiles fall below this many bytes.
+    high_watermark_tiles : int
+        Downloads pause when the buffer holds this many tiles, including downloads in flight.
+    low_watermark_tiles : int
+        Paused downloads resume when the buffer holds fewer than this many tiles.
+    min_free_bytes : int
+        Downloads pause while the free disk space is below this many bytes.
+    poll_interval : float
+        Seconds between rescans of tile_dir while downloads are paused.
+    n_bytes : int
+        Bytes currently held by the buffer.
+    n_tiles : int
+        Tiles currently held by the buffer.
+    """
+
+    def __init__(self, tile_dir, high_watermark_bytes=None, low_watermark_bytes=None, high_watermark_tiles=None,
+                 low_watermark_tiles=None, min_free_bytes=1024 ** 3, poll_interval=5.0):
+
+        self.tile_dir = Path(tile_dir)
+
+        self.high_watermark_bytes = high_watermark_bytes or None
+        self.low_watermark_bytes = low_watermark_bytes or high_watermark_bytes or None
+        self.high_watermark_tiles = high_watermark_tiles or None
+        self.low_watermark_tiles = low_watermark_tiles or high_watermark_tiles or None
+
+        self.min_free_bytes = min_free_bytes
+
+        self.poll_interval = poll_interval
+
+        self._condition = threading.Condition()
+
+        self._paused = False
+
+        self._closed = False
+
+        self._reserved = 0
+
+        # File names of tiles which have been released, but not removed yet
+        self._released = set()
+
+        self.rescan()
+
+    @classmethod
+    def from_configuration(cls, configuration):
+        """
+        Creates the buffer from config.yml in dict format.
+
+        Parameters
+        ----------
+        configuration : dict
+            config.yml in dict format.
+
+        Returns
+        -------
+        TileBuffer
+        """
+
+        mb = 1024 * 1024
+
+        return cls(
+            configuration['tile_dir'],
+            high_watermark_bytes=configuration.get('tile_buffer_high_watermark_mb', 0) * mb,
+            low_watermark_bytes=configuration.get('tile_buffer_low_watermark_mb', 0) * mb,
+            high_watermark_tiles=configuration.get('tile_buffer_high_watermark_tiles', 0),
+            low_watermark_tiles=configuration.get('tile_buffer_low_watermark_tiles', 0),
+            min_free_bytes=configuration.get('min_free_disk_mb', 1024) * mb,
+        )
+
+    def rescan(self):
+        """
+        Recounts all tiles in tile_dir, including partially downloaded ones.
+        """
+
+        n_bytes = 0
+        n_tiles = 0
+
+        with os.scandir(self.tile_dir) as entries:
+
+            for entry in entries:
+
+                if entry.name.endswith('.png') and entry.name not in self._released:
+
+                    n_bytes += entry.stat().st_size
+                    n_tiles += 1
+
+        with self._condition:
+
+            self.n_bytes = n_bytes
+            self.n_tiles = n_tiles
+
+            self._condition.notify_all()
+
+    def _free_bytes(self):
+
+        st = os.statvfs(self.tile_dir)
+
+        # f_bavail is the number of free blocks available to non-super users, f_frsize the block size in bytes
+        return st.f_bavail * st.f_frsize
+
+    def _is_full(self):
+
+        if self.high_watermark_bytes is not None and self.n_bytes > self.high_watermark_bytes:
+
+            return True
+
+        if self.high_watermark_tiles is not None and self.n_tiles + self._reserved >= self.high_watermark_tiles:
+
+            return True
+
+        return False
+
+    def _is_drained(self):
+
+        if self.low_watermark_bytes is not None and self.n_bytes >= self.low_watermark_bytes:
+
+            return False
+
+        if self.low_watermark_tiles is not None and self.n_tiles + self._reserved >= self.low_watermark_tiles:
+
+            return False
+
+        return True
+
+    def _has_space(self):
+
+        # Once paused, downloads only resume below the low watermark to avoid flapping around the high watermark
+        if self._paused:
+
+            if not self._is_drained():
+
+                return False
+
+        elif self._is_full():
+
+            return False
+
+        return self._free_bytes() > self.min_free_bytes
+
+    def wait_for_space(self):
+        """
+        Blocks until the buffer has room for another tile and reserves a slot for it.
+
+        Raises
+        ------
+        RuntimeError
+            If the buffer has been closed before or while waiting.
+        """
+
+        with self._condition:
+
+            if self._closed:
+
+                raise RuntimeError('Tile buffer has been closed')
+
+            if self._has_space():
+
+                if self._paused:
+
+                    print(f"Tile buffer has been drained to {self.n_tiles + self._reserved} tiles, resuming downloads ...")
+
+                    self._paused = False
+
+                self._reserved += 1
+
+                return
+
+            if not self._paused:
+
+                print(f"Tile buffer is full with {self.n_tiles + self._reserved} tiles and {self.n_bytes / 1024 ** 2:.0f} MB, pausing downloads ...")
+
+                self._paused = True
+
+        while True:
+
+            with self._condition:
+
+                # Woken up by remove() or after poll_interval to notice consumers in other processes
+                notified = self._condition.wait(timeout=self.poll_interval)
+
+                if self._closed:
+
+                    raise RuntimeError('Tile buffer has been closed')
+
+                if self._has_space():
+
+                    if self._paused:
+
+                        print(f"Tile buffer has been drained to {self.n_tiles + self._reserved} tiles, resuming downloads ...")
+
+                        self._paused = False
+
+                    self._reserved += 1
+
+                    return
+
+            if not notified:
+
+                self.rescan()
+
+    def add(self, n_bytes):
+        """
+        Fills the slot reserved by wait_for_space() with a newly downloaded tile.
+
+        Parameters
+        ----------
+        n_bytes : int
+            Size of the tile in bytes.
+        """
+
+        with self._condition:
+
+            self._reserved = max(0, self._reserved - 1)
+
+            self.n_bytes += n_bytes
+            self.n_tiles += 1
+
+    def cancel(self):
+        """
+        Returns the slot reserved by wait_for_space() after a failed download.
+        """
+
+        with self._condition:
+
+            self._reserved = max(0, self._reserved - 1)
+
+            self._condition.notify_all()
+
+    def release(self, filename, n_bytes):
+        """
+        Stops counting a tile which the consumer holds in memory, and wakes up paused downloads.
+
+        Parameters
+        ----------
+        filename : str
+            File name of the tile.
+        n_bytes : int
+            Size of the tile in bytes.
+        """
+
+        with self._condition:
+
+            if filename in self._released:
+
+                return
+
+            self._released.add(filename)
+
+            self.n_bytes = max(0, self.n_bytes - n_bytes)
+            self.n_tiles = max(0, self.n_tiles - 1)
+
+            self._condition.notify_all()
+
+    def remove(self, n_bytes, filename=None):
+        """
+        Accounts for a processed and deleted tile and wakes up paused downloads.
+
+        Parameters
+        ----------
+        n_bytes : int
+            Size of the tile in bytes.
+        filename : str
+            File name of the tile. A released tile is not counted anymore.
+        """
+
+        with self._condition:
+
+            if filename in self._released:
+
+                self._released.discard(filename)
+
+                self._condition.notify_all()
+
+                return
+
+            self.n_bytes = max(0, self.n_bytes - n_bytes)
+            self.n_tiles = max(0, self.n_tiles - 1)
+
+            self._condition.notify_all()
+
+    def close(self):
+        """
+        Wakes up all waiting downloads and lets them and all later calls of wait_for_space() fail.
+        """
+
+        with self._condition:
+
+            self._closed = True
+
+            self._condition.notify_all()
@@ -0,0 +1,265 @@
+import numpy as np
+from shapely.geometry import box
+from shapely.prepared import prep
+from src.utils.geo_utils import intersects_xy
+
+
+class TileGrid(object):
+    """
+    Grid of tiles, each with a dimension of side x side meters, spanned over a bounding box. The grid is computed
+    with NumPy arrays and the tiles within a polygon are selected by a quadtree which accepts or rejects whole blocks
+    of tiles at once and only tests the corners of individual tiles along the polygon's boundary.
+
+    Rows run from south to north and columns from west to east. The tile coordinates are accumulated in exactly the
+    same order as in the original nested while loop of TileCreator, hence the bounding boxes are bit-identical.
+
+    Attributes
+    ----------
+    side : int
+        Side length in meters for the tiles.
+    radius : int
+        Earth radius in meters.
+    dlat : float
+        Spans a distance of 'side' meters in north-south direction.
+    y : numpy.ndarray
+        Latitude of the tile centers for each row.
+    dlon : numpy.ndarray
+        Spans a distance of 'side' meters in west-east direction for each row.
+    n_cols : numpy.ndarray
+        Number of tiles in each row.
+    x : numpy.ndarray
+        Longitude of the tile centers with shape (rows, max(n_cols)). Cells beyond n_cols of a row are NaN.
+    leaf_size : int
+        Blocks with at most leaf_size rows and columns are no longer subdivided, but their tile corners are tested
+        in bulk against the polygon.
+    """
+
+    def __init__(self, N, S, E, W, side, radius, leaf_size=32):
+        """
+        Parameters
+        ----------
+        N : float
+            Northern boundary for the tile coordinates.
+        S : float
+            Southern boundary for the tile coordinates.
+        E : float
+            Eastern boundary for the tile coordinates.
+        W : float
+            Western boundary for the tile coordinates.
+        side : int
+            Side length in meters for the tiles.
+        radius : int
+            Earth radius in meters.
+        leaf_size : int
+            Maximum block size in tiles along each axis for which the quadtree stops subdividing.
+        """
+
+        self.side = side
+        self.radius = radius
+        self.leaf_size = leaf_size
+
+        # dlat spans a distance of 'side' meters in north-south direction
+        self.dlat = (self.side * 360) / (2 * np.pi * self.radius)
+
+        # Row latitudes are accumulated sequentially to reproduce the floating point values of the original loop
+        y = []
+
+        y_current = S
+
+        while y_current < N:
+
+            y.append(y_current)
+
+            y_current = y_current + self.dlat
+
+        self.y = np.array(y, dtype=np.float64)
+
+        # dlon depends on the latitude of each row
+        self.dlon = np.array(
+            [(self.side * 360) / (2 * np.pi * self.radius * np.cos(np.deg2rad(lat))) for lat in y], dtype=np.float64
+        )
+
+        # Upper bound for the number of columns, the exact number is determined after accumulation
+        max_cols = int(np.ceil((E - W) / self.dlon.min())) + 2
+
+        steps = np.empty((len(self.y), max_cols), dtype=np.float64)
+        steps[:, 0] = W
+        steps[:, 1:] = self.dlon[:, None]
+
+        # np.add.accumulate adds sequentially, i.e. x = x + dlon just like the original loop
+        x = np.add.accumulate(steps, axis=1)
+
+        self.n_cols = (x < E).sum(axis=1)
+
+        x = x[:, :self.n_cols.max()]
+        x[np.arange(x.shape[1])[None, :] >= self.n_cols[:, None]] = np.nan
+
+        self.x = x
+
+    @property
+    def shape(self):
+
+        return self.x.shape
+
+    def bounds(self, rows, cols):
+        """
+        Bounding box coordinates for the given tiles.
+
+        Parameters
+        ----------
+        rows : numpy.ndarray
+            Row indices of the tiles.
+        cols : numpy.ndarray
+            Column indices of the tiles.
+
+        Returns
+        -------
+        tuple
+            Four numpy.ndarrays with the minx, miny, maxx, maxy coordinates of the tiles.
+        """
+
+        rows = np.asarray(rows)
+        cols = np.asarray(cols)
+
+        x = self.x[rows, cols]
+        half_dlon = self.dlon[rows] / 2
+        y = self.y[rows]
+
+        return x - half_dlon, y - self.dlat / 2, x + half_dlon, y + self.dlat / 2
+
+    def _block_envelope(self, r0, r1, c0, c1):
+
+        # Columns within the block which actually exist in each row
+        c_last = np.minimum(self.n_cols[r0:r1], c1) - 1
+        valid = c_last >= c0
+
+        if not valid.any():
+
+            return None
+
+        rows = np.arange(r0, r1)[valid]
+
+        minx, _, _, _ = self.bounds(rows, np.full(len(rows), c0))
+        _, _, maxx, _ = self.bounds(rows, c_last[valid])
+
+        return minx.min(), self.y[rows[0]] - self.dlat / 2, maxx.max(), self.y[rows[-1]] + self.dlat / 2
+
+    def _block_cells(self, r0, r1, c0, c1):
+
+        rows, cols = np.meshgrid(np.arange(r0, r1), np.arange(c0, c1), indexing='ij')
+
+        inside = cols < self.n_cols[rows]
+
+        return rows[inside], cols[inside]
+
+    def select(self, polygon):
+        """
+        Selects all tiles where at least one corner of the bounding box intersects the polygon.
+
+        Parameters
+        ----------
+        polygon : shapely.geometry.polygon.Polygon
+            Geo-referenced polygon geometry, e.g. of the selected county.
+
+        Returns
+        -------
+        tuple
+            Two numpy.ndarrays with the row and column indices of all selected tiles in row-major order.
+        """
+
+        prepared_polygon = prep(polygon)
+
+        selected_rows = []
+        selected_cols = []
+
+        blocks = [(0, self.shape[0], 0, self.shape[1])]
+
+        while blocks:
+
+            r0, r1, c0, c1 = blocks.pop()
+
+            envelope = self._block_envelope(r0, r1, c0, c1)
+
+            if envelope is None:
+
+                continue
+
+            block_box = box(*envelope)
+
+            # No tile corner within the block can intersect the polygon
+            if not prepared_polygon.intersects(block_box):
+
+                continue
+
+            # Every tile corner within the block intersects the polygon
+            if prepared_polygon.contains(block_box):
+
+                rows, cols = self._block_cells(r0, r1, c0, c1)
+
+                selected_rows.append(rows)
+                selected_cols.append(cols)
+
+                continue
+
+            if (r1 - r0) <= self.leaf_size and (c1 - c0) <= self.leaf_size:
+
+                rows, cols = self._block_cells(r0, r1, c0, c1)
+
+                minx, miny, maxx, maxy = self.bounds(rows, cols)
+
+                # Lower left, lower right, upper left and upper right corner of each tile
+                corners_in_polygon = (
+                    intersects_xy(polygon, minx, miny)
+                    | intersects_xy(polygon, maxx, miny)
+                    | intersects_xy(polygon, minx, maxy)
+                    | intersects_xy(polygon, maxx, maxy)
+                )
+
+                selected_rows.append(rows[corners_in_polygon])
+                selected_cols.append(cols[corners_in_polygon])
+
+                continue
+
+            # Split the block into (up to) four quadrants
+            r_mid = (r0 + r1) // 2 if (r1 - r0) > 1 else r1
+            c_mid = (c0 + c1) // 2 if (c1 - c0) > 1 else c1
+
+            for rr0, rr1 in ((r0, r_mid), (r_mid, r1)):
+
+                for cc0, cc1 in ((c0, c_mid), (c_mid, c1)):
+
+                    if rr0 < rr1 and cc0 < cc1:
+
+                        blocks.append((rr0, rr1, cc0, cc1))
+
+        if not selected_rows:
+
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        rows = np.concatenate(selected_rows)
+        cols = np.concatenate(selected_cols)
+
+        # Restore the south-to-north, west-to-east order of the original grid walk
+        order = np.lexsort((cols, rows))
+
+        return rows[order].astype(np.int64), cols[order].astype(np.int64)
+
+    def tile_ids(self, rows, cols):
+        """
+        Stable integer IDs for the given tiles. The ID only depends on the position of a tile within the grid, hence
+        the same tile has the same ID in every county.
+
+        Parameters
+        ----------
+        rows : numpy.ndarray
+            Row indices of the tiles.
+        cols : numpy.ndarray
+            Column indices of the tiles.
+
+        Returns
+        -------
+        numpy.ndarray
+            Integer tile IDs, i.e. row * number of grid columns + col.
+        """
+
+        return np.asarray(rows, dtype=np.int64) * self.shape[1] + np.asarray(cols, dtype=np.int64)
@@ -0,0 +1,227 @@
+import numpy as np
+from pathlib import Path
+
+# Record layout of a single tile: stable integer ID, position within the TileGrid and bounding box coordinates
+TILE_DTYPE = np.dtype([
+    ('id', '<i8'),
+    ('row', '<i4'),
+    ('col', '<i4'),
+    ('minx', '<f8'),
+    ('miny', '<f8'),
+    ('maxx', '<f8'),
+    ('maxy', '<f8'),
+])
+
+# Suffix which signals that a tile has been completely downloaded and is ready to be processed
+COMPLETE_SUFFIX = ',COMPLETE.png'
+
+
+def tile_filename(tile_id, complete=True):
+    """
+    File name under which a tile is saved in tile_dir.
+
+    Parameters
+    ----------
+    tile_id : int
+        Integer ID of the tile.
+    complete : bool
+        Whether the tile has been completely downloaded.
+
+    Returns
+    -------
+    str
+        E.g. '812345,COMPLETE.png' for a complete and '812345.png' for an incomplete tile.
+    """
+
+    return f"{int(tile_id)}{COMPLETE_SUFFIX}" if complete else f"{int(tile_id)}.png"
+
+
+def tile_id_from_filename(filename):
+    """
+    Inverse of tile_filename().
+
+    Parameters
+    ----------
+    filename : str
+        File name of a tile, e.g. '812345,COMPLETE.png'.
+
+    Returns
+    -------
+    int
+        Integer ID of the tile.
+    """
+
+    return int(str(filename).split(',')[0].split('.')[0])
+
+
+class TileIndex(object):
+    """
+    Compact, array-backed index of all tiles within a county. Each tile is identified by a stable integer ID derived
+    from its (row, col) position on the TileGrid. The index is saved as a structured NumPy array which can be
+    memory-mapped, and the conversion between tile ID and bounding box is O(1).
+
+    Attributes
+    ----------
+    tiles : numpy.ndarray
+        Structured array with TILE_DTYPE, sorted by tile ID.
+    """
+
+    def __init__(self, tiles):
+        """
+        Parameters
+        ----------
+        tiles : numpy.ndarray
+            Structured array with TILE_DTYPE.
+        """
+
+        if len(tiles) > 1 and np.any(np.diff(tiles['id']) <= 0):
+
+            tiles = np.sort(np.asarray(tiles), order='id')
+
+        self.tiles = tiles
+
+        # Dense lookup table from tile ID to position in self.tiles, covering the ID range of the county only
+        ids = np.asarray(tiles['id'])
+
+        self._id_offset = int(ids[0]) if len(ids) else 0
+
+        self._positions = np.full(int(ids[-1]) - self._id_offset + 1 if len(ids) else 0, -1, dtype=np.int64)
+        self._positions[ids - self._id_offset] = np.arange(len(ids))
+
+    @classmethod
+    def from_grid(cls, grid, rows, cols):
+        """
+        Creates the index for the given tiles of a TileGrid.
+
+        Parameters
+        ----------
+        grid : src.utils.tile_grid.TileGrid
+            Grid on which the tiles are defined.
+        rows : numpy.ndarray
+            Row indices of the tiles.
+        cols : numpy.ndarray
+            Column indices of the tiles.
+
+        Returns
+        -------
+        TileIndex
+        """
+
+        tiles = np.empty(len(rows), dtype=TILE_DTYPE)
+
+        tiles['id'] = grid.tile_ids(rows, cols)
+        tiles['row'] = rows
+        tiles['col'] = cols
+        tiles['minx'], tiles['miny'], tiles['maxx'], tiles['maxy'] = grid.bounds(rows, cols)
+
+        return cls(tiles)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads the index from a .npy file.
+
+        Parameters
+        ----------
+        path : Path
+            Path to the .npy file.
+        mmap : bool
+            Memory-map the file instead of reading it into memory.
+
+        Returns
+        -------
+        TileIndex
+        """
+
+        return cls(np.load(Path(path), mmap_mode='r' if mmap else None))
+
+    def save(self, path):
+        """
+        Saves the index as a .npy file.
+
+        Parameters
+        ----------
+        path : Path
+            Path to the .npy file.
+        """
+
+        np.save(Path(path), np.ascontiguousarray(self.tiles))
+
+    def __len__(self):
+
+        return len(self.tiles)
+
+    def __contains__(self, tile_id):
+
+        return self._position(tile_id) >= 0
+
+    @property
+    def ids(self):
+
+        return np.asarray(self.tiles['id'])
+
+    def _position(self, tile_id):
+
+        offset = int(tile_id) - self._id_offset
+
+        if offset < 0 or offset >= len(self._positions):
+
+            return -1
+
+        return int(self._positions[offset])
+
+    def bbox(self, tile_id):
+        """
+        Bounding box of a single tile.
+
+        Parameters
+        ----------
+        tile_id : int
+            Integer ID of the tile.
+
+        Returns
+        -------
+        tuple
+            minx, miny, maxx, maxy coordinates of the tile.
+        """
+
+        position = self._position(tile_id)
+
+        if position < 0:
+
+            raise KeyError(f"Tile {tile_id} is not part of the tile index")
+
+        tile = self.tiles[position]
+
+        return float(tile['minx']), float(tile['miny']), float(tile['maxx']), float(tile['maxy'])
+
+    def bboxes(self):
+        """
+        Bounding boxes of all tiles.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of shape (len(self), 4) with the minx, miny, maxx, maxy coordinates of each tile.
+        """
+
+        return np.stack([self.tiles['minx'], self.tiles['miny'], self.tiles['maxx'], self.tiles['maxy']], axis=1)
+
+    def drop(self, tile_ids):
+        """
+        Removes the given tiles from the index.
+
+        Parameters
+        ----------
+        tile_ids : iterable
+            Integer IDs of the tiles to be removed.
+
+        Returns
+        -------
+        TileIndex
+            New index without the given tiles.
+        """
+
+        keep = ~np.isin(self.ids, np.fromiter(tile_ids, dtype=np.int64))
+
+        return TileIndex(np.asarray(self.tiles)[keep])
@@ -0,0 +1,179 @@
+import io
+from pathlib import Path
+import numpy as np
+import torch
+from PIL import Image
+from src.utils.geo_utils import intersects_xy
+from src.utils.patch_grid import PATCHES_PER_TILE, PATCH_SIZE, TILE_SIZE, patch_corners, patch_window
+from src.utils.tile_index import tile_id_from_filename
+
+
+class TileSplitter(object):
+    """
+    Decodes a tile and splits it into the 320x320 pixel images which lie within the county polygon and, if a
+    BuildingIndex is given, close to a building. Everything a DataLoader worker needs to prepare a tile for inference
+    is kept in this object, so that decoding and splitting can run in worker processes.
+
+    Attributes
+    ----------
+    tile_dir : str
+        Path to directory where all the downloaded tiles are saved.
+    polygon : shapely.geometry.polygon.Polygon
+        Geo-referenced polygon geometry for the selected county within NRW.
+    tile_coords : src.utils.tile_index.TileIndex
+        Index of all tiles within the selected county, used to look up a tile's minx, miny, maxx, maxy coordinates by its tile ID.
+    building_index : src.utils.building_index.BuildingIndex
+        Building footprints of the selected county. None if images are not filtered by buildings.
+    side : int
+        Image side length in meters.
+    radius : int
+        Earth radius in meters.
+    dlat : float
+        Spans a distance of 'side' meters in north-south direction.
+    """
+
+    def __init__(self, tile_dir, polygon, tile_coords, building_index=None, side=16, radius=6371000):
+
+        self.tile_dir = tile_dir
+
+        self.polygon = polygon
+
+        self.tile_coords = tile_coords
+
+        self.building_index = building_index
+
+        self.side = side
+
+        self.radius = radius
+
+        self.dlat = (self.side * 360) / (2 * np.pi * self.radius)
+
+    def __call__(self, filename, tile_bytes=None):
+        """
+        Parameters
+        ----------
+        filename : str
+            File name of the tile, i.e. '<tile ID>,COMPLETE.png'.
+        tile_bytes : bytes
+            PNG bytes of the tile if it was handed over in memory instead of being saved in tile_dir.
+
+        Returns
+        -------
+        tuple
+            List of the upper left (x, y) coordinates of the images and torch.Tensor of shape (N, 320, 320, 3) with the
+            uint8 images.
+        """
+
+        # Load image tile, either from disk or from the bytes which the TileDownloader handed over in memory
+        if tile_bytes is not None:
+
+            tile = Image.open(io.BytesIO(tile_bytes))
+
+        else:
+
+            tile = Image.open(Path(self.tile_dir + "/" + filename))
+
+        if not tile.mode == 'RGB':
+            tile = tile.convert('RGB')
+
+        minx, miny, maxx, maxy = self.tile_coords.bbox(tile_id_from_filename(filename))
+
+        if tile.size != (TILE_SIZE, TILE_SIZE):
+
+            tile = self.restore(tile, minx, maxy)
+
+        coords, images = self.split(tile, minx, maxy)
+
+        # A tensor is moved to the main process through shared memory instead of being pickled
+        return coords, torch.from_numpy(images)
+
+    def restore(self, tile, minx, maxy):
+        """
+        Puts a border tile which was only downloaded for the block of images within the county back into place
+        within the full 4800x4800 pixel tile.
+
+        Parameters
+        ----------
+        tile : PIL.Image.Image
+            Clipped tile.
+        minx : float
+            Western boundary of the tile.
+        maxy : float
+            Northern boundary of the tile.
+
+        Returns
+        -------
+        PIL.Image.Image
+        """
+
+        # The TileDownloader requests border tiles only for the block of images within the county, which
+        # is recomputed here to put the block back into place within the full tile
+        row_start, row_stop, col_start, col_stop = patch_window(self.polygon, minx, maxy, self.side, self.radius)
+
+        expected_size = ((col_stop - col_start) * PATCH_SIZE, (row_stop - row_start) * PATCH_SIZE)
+
+        if tile.size != expected_size:
+
+            raise ValueError(f"Tile of size {tile.size} matches neither a full nor a clipped tile of size {expected_size}")
+
+        # Pixels outside the block belong to images outside the county, which are discarded in split()
+        full_tile = Image.new('RGB', (TILE_SIZE, TILE_SIZE))
+
+        full_tile.paste(tile, (col_start * PATCH_SIZE, row_start * PATCH_SIZE))
+
+        return full_tile
+
+    def split(self, tile, minx, maxy):
+        """
+        Takes a 4800x4800 image tile and returns the 320x320 pixel images which are within the county polygon.
+
+        Parameters
+        ----------
+        tile : PIL.Image.Image
+            Full RGB tile.
+        minx : float
+            Western boundary of the tile.
+        maxy : float
+            Northern boundary of the tile.
+
+        Returns
+        -------
+        tuple
+            List of the upper left (x, y) coordinates of the images and numpy.ndarray of shape (N, 320, 320, 3).
+        """
+
+        tile = np.asarray(tile)
+
+        # The first image is taken from the upper left corner, we then slide from left
+        # to right and from top to bottom. Each image shall cover an area of 16x16m
+        # and shall be identified by the coordinates of its upper left corner.
+        # reshape() and swapaxes() only create a (15, 15, 320, 320, 3) view on the tile without copying any pixels
+        patches = tile.reshape(PATCHES_PER_TILE, PATCH_SIZE, PATCHES_PER_TILE, PATCH_SIZE, 3).swapaxes(1, 2)
+
+        # Upper left coordinates of all images, x with shape (15, 15) and y with shape (15,)
+        x, y = patch_corners(float(minx), float(maxy), self.side, self.radius)
+
+        y_grid = np.broadcast_to(y[:, None], x.shape)
+
+        # A (15, 15) boolean array indicating whether an image's upper left coordinate is within the county polygon,
+        # tested for all images in one vectorized call against the prepared polygon
+        in_polygon = intersects_xy(self.polygon, x, y_grid)
+
+        # Images without a rooftop nearby cannot contain a rooftop PV system and are not classified
+        if self.building_index is not None:
+
+            dlon = (self.side * 360) / (2 * np.pi * self.radius * np.cos(np.deg2rad(y_grid)))
+
+            near_building = self.building_index.intersects(
+                x.ravel(), (y_grid - self.dlat).ravel(), (x + dlon).ravel(), y_grid.ravel()
+            )
+
+            in_polygon &= near_building.reshape(x.shape)
+
+        rows, cols = np.nonzero(in_polygon)
+
+        # Fancy indexing copies only the selected images into one contiguous (N, 320, 320, 3) array
+        images_in_polygon = patches[rows, cols]
+        coords_in_polygon = list(zip(x[rows, cols], y[rows]))
+
+        return coords_in_polygon, images_in_polygon